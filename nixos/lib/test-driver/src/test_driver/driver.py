@@ -171,12 +171,31 @@ class Driver:
             f"Test will time out and terminate in {self.global_timeout} seconds"
         )
         self.race_timer.start()
-        self.test_script()
+        try:
+            self.test_script()
+        finally:
+            self.log_wait_timings()
         # TODO: Collect coverage data
         for machine in self.machines:
             if machine.is_up():
                 machine.execute("sync")
 
+    def log_wait_timings(self) -> None:
+        """Log how long every wait of the machines blocked the test script"""
+        machines = [machine for machine in self.machines if machine.wait_timings]
+        if not machines:
+            return
+
+        with self.logger.nested("wait timings"):
+            for machine in machines:
+                total = sum(seconds for _, seconds in machine.wait_timings)
+                self.logger.info(
+                    f"{machine.name}: {len(machine.wait_timings)} waits "
+                    f"blocked for {total:.2f} seconds in total"
+                )
+                for description, seconds in machine.wait_timings:
+                    self.logger.info(f"  {seconds:8.3f}s {description}")
+
     def start_all(self) -> None:
         """Start all machines"""
         with self.logger.nested("start all VMs"):
@@ -3,17 +3,19 @@ import io
 import os
 import queue
 import re
+import secrets
 import select
 import shlex
 import shutil
 import socket
 import subprocess
 import sys
+import tarfile
 import tempfile
 import threading
 import time
-from collections.abc import Callable, Iterable
-from contextlib import _GeneratorContextManager, nullcontext
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from contextlib import _GeneratorContextManager, contextmanager, nullcontext
 from pathlib import Path
 from queue import Queue
 from typing import Any
@@ -168,18 +170,105 @@ def _perform_ocr_on_screenshot(
     return model_results
 
 
-def retry(fn: Callable, timeout: int = 900) -> None:
-    """Call the given function repeatedly, with 1 second intervals,
-    until it returns True or a timeout is reached.
+# Intervals between the attempts of `retry`, in seconds
+RETRY_INITIAL_INTERVAL = 0.01
+RETRY_MAX_INTERVAL = 1.0
+
+# How long a condition is polled for inside the guest at once, and how often,
+# in seconds. See `Machine.wait_in_guest`.
+GUEST_WAIT_SLICE = 1
+GUEST_POLL_INTERVAL = 0.05
+
+
+def retry(fn: Callable, timeout: int = 900) -> int:
+    """Call the given function repeatedly until it returns True or a timeout
+    (in seconds) is reached. The interval between the calls starts at
+    10 milliseconds and doubles up to 1 second, so conditions which become true
+    quickly are noticed quickly.
+
+    Returns the number of calls it took.
     """
+    deadline = time.monotonic() + timeout
+    interval = RETRY_INITIAL_INTERVAL
+    attempts = 0
 
-    for _ in range(timeout):
+    while True:
+        attempts += 1
         if fn(False):
-            return
-        time.sleep(1)
+            return attempts
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, RETRY_MAX_INTERVAL)
 
     if not fn(True):
         raise Exception(f"action timed out after {timeout} seconds")
+    return attempts + 1
+
+
+# How much to read from the guest shell at once
+SHELL_RECV_SIZE = 256 * 1024
+
+
+class CommandOutput(Iterator[bytes]):
+    """Iterator over the standard output of a command run on the guest
+    shell, yielding the raw bytes in chunks as they arrive.
+
+    The guest shell terminates the output with a line consisting of a
+    boundary, which is unique to the command, and its exit status. Once the
+    iterator is exhausted, `status` holds the exit status of the command,
+    or stays `None` if the connection broke before it was received.
+    """
+
+    status: int | None
+    done: bool
+
+    def __init__(self, shell: socket.socket, boundary: bytes) -> None:
+        self._shell = shell
+        self._marker = b"\n" + boundary + b" "
+        self._buffer = bytearray()
+        self.status = None
+        self.done = False
+
+    def __next__(self) -> bytes:
+        while not self.done:
+            end = self._buffer.find(self._marker)
+            if end != -1:
+                status_start = end + len(self._marker)
+                status_end = self._buffer.find(b"\n", status_start)
+                if status_end != -1:
+                    self.status = int(self._buffer[status_start:status_end])
+                    self.done = True
+                    chunk = bytes(self._buffer[:end])
+                    self._buffer.clear()
+                    if chunk:
+                        return chunk
+                    break
+            else:
+                # Everything that can't be the beginning of the marker is
+                # output of the command already
+                safe = len(self._buffer) - len(self._marker) + 1
+                if safe > 0:
+                    chunk = bytes(self._buffer[:safe])
+                    del self._buffer[:safe]
+                    return chunk
+
+            received = self._shell.recv(SHELL_RECV_SIZE)
+            if not received:
+                # Probably a broken pipe, return the output we have
+                self.done = True
+                chunk = bytes(self._buffer)
+                self._buffer.clear()
+                if chunk:
+                    return chunk
+                break
+            self._buffer += received
+        raise StopIteration
+
+    def read_all(self) -> bytes:
+        """Consume the remaining output and return it."""
+        return b"".join(self)
 
 
 class StartCommand:
@@ -302,6 +391,11 @@ class Machine:
     qmp_client: QMPSession | None
     shell: socket.socket | None
     serial_thread: threading.Thread | None
+    # Output of the last command sent to the shell, unless it was read
+    # completely already
+    pending_output: CommandOutput | None
+    # What was waited for and for how long, in seconds
+    wait_timings: list[tuple[str, float]]
 
     booted: bool
     connected: bool
@@ -349,6 +443,8 @@ class Machine:
         self.qmp_client = None
         self.shell = None
         self.serial_thread = None
+        self.pending_output = None
+        self.wait_timings = []
 
         self.booted = False
         self.connected = False
@@ -367,6 +463,39 @@ class Machine:
         my_attrs.update(attrs)
         return self.logger.nested(msg, my_attrs)
 
+    def wait(self, description: str, fn: Callable, timeout: int = 900) -> None:
+        """
+        `retry` the given function until it returns True, logging what is
+        waited for and recording how long it blocked in `wait_timings`.
+        """
+        with self._waiting(description):
+            retry(fn, timeout)
+
+    @contextmanager
+    def _waiting(self, description: str) -> Iterator[None]:
+        """Log what is waited for and record how long the block took in
+        `wait_timings`, see `wait`.
+        """
+        with self.nested(description):
+            start = time.monotonic()
+            try:
+                yield
+            finally:
+                self.wait_timings.append((description, time.monotonic() - start))
+
+    def wait_in_guest(self, condition: str) -> bool:
+        """
+        Poll the given shell condition inside the guest, every few
+        milliseconds for up to a second, and return whether it became true.
+        Compared to checking it from the host, this notices changes sooner
+        while sending fewer commands to the guest.
+        """
+        status, _ = self.execute(
+            f"until {condition}; do sleep {GUEST_POLL_INTERVAL}; done",
+            timeout=GUEST_WAIT_SLICE,
+        )
+        return status == 0
+
     def wait_for_monitor_prompt(self) -> str:
         assert self.monitor is not None
         answer = ""
@@ -400,6 +529,13 @@ class Machine:
         """
 
         def check_active(_last_try: bool) -> bool:
+            if user is None:
+                # Let the guest wait for the unit to leave transitional states
+                self.wait_in_guest(
+                    f"! systemctl show --property=ActiveState --value {shlex.quote(unit)}"
+                    " | grep --quiet --line-regexp"
+                    " --regexp=activating --regexp=deactivating --regexp=reloading"
+                )
             state = self.get_unit_property(unit, "ActiveState", user)
             if state == "failed":
                 raise Exception(f'unit "{unit}" reached state "{state}"')
@@ -415,11 +551,12 @@ class Machine:
 
             return state == "active"
 
-        with self.nested(
+        self.wait(
             f"waiting for unit {unit}"
-            + (f" with user {user}" if user is not None else "")
-        ):
-            retry(check_active, timeout)
+            + (f" with user {user}" if user is not None else ""),
+            check_active,
+            timeout,
+        )
 
     def get_unit_info(self, unit: str, user: str | None = None) -> dict[str, str]:
         status, lines = self.systemctl(f'--no-pager show "{unit}"', user)
@@ -507,21 +644,48 @@ class Machine:
                     f"'{require_state}' but it is in state '{state}'"
                 )
 
-    def _next_newline_closed_block_from_shell(self) -> str:
+    def _send_command(
+        self, command: str, timeout: int | None, check_output: bool = True
+    ) -> CommandOutput | None:
+        """Send a command to the guest shell and return the iterator over its
+        output, see `CommandOutput`.
+        """
+        self.run_callbacks()
+        self.connect()
+
         assert self.shell
-        output_buffer = []
-        while True:
-            # This receives up to 4096 bytes from the socket
-            chunk = self.shell.recv(4096)
-            if not chunk:
-                # Probably a broken pipe, return the output we have
-                break
 
-            decoded = chunk.decode()
-            output_buffer += [decoded]
-            if decoded[-1] == "\n":
-                break
-        return "".join(output_buffer)
+        # The shell runs one command after another, so the output of the
+        # previous one has to be out of the way first.
+        if self.pending_output is not None:
+            self.pending_output.read_all()
+            self.pending_output = None
+
+        # Always run command with shell opts
+        command = f"set -euo pipefail; {command}"
+
+        timeout_str = ""
+        if timeout is not None:
+            timeout_str = f"timeout {timeout}"
+
+        # While sh is bash on NixOS, this is not the case for every distro.
+        # We explicitly call bash here to allow for the driver to boot other distros as well.
+        # stdout goes through `cat`, so commands keep writing to a pipe rather
+        # than the terminal of the shell.
+        out_command = f"{timeout_str} bash -c {shlex.quote(command)}"
+
+        if not check_output:
+            self.shell.send(f"{out_command} > /dev/null\n".encode())
+            return None
+
+        boundary = f"nixos-test-driver-{secrets.token_hex(16)}"
+        self.shell.send(
+            f"{out_command} | cat; "
+            f"printf '\\n%s %d\\n' {boundary} \"${{PIPESTATUS[0]}}\"\n".encode()
+        )
+
+        self.pending_output = CommandOutput(self.shell, boundary.encode())
+        return self.pending_output
 
     def execute(
         self,
@@ -561,40 +725,48 @@ class Machine:
         A timeout for the command can be specified (in seconds) using the optional
         `timeout` parameter, e.g., `execute(cmd, timeout=10)` or
         `execute(cmd, timeout=None)`. The default is 900 seconds.
-        """
-        self.run_callbacks()
-        self.connect()
-
-        # Always run command with shell opts
-        command = f"set -euo pipefail; {command}"
-
-        timeout_str = ""
-        if timeout is not None:
-            timeout_str = f"timeout {timeout}"
 
-        # While sh is bash on NixOS, this is not the case for every distro.
-        # We explicitly call bash here to allow for the driver to boot other distros as well.
-        out_command = (
-            f"{timeout_str} bash -c {shlex.quote(command)} | (base64 -w 0; echo)\n"
-        )
-
-        assert self.shell
-        self.shell.send(out_command.encode())
+        The output and the exit status are sent back in one go, see
+        `execute_stream` for commands with a lot of output.
+        """
+        output_stream = self._send_command(command, timeout, check_output)
 
-        if not check_output:
+        if output_stream is None:
             return (-2, "")
 
-        # Get the output
-        output = base64.b64decode(self._next_newline_closed_block_from_shell())
+        output = output_stream.read_all()
+        self.pending_output = None
 
         if not check_return:
             return (-1, output.decode())
 
-        # Get the return code
-        self.shell.send(b"echo ${PIPESTATUS[0]}\n")
-        rc = int(self._next_newline_closed_block_from_shell().strip())
+        if output_stream.status is None:
+            raise Exception(
+                f"connection to the guest shell broke while running `{command}`"
+            )
+
+        return (output_stream.status, output.decode(errors="replace"))
+
+    def execute_stream(self, command: str, timeout: int | None = 900) -> CommandOutput:
+        """
+        Execute a shell command like `execute`, but return an iterator over
+        its standard output as it arrives, in chunks of raw bytes. Once the
+        iterator is exhausted, its `status` attribute holds the exit status.
+        This avoids holding large outputs in memory, e.g.:
+
+        ```py
+        output = machine.execute_stream("cat /dev/vda")
+        with open("disk.img", "wb") as f:
+            for chunk in output:
+                f.write(chunk)
+        assert output.status == 0
+        ```
 
-        return (rc, output.decode(errors="replace"))
+        Any other command run on the machine first reads the remaining output.
+        """
+        output_stream = self._send_command(command, timeout)
+        assert output_stream is not None
+        return output_stream
 
     def shell_interact(self, address: str | None = None) -> None:
         """
@@ -676,7 +848,8 @@ class Machine:
 
     def wait_until_succeeds(self, command: str, timeout: int = 900) -> str:
         """
-        Repeat a shell command with 1-second intervals until it succeeds.
+        Repeat a shell command with increasing intervals of up to 1 second
+        until it succeeds.
         Has a default timeout of 900 seconds which can be modified, e.g.
         `wait_until_succeeds(cmd, timeout=10)`. See `execute` for details on
         command execution.
@@ -689,9 +862,8 @@ class Machine:
             status, output = self.execute(command, timeout=timeout)
             return status == 0
 
-        with self.nested(f"waiting for success: {command}"):
-            retry(check_success, timeout)
-            return output
+        self.wait(f"waiting for success: {command}", check_success, timeout)
+        return output
 
     def wait_until_fails(self, command: str, timeout: int = 900) -> str:
         """
@@ -704,9 +876,8 @@ class Machine:
             status, output = self.execute(command, timeout=timeout)
             return status != 0
 
-        with self.nested(f"waiting for failure: {command}"):
-            retry(check_failure, timeout)
-            return output
+        self.wait(f"waiting for failure: {command}", check_failure, timeout)
+        return output
 
     def wait_for_shutdown(self) -> None:
         if not self.booted:
@@ -720,6 +891,7 @@ class Machine:
             self.pid = None
             self.booted = False
             self.connected = False
+            self.pending_output = None
 
     def wait_for_qmp_event(
         self, event_filter: Callable[[dict[str, Any]], bool], timeout: int = 60 * 10
@@ -768,8 +940,7 @@ class Machine:
                 )
             return len(matcher.findall(text)) > 0
 
-        with self.nested(f"waiting for {regexp} to appear on tty {tty}"):
-            retry(tty_matches, timeout)
+        self.wait(f"waiting for {regexp} to appear on tty {tty}", tty_matches, timeout)
 
     def send_chars(self, chars: str, delay: float | None = 0.01) -> None:
         r"""
@@ -787,11 +958,9 @@ class Machine:
         """
 
         def check_file(_last_try: bool) -> bool:
-            status, _ = self.execute(f"test -e {filename}")
-            return status == 0
+            return self.wait_in_guest(f"test -e {filename}")
 
-        with self.nested(f"waiting for file '{filename}'"):
-            retry(check_file, timeout)
+        self.wait(f"waiting for file '{filename}'", check_file, timeout)
 
     def wait_for_open_port(
         self, port: int, addr: str = "localhost", timeout: int = 900
@@ -802,11 +971,9 @@ class Machine:
         """
 
         def port_is_open(_last_try: bool) -> bool:
-            status, _ = self.execute(f"nc -z {addr} {port}")
-            return status == 0
+            return self.wait_in_guest(f"nc -z {addr} {port}")
 
-        with self.nested(f"waiting for TCP port {port} on {addr}"):
-            retry(port_is_open, timeout)
+        self.wait(f"waiting for TCP port {port} on {addr}", port_is_open, timeout)
 
     def wait_for_open_unix_socket(
         self, addr: str, is_datagram: bool = False, timeout: int = 900
@@ -822,13 +989,13 @@ class Machine:
         ]
 
         def socket_is_open(_last_try: bool) -> bool:
-            status, _ = self.execute(f"nc {' '.join(nc_flags)} {addr}")
-            return status == 0
+            return self.wait_in_guest(f"nc {' '.join(nc_flags)} {addr}")
 
-        with self.nested(
-            f"waiting for UNIX-domain {'datagram' if is_datagram else 'stream'} on '{addr}'"
-        ):
-            retry(socket_is_open, timeout)
+        self.wait(
+            f"waiting for UNIX-domain {'datagram' if is_datagram else 'stream'} on '{addr}'",
+            socket_is_open,
+            timeout,
+        )
 
     def wait_for_closed_port(
         self, port: int, addr: str = "localhost", timeout: int = 900
@@ -839,11 +1006,13 @@ class Machine:
         """
 
         def port_is_closed(_last_try: bool) -> bool:
-            status, _ = self.execute(f"nc -z {addr} {port}")
-            return status != 0
+            return self.wait_in_guest(f"! nc -z {addr} {port}")
 
-        with self.nested(f"waiting for TCP port {port} on {addr} to be closed"):
-            retry(port_is_closed, timeout)
+        self.wait(
+            f"waiting for TCP port {port} on {addr} to be closed",
+            port_is_closed,
+            timeout,
+        )
 
     def start_job(self, jobname: str, user: str | None = None) -> tuple[int, str]:
         return self.systemctl(f"start {jobname}", user)
@@ -985,6 +1154,117 @@ class Machine:
             else:
                 shutil.copy(intermediate, abs_target)
 
+    def _log_transfer(self, what: str, archive: Path, seconds: float) -> None:
+        size = archive.stat().st_size
+        self.log(
+            f"transferred {what} as {size} bytes in {seconds:.2f} seconds "
+            f"({size / max(seconds, 1e-6) / 1024**2:.1f} MiB/s)"
+        )
+
+    def copy_from_host_bulk(self, files: Mapping[str, str]) -> None:
+        """
+        Copies many files or directory trees from the host to the machine at
+        once, e.g.,
+        `copy_from_host_bulk({"myfile": "/etc/my/file", "mydir": "/var/lib/mydir"})`.
+
+        Keys are paths on the host, values the paths on the machine they are
+        copied to. Unlike `copy_from_host`, directories are copied to exactly
+        the given path, even if it exists already.
+
+        Everything is streamed into a single tar archive in the `shared_dir`
+        and unpacked in the machine with one command. Access rights bits, symlinks
+        and hard links are preserved, user:group will be root:root.
+        """
+
+        def as_root(ti: tarfile.TarInfo) -> tarfile.TarInfo:
+            ti.uid = ti.gid = 0
+            ti.uname = ti.gname = "root"
+            return ti
+
+        with self.nested(f"copying {len(files)} paths from the host"):
+            with tempfile.TemporaryDirectory(dir=self.shared_dir) as shared_td:
+                shared_temp = Path(shared_td)
+                archive = shared_temp / "transfer.tar"
+                vm_archive = Path("/tmp/shared") / shared_temp.name / archive.name
+
+                start = time.monotonic()
+                # Hard links are only detected within one archive, so all
+                # files have to go into the same one.
+                with tarfile.open(archive, "w") as tar:
+                    for source, target in files.items():
+                        tar.add(
+                            source,
+                            arcname=os.path.relpath(Path("/") / target, "/"),
+                            filter=as_root,
+                        )
+                self.succeed(
+                    make_command(
+                        [
+                            "tar",
+                            "-x",
+                            "-p",
+                            "--numeric-owner",
+                            "-f",
+                            vm_archive,
+                            "-C",
+                            "/",
+                        ]
+                    )
+                )
+                self._log_transfer(
+                    f"{len(files)} paths", archive, time.monotonic() - start
+                )
+
+    def copy_from_vm_bulk(self, sources: Iterable[str], target_dir: str = "") -> None:
+        """
+        Copies many files or directory trees from the VM (specified by in-VM
+        source paths) to a path relative to `$out` at once, like
+        `copy_from_vm` does for a single one.
+
+        Everything is packed into a single tar archive in the `shared_dir`
+        with one command and unpacked on the host. Access rights bits, symlinks
+        and hard links are preserved.
+
+        Sources must be absolute paths, and, as they are all copied into
+        `target_dir` by their name, have different names.
+        """
+        vm_sources = [Path(source) for source in sources]
+        names: dict[str, Path] = {}
+        for vm_src in vm_sources:
+            # tar's `-C` options are cumulative, so relative paths would be
+            # resolved against the previous source
+            if not vm_src.is_absolute() or vm_src == vm_src.parent:
+                raise Exception(
+                    f"cannot copy {vm_src} from the VM, sources must be absolute "
+                    "paths other than /"
+                )
+            if vm_src.name in names:
+                raise Exception(
+                    f"cannot copy both {names[vm_src.name]} and {vm_src} from "
+                    f"the VM, they would both be copied to {vm_src.name}"
+                )
+            names[vm_src.name] = vm_src
+
+        with self.nested(f"copying {len(vm_sources)} paths from the VM"):
+            with tempfile.TemporaryDirectory(dir=self.shared_dir) as shared_td:
+                shared_temp = Path(shared_td)
+                archive = shared_temp / "transfer.tar"
+                vm_archive = Path("/tmp/shared") / shared_temp.name / archive.name
+
+                start = time.monotonic()
+                tar_args: list[str | Path] = ["tar", "-c", "-f", vm_archive]
+                for vm_src in vm_sources:
+                    tar_args += ["-C", vm_src.parent, vm_src.name]
+                self.succeed(make_command(tar_args))
+
+                abs_target = self.out_dir / target_dir
+                abs_target.mkdir(exist_ok=True, parents=True)
+                with tarfile.open(archive) as tar:
+                    tar.extractall(abs_target, filter="tar")
+                self._log_transfer(
+                    f"{len(vm_sources)} paths", archive, time.monotonic() - start
+                )
+
     def dump_tty_contents(self, tty: str) -> None:
         """Debugging: Dump the contents of the TTY<n>"""
         self.execute(f"fold -w 80 /dev/vcs{tty} | systemd-cat")
@@ -1042,8 +1322,7 @@ class Machine:
 
             return False
 
-        with self.nested(f"waiting for {regex} to appear on screen"):
-            retry(screen_matches, timeout)
+        self.wait(f"waiting for {regex} to appear on screen", screen_matches, timeout)
 
     def wait_for_console_text(self, regex: str, timeout: int | None = None) -> None:
         """
@@ -1057,20 +1336,21 @@ class Machine:
 
         def console_matches(_last_try: bool) -> bool:
             nonlocal console
-            try:
-                # This will return as soon as possible and
-                # sleep 1 second.
-                console.write(self.last_lines.get(block=False))
-            except queue.Empty:
-                pass
+            # Take all lines which arrived since the last call
+            while True:
+                try:
+                    console.write(self.last_lines.get(block=False))
+                except queue.Empty:
+                    break
             console.seek(0)
             matches = re.search(regex, console.read())
             return matches is not None
 
-        with self.nested(f"waiting for {regex} to appear on console"):
-            if timeout is not None:
-                retry(console_matches, timeout)
-            else:
+        description = f"waiting for {regex} to appear on console"
+        if timeout is not None:
+            self.wait(description, console_matches, timeout)
+        else:
+            with self._waiting(description):
                 while not console_matches(False):
                     pass
 
@@ -1135,6 +1415,7 @@ class Machine:
         )
         self.monitor, _ = monitor_socket.accept()
         self.shell, _ = shell_socket.accept()
+        self.pending_output = None
         self.qmp_client = QMPSession.from_path(self.qmp_path)
 
         # Store last serial console lines for use
@@ -1195,6 +1476,8 @@ class Machine:
         """
         self.send_key("ctrl-alt-delete")
         self.connected = False
+        # The output of a command that is still running is lost with its shell
+        self.pending_output = None
 
     def wait_for_x(self, timeout: int = 900) -> None:
         """
@@ -1212,8 +1495,7 @@ class Machine:
             status, _ = self.execute("[ -e /tmp/.X11-unix/X0 ]")
             return status == 0
 
-        with self.nested("waiting for the X11 server"):
-            retry(check_x, timeout)
+        self.wait("waiting for the X11 server", check_x, timeout)
 
     def get_window_names(self) -> list[str]:
         return self.succeed(
@@ -1237,8 +1519,7 @@ class Machine:
                 )
             return any(pattern.search(name) for name in names)
 
-        with self.nested("waiting for a window to appear"):
-            retry(window_is_visible, timeout)
+        self.wait("waiting for a window to appear", window_is_visible, timeout)
 
     def sleep(self, secs: int) -> None:
         # We want to sleep in *guest* time, not *host* time.
@@ -1278,6 +1559,7 @@ class Machine:
 
         self.process.terminate()
         self.shell.close()
+        self.pending_output = None
         self.monitor.close()
         self.serial_thread.join()
 
@@ -1301,4 +1583,5 @@ class Machine:
             check_output=False,
         )
         self.connected = False
+        self.pending_output = None
         self.connect()
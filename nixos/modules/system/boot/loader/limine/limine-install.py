@@ -1,23 +1,28 @@
 #!@python3@/bin/python3 -B
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Any, Callable, Dict, List, Optional, Tuple
 
+import argparse
 import datetime
 import hashlib
 import json
 import os
 import psutil
 import re
-import shutil
 import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
+import time
 
 
 limine_dir = None
 can_use_direct_paths = False
+file_copier = None
+dry_run = False
 install_config = json.load(open('@configPath@', 'r'))
 
 
@@ -73,26 +78,130 @@ def is_fs_type_supported(fs_type: str) -> bool:
     return fs_type.startswith('vfat')
 
 
-def get_copied_path_uri(path: str, target: str) -> str:
-    result = ''
+class FileCopier:
+    """Copies files to the boot partition, hashing them while they are copied
+
+    The copies run concurrently in a thread pool. The blake2b hashes and sizes
+    of the copied files are kept in an index on the boot partition, so files
+    that are already in place are neither read nor written again.
+    """
 
+    chunk_size = 1024 * 1024
+
+    def __init__(self, index_path: str, dry_run: bool = False):
+        self.index_path = index_path
+        self.dry_run = dry_run
+        self.index: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(index_path, 'r') as file:
+                self.index = json.load(file)
+        except (OSError, ValueError):
+            pass
+        self.executor = ThreadPoolExecutor()
+        self.lock = threading.Lock()
+        self.copies: Dict[str, Future[str]] = {}
+        self.copied: List[int] = []
+        self.skipped: List[int] = []
+        self.removed: List[str] = []
+        self.copy_time = 0.0
+
+    def copy(self, from_path: str, to_path: str, refresh: bool = False) -> 'Future[str]':
+        """Copy a file unless it is already in place, returning its future hash
+
+        With refresh, the file is copied even if it is in place, and not added
+        to the index, because it is going to be modified.
+        """
+        if to_path not in self.copies:
+            self.copies[to_path] = self.executor.submit(self._copy, from_path, to_path, refresh)
+        return self.copies[to_path]
+
+    def _copy(self, from_path: str, to_path: str, refresh: bool) -> str:
+        with self.lock:
+            entry = self.index.pop(to_path, None)
+        if not refresh and entry is not None and entry['source'] == from_path \
+                and os.path.isfile(to_path) and os.path.getsize(to_path) == entry['size']:
+            with self.lock:
+                self.index[to_path] = entry
+                self.skipped.append(entry['size'])
+            return entry['b2sum']
+
+        start = time.monotonic()
+        b2sum = hashlib.blake2b()
+        size = 0
+        with open(from_path, 'rb') as source:
+            if self.dry_run:
+                while chunk := source.read(self.chunk_size):
+                    b2sum.update(chunk)
+                    size += len(chunk)
+            else:
+                os.makedirs(os.path.dirname(to_path), exist_ok=True)
+                with open(f'{to_path}.tmp', 'wb') as dest:
+                    while chunk := source.read(self.chunk_size):
+                        b2sum.update(chunk)
+                        dest.write(chunk)
+                        size += len(chunk)
+                os.replace(f'{to_path}.tmp', to_path)
+
+        with self.lock:
+            if not refresh:
+                self.index[to_path] = {'source': from_path, 'size': size, 'b2sum': b2sum.hexdigest()}
+            self.copied.append(size)
+            self.copy_time += time.monotonic() - start
+        return b2sum.hexdigest()
+
+    def wait(self) -> None:
+        for future in list(self.copies.values()):
+            future.result()
+
+    def finish(self, managed_dirs: List[str]) -> None:
+        """Wait for all copies and remove the files in managed_dirs not copied by this run"""
+        self.wait()
+        self.executor.shutdown()
+
+        for managed_dir in managed_dirs:
+            if not os.path.isdir(managed_dir):
+                continue
+            for name in os.listdir(managed_dir):
+                path = os.path.join(managed_dir, name)
+                if path not in self.copies and os.path.isfile(path):
+                    self.removed.append(path)
+                    if not self.dry_run:
+                        os.unlink(path)
+
+        self.index = {path: entry for path, entry in self.index.items() if path in self.copies}
+        if not self.dry_run:
+            with open(f'{self.index_path}.tmp', 'w') as file:
+                json.dump(self.index, file, indent=2, sort_keys=True)
+            os.replace(f'{self.index_path}.tmp', self.index_path)
+
+    def report(self) -> str:
+        mib = 1024 * 1024
+        action = ['copied', 'removed'] if not self.dry_run else ['would copy', 'would remove']
+        return (f'{action[0]} {len(self.copied)} files ({sum(self.copied) / mib:.1f} MiB, '
+                f'{self.copy_time:.2f}s of reading and writing), '
+                f'{len(self.skipped)} files ({sum(self.skipped) / mib:.1f} MiB) already in place, '
+                f'{action[1]} {len(self.removed)} stale files')
+
+
+def copy_to_boot(path: str, target: str) -> Tuple[str, 'Future[str]']:
     package_id = os.path.basename(os.path.dirname(path))
     suffix = os.path.basename(path)
     dest_file = f'{package_id}-{suffix}'
     dest_path = os.path.join(limine_dir, target, dest_file)
 
-    if not os.path.exists(dest_path):
-        copy_file(path, dest_path)
+    return dest_file, copy_file(path, dest_path)
+
+
+def get_copied_path_uri(path: str, target: str) -> str:
+    result = ''
+
+    dest_file, b2sum = copy_to_boot(path, target)
 
     path_with_prefix = os.path.join('/limine', target, dest_file)
     result = f'boot():{path_with_prefix}'
 
     if config('validateChecksums'):
-        with open(path, 'rb') as file:
-            b2sum = hashlib.blake2b()
-            b2sum.update(file.read())
-
-            result += f'#{b2sum.hexdigest()}'
+        result += f'#{b2sum.result()}'
 
     return result
 
@@ -155,7 +264,7 @@ def config_entry(levels: int, bootspec: BootSpec, label: str, time: str) -> str:
             print(f'note: if this is an older generation there is nothing to worry about')
 
         if os.path.exists(initrd_secrets_path_temp):
-            copy_file(initrd_secrets_path_temp, initrd_secrets_path)
+            copy_file(initrd_secrets_path_temp, initrd_secrets_path).result()
             os.unlink(initrd_secrets_path_temp)
             entry += 'module_path: ' + get_kernel_uri(initrd_secrets_path) + '\n'
 
@@ -163,10 +272,14 @@ def config_entry(levels: int, bootspec: BootSpec, label: str, time: str) -> str:
     return entry
 
 
+def get_bootspec(profile: str, gen: str) -> BootSpec:
+    boot_json = json.load(open(os.path.join(get_system_path(profile, gen), 'boot.json'), 'r'))
+    return bootjson_to_bootspec(boot_json)
+
+
 def generate_config_entry(profile: str, gen: str) -> str:
     time = datetime.datetime.fromtimestamp(os.stat(get_system_path(profile,gen), follow_symlinks=False).st_mtime).strftime("%F %H:%M:%S")
-    boot_json = json.load(open(os.path.join(get_system_path(profile, gen), 'boot.json'), 'r'))
-    boot_spec = bootjson_to_bootspec(boot_json)
+    boot_spec = get_bootspec(profile, gen)
 
     entry = config_entry(2, boot_spec, f'Generation {gen}', time)
     for spec in boot_spec.specialisations:
@@ -195,13 +308,8 @@ def find_mounted_device(path: str) -> str:
     return devices[0].device
 
 
-def copy_file(from_path: str, to_path: str):
-    dirname = os.path.dirname(to_path)
-
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-
-    shutil.copyfile(from_path, to_path)
+def copy_file(from_path: str, to_path: str, refresh: bool = False) -> 'Future[str]':
+    return file_copier.copy(from_path, to_path, refresh)
 
 def option_from_config(name: str, config_path: List[str], conversion: Callable[[str], str] | None = None) -> str:
     if config(*config_path):
@@ -210,7 +318,14 @@ def option_from_config(name: str, config_path: List[str], conversion: Callable[[
 
 
 def main():
-    global limine_dir
+    global limine_dir, file_copier, dry_run
+
+    parser = argparse.ArgumentParser(description='Install Limine and its NixOS boot entries')
+    parser.add_argument('default_config', nargs='?', help='The default NixOS config to boot (unused)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only report the files that would be copied and removed, and how long reading them takes')
+    args = parser.parse_args()
+    dry_run = args.dry_run
 
     boot_fs = None
 
@@ -241,20 +356,27 @@ def main():
             partition formatted as FAT.
         '''))
 
-    if not os.path.exists(limine_dir):
+    if not os.path.exists(limine_dir) and not dry_run:
         os.makedirs(limine_dir)
 
-    if os.path.exists(os.path.join(limine_dir, 'kernels')):
-        print(f'nuking {os.path.join(limine_dir, "kernels")}')
-        shutil.rmtree(os.path.join(limine_dir, 'kernels'))
-
-    os.makedirs(os.path.join(limine_dir, "kernels"))
+    # Files in kernels and wallpapers that are not copied by this run are
+    # removed at the end, instead of copying everything again.
+    file_copier = FileCopier(os.path.join(limine_dir, 'nixos-files.json'), dry_run)
 
     profiles = [('system', get_gens())]
 
     for profile in get_profiles():
         profiles += (profile, get_gens(profile))
 
+    # Start copying the kernels and initrds of all generations, so that they
+    # are copied concurrently while the entries referring to them are written.
+    for (profile, gens) in profiles:
+        for gen in gens:
+            boot_spec = get_bootspec(profile, gen)
+            copy_to_boot(boot_spec.kernel, 'kernels')
+            if boot_spec.initrd:
+                copy_to_boot(boot_spec.initrd, 'kernels')
+
     timeout = config('timeout')
     editor_enabled = 'yes' if config('enableEditor') else 'no'
     hash_mismatch_panic = 'yes' if config('panicOnChecksumMismatch') else 'no'
@@ -268,13 +390,6 @@ def main():
         default_entry: 2
     ''')
 
-    if os.path.exists(os.path.join(limine_dir, 'wallpapers')):
-        print(f'nuking {os.path.join(limine_dir, "wallpapers")}')
-        shutil.rmtree(os.path.join(limine_dir, 'wallpapers'))
-
-    if len(config('style', 'wallpapers')) > 0:
-        os.makedirs(os.path.join(limine_dir, 'wallpapers'))
-
     for wallpaper in config('style', 'wallpapers'):
         config_file += f'''wallpaper: {get_copied_path_uri(wallpaper, 'wallpapers')}\n'''
 
@@ -312,15 +427,27 @@ def main():
 
     config_file += config('extraEntries')
 
-    with open(config_file_path, 'w') as file:
-        file.truncate()
-        file.write(config_file.strip())
-
     for dest_path, source_path in config('additionalFiles').items():
         dest_path = os.path.join(limine_dir, dest_path)
 
         copy_file(source_path, dest_path)
 
+    # Only refer to the copied files once they are all complete
+    file_copier.wait()
+
+    if not dry_run:
+        with open(config_file_path, 'w') as file:
+            file.truncate()
+            file.write(config_file.strip())
+
+    install_bootloader(config_file)
+
+    file_copier.finish([os.path.join(limine_dir, 'kernels'), os.path.join(limine_dir, 'wallpapers')])
+    print(file_copier.report(), file=sys.stderr if not dry_run else sys.stdout)
+
+
+def install_bootloader(config_file: str) -> None:
+
     limine_binary = os.path.join(config('liminePath'), 'bin', 'limine')
     cpu_family = config('hostArchitecture', 'family')
     if config('efiSupport'):
@@ -340,9 +467,12 @@ def main():
         efi_path = os.path.join(config('liminePath'), 'share', 'limine', boot_file)
         dest_path = os.path.join(config('efiMountPoint'), 'efi', 'boot' if config('efiRemovable') else 'limine', boot_file)
 
-        copy_file(efi_path, dest_path)
+        # enroll-config modifies the copy, so it has to be a fresh one
+        copy_file(efi_path, dest_path, refresh=config('enrollConfig')).result()
 
-        if config('enrollConfig'):
+        if dry_run:
+            print(f'dry run: not installing {dest_path}')
+        elif config('enrollConfig'):
             b2sum = hashlib.blake2b()
             b2sum.update(config_file.strip().encode())
             try:
@@ -354,7 +484,7 @@ def main():
         if not config('efiRemovable') and not config('canTouchEfiVariables'):
             print('warning: boot.loader.efi.canTouchEfiVariables is set to false while boot.loader.limine.efiInstallAsRemovable.\n  This may render the system unbootable.')
 
-        if config('canTouchEfiVariables'):
+        if config('canTouchEfiVariables') and not dry_run:
             if config('efiRemovable'):
                 print('note: boot.loader.limine.efiInstallAsRemovable is true, no need to add EFI entry.')
             else:
@@ -384,11 +514,14 @@ def main():
         limine_sys = os.path.join(config('liminePath'), 'share', 'limine', 'limine-bios.sys')
         limine_sys_dest = os.path.join(limine_dir, 'limine-bios.sys')
 
-        copy_file(limine_sys, limine_sys_dest)
+        copy_file(limine_sys, limine_sys_dest).result()
 
         device = config('biosDevice')
 
-        if device == 'nodev':
+        if dry_run:
+            print(f'dry run: not installing Limine on {device}')
+            return
+        elif device == 'nodev':
             print("note: boot.loader.limine.biosSupport is set, but device is set to nodev, only the stage 2 bootloader will be installed.", file=sys.stderr)
             return
         else:
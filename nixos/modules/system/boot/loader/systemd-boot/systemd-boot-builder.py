@@ -3,7 +3,9 @@ import argparse
 import ctypes
 import datetime
 import errno
+import functools
 import glob
+import hashlib
 import os
 import os.path
 import re
@@ -25,7 +27,6 @@ EDITOR = "@editor@" == "1" # noqa: PLR0133
 CONSOLE_MODE = "@consoleMode@"
 BOOTSPEC_TOOLS = "@bootspecTools@"
 DISTRO_NAME = "@distroName@"
-NIX = "@nix@"
 SYSTEMD = "@systemd@"
 CONFIGURATION_LIMIT = int("@configurationLimit@")
 REBOOT_FOR_BITLOCKER = bool("@rebootForBitlocker@")
@@ -34,6 +35,8 @@ GRACEFUL = "@graceful@"
 COPY_EXTRA_FILES = "@copyExtraFiles@"
 CHECK_MOUNTPOINTS = "@checkMountpoints@"
 STORE_DIR = "@storeDir@"
+# Records what the builder put on the ESP, see EspManifest
+MANIFEST_FILE = f"{BOOT_MOUNT_POINT}{NIXOS_DIR}/.manifest.json"
 
 @dataclass
 class BootSpec:
@@ -63,9 +66,57 @@ class SystemIdentifier(NamedTuple):
     specialisation: str | None
 
 
-def copy_if_not_exists(source: str, dest: str) -> None:
-    if not os.path.exists(dest):
-        shutil.copyfile(source, dest)
+@dataclass
+class EspManifest:
+    """The files and boot entries the builder has completely written to the ESP
+
+    Kernels, initrds and entries recorded in here, and still present, don't
+    have to be written again, which is slow on the flash of many ESPs.
+    """
+    # Path on the ESP -> store path it was copied from
+    files: dict[str, str]
+    # Boot entry file name -> SHA-256 of its content
+    entries: dict[str, str]
+    # Files copied during this run that must not be copied again
+    refreshed: set[str]
+
+    @classmethod
+    def load(cls) -> "EspManifest":
+        try:
+            with open(MANIFEST_FILE) as f:
+                manifest = json.load(f)
+            return cls(files=dict(manifest["files"]), entries=dict(manifest["entries"]), refreshed=set())
+        except (OSError, ValueError, KeyError, TypeError):
+            # A missing or broken manifest only means everything is written again
+            return cls(files={}, entries={}, refreshed=set())
+
+    def save(self) -> None:
+        with open(f"{MANIFEST_FILE}.tmp", 'w') as f:
+            json.dump({"files": self.files, "entries": self.entries}, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(f"{MANIFEST_FILE}.tmp", MANIFEST_FILE)
+
+    def copy_file(self, source: str, dest: str, refresh: bool = False) -> None:
+        """Copy a store file to the path dest on the ESP, unless it is already there
+
+        With refresh, the file is copied anyway, once per run, because it is
+        modified after being copied. It isn't recorded then, so it is copied
+        again by the next run too.
+        """
+        if dest in self.refreshed:
+            return
+        if not refresh and self.files.get(dest) == source and os.path.exists(f"{BOOT_MOUNT_POINT}{dest}"):
+            return
+        # Copy to a temporary file first, so that a file interrupted while
+        # being copied is never mistaken for a complete one
+        shutil.copyfile(source, f"{BOOT_MOUNT_POINT}{dest}.tmp")
+        os.rename(f"{BOOT_MOUNT_POINT}{dest}.tmp", f"{BOOT_MOUNT_POINT}{dest}")
+        if refresh:
+            self.files.pop(dest, None)
+            self.refreshed.add(dest)
+        else:
+            self.files[dest] = source
 
 
 def generation_dir(profile: str | None, generation: int) -> str:
@@ -114,6 +165,7 @@ def write_loader_conf(profile: str | None, generation: int, specialisation: str
     os.rename(f"{LOADER_CONF}.tmp", LOADER_CONF)
 
 
+@functools.cache
 def get_bootspec(profile: str | None, generation: int) -> BootSpec:
     system_directory = system_dir(profile, generation, None)
     boot_json_path = os.path.realpath("%s/%s" % (system_directory, "boot.json"))
@@ -148,23 +200,25 @@ def bootspec_from_json(bootspec_json: dict[str, Any]) -> BootSpec:
     )
 
 
-def copy_from_file(file: str, dry_run: bool = False) -> str:
+def copy_from_file(file: str, manifest: EspManifest | None = None, refresh: bool = False) -> str:
     store_file_path = os.path.realpath(file)
     suffix = os.path.basename(store_file_path)
     store_subdir = os.path.relpath(store_file_path, start=STORE_DIR).split(os.path.sep)[0]
     efi_file_path = f"{NIXOS_DIR}/{suffix}.efi" if suffix == store_subdir else f"{NIXOS_DIR}/{store_subdir}-{suffix}.efi"
-    if not dry_run:
-        copy_if_not_exists(store_file_path, f"{BOOT_MOUNT_POINT}{efi_file_path}")
+    if manifest is not None:
+        manifest.copy_file(store_file_path, efi_file_path, refresh)
     return efi_file_path
 
 
 def write_entry(profile: str | None, generation: int, specialisation: str | None,
-                machine_id: str | None, bootspec: BootSpec, current: bool) -> None:
+                machine_id: str | None, bootspec: BootSpec, current: bool, manifest: EspManifest) -> None:
     if specialisation:
         bootspec = bootspec.specialisations[specialisation]
-    kernel = copy_from_file(bootspec.kernel)
-    initrd = copy_from_file(bootspec.initrd)
-    devicetree = copy_from_file(bootspec.devicetree) if bootspec.devicetree is not None else None
+    kernel = copy_from_file(bootspec.kernel, manifest)
+    # The initrd secrets are appended to the copy of the initrd, so it has to
+    # be a fresh one.
+    initrd = copy_from_file(bootspec.initrd, manifest, refresh=bootspec.initrdSecrets is not None)
+    devicetree = copy_from_file(bootspec.devicetree, manifest) if bootspec.devicetree is not None else None
 
     title = "{name}{profile}{specialisation}".format(
         name=DISTRO_NAME,
@@ -183,8 +237,8 @@ def write_entry(profile: str | None, generation: int, specialisation: str | None
                   f'for "{title} - Configuration {generation}", an older generation', file=sys.stderr)
             print("note: this is normal after having removed "
                   "or renamed a file in `boot.initrd.secrets`", file=sys.stderr)
-    entry_file = f"{BOOT_MOUNT_POINT}/loader/entries/%s" % (
-        generation_conf_filename(profile, generation, specialisation))
+    entry_name = generation_conf_filename(profile, generation, specialisation)
+    entry_file = f"{BOOT_MOUNT_POINT}/loader/entries/%s" % (entry_name)
     tmp_path = "%s.tmp" % (entry_file)
     kernel_params = "init=%s " % bootspec.init
 
@@ -192,57 +246,67 @@ def write_entry(profile: str | None, generation: int, specialisation: str | None
     build_time = int(os.path.getctime(system_dir(profile, generation, specialisation)))
     build_date = datetime.datetime.fromtimestamp(build_time).strftime('%F')
 
+    entry = BOOT_ENTRY.format(title=title,
+                sort_key=bootspec.sortKey,
+                generation=generation,
+                kernel=kernel,
+                initrd=initrd,
+                kernel_params=kernel_params,
+                description=f"{bootspec.label}, built on {build_date}")
+    if machine_id is not None:
+        entry += "machine-id %s\n" % machine_id
+    if devicetree is not None:
+        entry += "devicetree %s\n" % devicetree
+
+    entry_hash = hashlib.sha256(entry.encode()).hexdigest()
+    if manifest.entries.get(entry_name) == entry_hash and os.path.exists(entry_file):
+        return
+
     with open(tmp_path, 'w') as f:
-        f.write(BOOT_ENTRY.format(title=title,
-                    sort_key=bootspec.sortKey,
-                    generation=generation,
-                    kernel=kernel,
-                    initrd=initrd,
-                    kernel_params=kernel_params,
-                    description=f"{bootspec.label}, built on {build_date}"))
-        if machine_id is not None:
-            f.write("machine-id %s\n" % machine_id)
-        if devicetree is not None:
-            f.write("devicetree %s\n" % devicetree)
+        f.write(entry)
         f.flush()
         os.fsync(f.fileno())
     os.rename(tmp_path, entry_file)
+    manifest.entries[entry_name] = entry_hash
 
 
 def get_generations(profile: str | None = None) -> list[SystemIdentifier]:
-    gen_list = run(
-        [
-            f"{NIX}/bin/nix-env",
-            "--list-generations",
-            "-p",
-            "/nix/var/nix/profiles/%s"
-            % ("system-profiles/" + profile if profile else "system"),
-        ],
-        stdout=subprocess.PIPE,
-    ).stdout
-    gen_lines = gen_list.split("\n")
-    gen_lines.pop()
+    # The generations of a profile are the <profile>-<number>-link symlinks
+    # next to it, which is also where `nix-env --list-generations` finds them.
+    if profile:
+        profiles_dir, name = "/nix/var/nix/profiles/system-profiles", profile
+    else:
+        profiles_dir, name = "/nix/var/nix/profiles", "system"
+    rex_link = re.compile(r"^" + re.escape(name) + r"-([0-9]+)-link$")
+    generations = sorted(
+        int(match.group(1))
+        for link in os.listdir(profiles_dir)
+        if (match := rex_link.match(link))
+    )
 
     configurationLimit = CONFIGURATION_LIMIT
     configurations = [
         SystemIdentifier(
             profile=profile,
-            generation=int(line.split()[0]),
+            generation=generation,
             specialisation=None
         )
-        for line in gen_lines
+        for generation in generations
     ]
     return configurations[-configurationLimit:]
 
 
-def remove_old_entries(gens: list[SystemIdentifier]) -> None:
+def remove_old_entries(gens: list[SystemIdentifier], manifest: EspManifest) -> None:
     rex_profile = re.compile(r"^" + re.escape(BOOT_MOUNT_POINT) + r"/loader/entries/nixos-(.*)-generation-.*\.conf$")
     rex_generation = re.compile(r"^" + re.escape(BOOT_MOUNT_POINT) + r"/loader/entries/nixos.*-generation-([0-9]+)(-specialisation-.*)?\.conf$")
-    known_paths = []
+    known_paths = set()
     for gen in gens:
         bootspec = get_bootspec(gen.profile, gen.generation)
-        known_paths.append(copy_from_file(bootspec.kernel, True))
-        known_paths.append(copy_from_file(bootspec.initrd, True))
+        for spec in [bootspec, *bootspec.specialisations.values()]:
+            known_paths.add(copy_from_file(spec.kernel))
+            known_paths.add(copy_from_file(spec.initrd))
+            if spec.devicetree is not None:
+                known_paths.add(copy_from_file(spec.devicetree))
     for path in glob.iglob(f"{BOOT_MOUNT_POINT}/loader/entries/nixos*-generation-[1-9]*.conf"):
         if rex_profile.match(path):
             prof = rex_profile.sub(r"\1", path)
@@ -254,9 +318,12 @@ def remove_old_entries(gens: list[SystemIdentifier]) -> None:
             continue
         if (prof, gen_number, None) not in gens:
             os.unlink(path)
-    for path in glob.iglob(f"{BOOT_MOUNT_POINT}/{NIXOS_DIR}/*"):
-        if path not in known_paths and not os.path.isdir(path):
+            manifest.entries.pop(os.path.basename(path), None)
+    for path in glob.iglob(f"{BOOT_MOUNT_POINT}{NIXOS_DIR}/*"):
+        efi_file_path = f"{NIXOS_DIR}/{os.path.basename(path)}"
+        if efi_file_path not in known_paths and not os.path.isdir(path):
             os.unlink(path)
+            manifest.files.pop(efi_file_path, None)
 
 
 def cleanup_esp() -> None:
@@ -358,15 +425,16 @@ def install_bootloader(args: argparse.Namespace) -> None:
     for profile in get_profiles():
         gens += get_generations(profile)
 
-    remove_old_entries(gens)
+    manifest = EspManifest.load()
+    remove_old_entries(gens, manifest)
 
     for gen in gens:
         try:
             bootspec = get_bootspec(gen.profile, gen.generation)
             is_default = os.path.dirname(bootspec.init) == args.default_config
-            write_entry(*gen, machine_id, bootspec, current=is_default)
+            write_entry(*gen, machine_id, bootspec, current=is_default, manifest=manifest)
             for specialisation in bootspec.specialisations.keys():
-                write_entry(gen.profile, gen.generation, specialisation, machine_id, bootspec, current=is_default)
+                write_entry(gen.profile, gen.generation, specialisation, machine_id, bootspec, current=is_default, manifest=manifest)
             if is_default:
                 write_loader_conf(*gen)
         except OSError as e:
@@ -377,6 +445,8 @@ def install_bootloader(args: argparse.Namespace) -> None:
             else:
                 raise e
 
+    manifest.save()
+
     if BOOT_MOUNT_POINT != EFI_SYS_MOUNT_POINT:
         # Cleanup any entries in ESP if xbootldrMountPoint is set.
         # If the user later unsets xbootldrMountPoint, entries in XBOOTLDR will not be cleaned up
@@ -49,8 +49,6 @@ let
 
       bootspecTools = pkgs.bootspec;
 
-      nix = config.nix.package.out;
-
       timeout = if config.boot.loader.timeout == null then "menu-force" else config.boot.loader.timeout;
 
       configurationLimit = if cfg.configurationLimit == null then 0 else cfg.configurationLimit;
@@ -10,16 +10,27 @@ Ensure to check the file with the check script when you make changes to it:
 ./check-build-composefs-dump.sh ./build-composefs_dump.py
 """
 
+import argparse
 import glob
+import hashlib
 import json
 import os
+import struct
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
-from typing import Any
+from typing import IO, Any
 
 Attrs = dict[str, Any]
 
+# Parameters of the Merkle tree of the fs-verity digests, which have to match
+# the ones composefs enables fs-verity with
+FSVERITY_BLOCK_SIZE = 4096
+FSVERITY_LOG_BLOCK_SIZE = 12
+FSVERITY_HASH_ALG_SHA256 = 1
+FSVERITY_READ_SIZE = 256 * FSVERITY_BLOCK_SIZE
+
 
 class FileType(Enum):
     """The filetype as defined by the `st_mode` stat field in octal
@@ -83,6 +94,91 @@ class ComposefsPath:
         return " ".join(line_list)
 
 
+def fsverity_tree_level(hashes: list[bytes]) -> list[bytes]:
+    """Hash the next level of a fs-verity Merkle tree
+
+    The hashes of a level are packed into blocks, the last one zero-padded,
+    and every block is hashed again.
+    """
+    per_block = FSVERITY_BLOCK_SIZE // hashlib.sha256().digest_size
+    return [
+        hashlib.sha256(
+            b"".join(hashes[i : i + per_block]).ljust(FSVERITY_BLOCK_SIZE, b"\0")
+        ).digest()
+        for i in range(0, len(hashes), per_block)
+    ]
+
+
+def fsverity_digest(path: str) -> str:
+    """Compute the fs-verity SHA-256 digest of a file
+
+    This is the digest `fsverity digest` prints, and which the kernel checks
+    the content of a file against when it is accessed through composefs. See
+    https://docs.kernel.org/filesystems/fsverity.html#fs-verity-descriptor
+    """
+    size = 0
+    hashes = []
+    with open(path, "rb") as f:
+        while data := f.read(FSVERITY_READ_SIZE):
+            size += len(data)
+            view = memoryview(data)
+            for i in range(0, len(data), FSVERITY_BLOCK_SIZE):
+                block = view[i : i + FSVERITY_BLOCK_SIZE]
+                if len(block) < FSVERITY_BLOCK_SIZE:
+                    block = memoryview(bytes(block).ljust(FSVERITY_BLOCK_SIZE, b"\0"))
+                hashes.append(hashlib.sha256(block).digest())
+
+    # The root hash of an empty file is all zeros, the one of a file with a
+    # single block is the hash of that block.
+    root_hash = b""
+    if hashes:
+        while len(hashes) > 1:
+            hashes = fsverity_tree_level(hashes)
+        root_hash = hashes[0]
+
+    descriptor = struct.pack(
+        "<BBBBIQ64s32s144x",
+        1,  # version
+        FSVERITY_HASH_ALG_SHA256,
+        FSVERITY_LOG_BLOCK_SIZE,
+        0,  # salt size
+        0,  # signature size
+        size,
+        root_hash,
+        b"",  # salt
+    )
+    return hashlib.sha256(descriptor).hexdigest()
+
+
+def write_dump(
+    paths: dict[str, ComposefsPath],
+    sources: dict[str, str],
+    out: IO[str],
+    jobs: int | None = None,
+    verbose: bool = False,
+) -> None:
+    """Write the composefs dump of paths to out, sorted by path
+
+    The fs-verity digests of the regular files, whose content is read from
+    their path in `sources`, are computed in a thread pool while the lines are
+    written.
+    """
+    out.write("/ 4096 40755 1 0 0 0 0.0 - - -\n")  # Root directory
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        digests: dict[str, Future[str]] = {
+            key: executor.submit(fsverity_digest, source)
+            for key, source in sources.items()
+        }
+        for key in sorted(paths):
+            composefs_path = paths[key]
+            if verbose:
+                eprint(composefs_path.path)
+            if key in digests:
+                composefs_path.digest = digests.pop(key).result()
+            out.write(composefs_path.write_line())
+            out.write("\n")
+
+
 def eprint(*args: Any, **kwargs: Any) -> None:
     print(*args, **kwargs, file=sys.stderr)
 
@@ -133,12 +229,22 @@ def main() -> None:
     This config describes the files that the final composefs image is supposed
     to contain.
     """
-    config_file = sys.argv[1]
-    if not config_file:
-        eprint("No config file was supplied.")
-        sys.exit(1)
-
-    with open(config_file, "rb") as f:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("config_file", help="Json config describing the files")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of threads computing fs-verity digests, 0 for the default",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="print every path added to the dump to stderr",
+    )
+    args = parser.parse_args()
+
+    with open(args.config_file, "rb") as f:
         config = json.load(f)
 
     if not config:
@@ -148,6 +254,8 @@ def main() -> None:
     eprint("Building composefs dump...")
 
     paths: dict[str, ComposefsPath] = {}
+    # Sources of the regular files, whose fs-verity digests are needed
+    sources: dict[str, str] = {}
     for attrs in config:
         # Normalize the target path to work around issues in how targets are
         # declared in `environment.etc`.
@@ -166,7 +274,7 @@ def main() -> None:
                 composefs_path = ComposefsPath(
                     attrs,
                     path=glob_target,
-                    size=100,
+                    size=len(os.fsencode(glob_source)),
                     filetype=FileType.symlink,
                     mode="0777",
                     payload=glob_source,
@@ -178,8 +286,8 @@ def main() -> None:
             if mode == "symlink" or mode == "direct-symlink":
                 composefs_path = ComposefsPath(
                     attrs,
-                    # A high approximation of the size of a symlink
-                    size=100,
+                    # The size of a symlink is the length of its target
+                    size=len(os.fsencode(source)),
                     filetype=FileType.symlink,
                     mode="0777",
                     payload=source,
@@ -201,16 +309,17 @@ def main() -> None:
                     # payload needs to be relative path in this case
                     payload=target.lstrip("/"),
                 )
+                sources[target] = source
             paths[target] = composefs_path
             add_leading_directories(target, attrs, paths)
 
-    composefs_dump = ["/ 4096 40755 1 0 0 0 0.0 - - -"]  # Root directory
-    for key in sorted(paths):
-        composefs_path = paths[key]
-        eprint(composefs_path.path)
-        composefs_dump.append(composefs_path.write_line())
-
-    print("\n".join(composefs_dump))
+    # Only keep the sources of targets that ended up being regular files
+    sources = {
+        target: source
+        for target, source in sources.items()
+        if paths[target].filetype == FileType.file
+    }
+    write_dump(paths, sources, sys.stdout, jobs=args.jobs or None, verbose=args.verbose)
 
 
 if __name__ == "__main__":
@@ -393,7 +393,7 @@ in
       let
         etcJson = pkgs.writeText "etc-json" (builtins.toJSON etc');
         etcDump = pkgs.runCommand "etc-dump" { } ''
-          ${lib.getExe pkgs.buildPackages.python3} ${./build-composefs-dump.py} ${etcJson} > $out
+          ${lib.getExe pkgs.buildPackages.python3} ${./build-composefs-dump.py} --jobs "$NIX_BUILD_CORES" ${etcJson} > $out
         '';
       in
       pkgs.runCommand "etc-metadata.erofs"
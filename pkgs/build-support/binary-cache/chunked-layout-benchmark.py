@@ -0,0 +1,144 @@
+# Benchmark the chunked layout of make-binary-cache.py against the nar
+# layout, on a generated set of similar trees: a random base tree, and copies
+# of it that each differ by a few small inserts, like successive versions of
+# a package do.
+#
+# Run with:
+#
+#   python chunked-layout-benchmark.py
+#
+# This needs nix-store (to dump the trees, which don't have to be in the
+# store) and numpy in the environment.
+
+import argparse
+import json
+import os
+from pathlib import Path
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+script = Path(__file__).parent / "make-binary-cache.py"
+
+
+def makeTrees(storeDir, count, size, files, inserts, seed=0):
+    """
+    Create `count` trees of `files` files with `size` bytes in total below
+    `storeDir`, the first one random and every other one a copy of it with
+    `inserts` inserts of up to 64 random bytes at random places.
+
+    Returns the paths of the trees.
+    """
+    rng = random.Random(seed)
+    base = [rng.randbytes(size // files) for _ in range(files)]
+    paths = []
+    for index in range(count):
+        contents = list(base)
+        for _ in range(inserts if index > 0 else 0):
+            file = rng.randrange(files)
+            offset = rng.randrange(len(contents[file]))
+            insert = rng.randbytes(rng.randint(1, 64))
+            contents[file] = (
+                contents[file][:offset] + insert + contents[file][offset:]
+            )
+        path = storeDir / f"{rng.getrandbits(128):032x}-tree-{index}"
+        os.makedirs(path / "share")
+        for file, content in enumerate(contents):
+            (path / "share" / f"file-{file}").write_bytes(content)
+        paths.append(path)
+    return paths
+
+
+def makeBinaryCache(storeDir, attrsFile, outDir, layout, compression, jobs):
+    """
+    Run make-binary-cache.py with the given layout.
+
+    Returns its output, the time it took and the bytes written below `outDir`.
+    """
+    env = dict(os.environ, NIX_STORE=str(storeDir), NIX_ATTRS_JSON_FILE=str(attrsFile))
+    start = time.monotonic()
+    output = subprocess.run(
+        [
+            sys.executable,
+            script,
+            "--out-dir",
+            outDir,
+            "--layout",
+            layout,
+            "--compression",
+            compression,
+            "--jobs",
+            str(jobs),
+        ],
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+    ).stdout
+    duration = time.monotonic() - start
+    size = sum(
+        path.stat().st_size for path in Path(outDir).rglob("*") if path.is_file()
+    )
+    return output, duration, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trees", type=int, default=10)
+    parser.add_argument("--size", type=int, default=2 * 1024 * 1024)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--inserts", type=int, default=5)
+    parser.add_argument(
+        "--compression",
+        choices=["none", "xz", "zstd"],
+        default="none",
+        help="compression of the nar layout, the chunked one is uncompressed",
+    )
+    parser.add_argument("--jobs", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        storeDir = workdir / "store"
+        paths = makeTrees(storeDir, args.trees, args.size, args.files, args.inserts)
+
+        attrsFile = workdir / "attrs.json"
+        with open(attrsFile, "w") as f:
+            # Only copied into the narinfo files, so they don't have to be real.
+            json.dump(
+                {
+                    "closure": [
+                        {
+                            "path": str(path),
+                            "narHash": "sha256:" + "0" * 52,
+                            "narSize": 0,
+                            "references": [],
+                        }
+                        for path in paths
+                    ]
+                },
+                f,
+            )
+
+        _, narTime, narBytes = makeBinaryCache(
+            storeDir, attrsFile, workdir / "nar", "nar", args.compression, args.jobs
+        )
+        output, chunkedTime, chunkedBytes = makeBinaryCache(
+            storeDir, attrsFile, workdir / "chunked", "chunked", "none", args.jobs
+        )
+
+    match = re.search(r"dedup ratio ([0-9.]+)", output)
+    if match is None:
+        raise SystemExit(f"no dedup ratio in the output:\n{output}")
+
+    print(f"{'layout':>8} {'bytes':>12} {'time':>8}")
+    print(f"{'nar':>8} {narBytes:>12} {narTime:>7.2f}s")
+    print(f"{'chunked':>8} {chunkedBytes:>12} {chunkedTime:>7.2f}s")
+    print(f"Dedup ratio of the chunked layout: {match.group(1)}")
+
+
+if __name__ == "__main__":
+    main()
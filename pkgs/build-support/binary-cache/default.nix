@@ -18,6 +18,8 @@
 {
   name ? "binary-cache",
   compression ? "zstd", # one of ["none" "xz" "zstd"]
+  compressionLevel ? null, # passed to the compressor, e.g. 19 for zstd
+  layout ? "nar", # one of ["nar" "chunked"]
   rootPaths,
 }:
 
@@ -27,6 +29,21 @@ assert lib.elem compression [
   "zstd"
 ];
 
+assert lib.elem layout [
+  "nar"
+  "chunked"
+];
+
+let
+  src = lib.fileset.toSource {
+    root = ./.;
+    fileset = lib.fileset.unions [
+      ./make-binary-cache.py
+      ./nixbase32.py
+    ];
+  };
+in
+
 stdenv.mkDerivation {
   inherit name;
 
@@ -40,7 +57,8 @@ stdenv.mkDerivation {
     [
       coreutils
       jq
-      python3
+      # numpy finds the chunk boundaries of the chunked layout
+      (if layout == "chunked" then python3.withPackages (ps: [ ps.numpy ]) else python3)
       nix
     ]
     ++ lib.optional (compression == "xz") xz
@@ -49,7 +67,9 @@ stdenv.mkDerivation {
   buildCommand = ''
     mkdir -p $out/nar
 
-    python ${./make-binary-cache.py} --compression "${compression}"
+    python ${src}/make-binary-cache.py --compression "${compression}" --layout "${layout}" ${
+      lib.optionalString (compressionLevel != null) "--compression-level ${toString compressionLevel}"
+    }
 
     # These directories must exist, or Nix might try to create them in LocalBinaryCacheStore::init(),
     # which fails if mounted read-only
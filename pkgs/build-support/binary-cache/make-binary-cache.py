@@ -1,45 +1,290 @@
 import argparse
 from functools import partial
+import hashlib
 import json
 from multiprocessing import Pool
 import os
 from pathlib import Path
 import subprocess
+import tempfile
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from nixbase32 import toNixBase32
+
+chunkSize = 1024 * 1024
+
+# Bytes the gear hashes are calculated for at once, see findCandidates
+gearBlockSize = 64 * 1024
+
+# Random but fixed 64-bit values for the gear hash of the content-defined
+# chunking, one for every byte value.
+gearTable = [
+    int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "little")
+    for i in range(256)
+]
+gearArray = None if numpy is None else numpy.array(gearTable, dtype=numpy.uint64)
 
 
 def dropPrefix(path, nixPrefix):
     return path[len(nixPrefix + "/") :]
 
 
+def compressionCommand(compression, compressionLevel):
+    level = [] if compressionLevel is None else [f"-{compressionLevel}"]
+    return {
+        "none": None,
+        "xz": ["xz", "-c", *level],
+        "zstd": ["zstd", "-c", *level],
+    }[compression]
+
+
+def dumpCompressed(storePath, command, out):
+    """
+    Write the NAR of `storePath`, piped through `command` if any, to `out`.
+
+    The written stream is hashed on the way, so the compressed NAR doesn't have
+    to be read again afterwards.
+
+    Returns the sha256 digest and the size of the written stream.
+    """
+    dump = subprocess.Popen(["nix-store", "--dump", storePath], stdout=subprocess.PIPE)
+    processes = [dump]
+    source = dump.stdout
+    if command is not None:
+        compressor = subprocess.Popen(
+            command, stdin=dump.stdout, stdout=subprocess.PIPE
+        )
+        # Only the compressor should hold the read end of the pipe, so that
+        # nix-store gets SIGPIPE if it exits early.
+        dump.stdout.close()
+        processes.append(compressor)
+        source = compressor.stdout
+
+    fileHash = hashlib.sha256()
+    fileSize = 0
+    with source:
+        while chunk := source.read(chunkSize):
+            fileHash.update(chunk)
+            out.write(chunk)
+            fileSize += len(chunk)
+
+    for process in processes:
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    return fileHash.digest(), fileSize
+
+
+def gearHashes(data):
+    """
+    Return the gear hash at every position of `data`, as a numpy array.
+
+    The hash is shifted left by one bit for every byte, so it only depends on
+    the last 64 of them. Instead of rolling it over `data` byte by byte, the
+    hashes of windows of 1, 2, 4, ..., 64 bytes are combined from the ones of
+    half the size, which are all calculated at once. The windows at the start
+    of `data` are shorter, as if the hash started from zero there.
+    """
+    hashes = gearArray[numpy.frombuffer(data, dtype=numpy.uint8)]
+    shifted = numpy.empty_like(hashes)
+    width = 1
+    while width < 64:
+        numpy.left_shift(hashes[:-width], numpy.uint64(width), out=shifted[:-width])
+        numpy.add(hashes[width:], shifted[:-width], out=hashes[width:])
+        width *= 2
+    return hashes
+
+
+def findCandidates(data, mask):
+    """
+    Return the sorted positions in `data` at which the gear hash has all the
+    bits of `mask`, its upper ones, zero.
+
+    The hashes are calculated for blocks of `gearBlockSize` bytes, which is
+    faster than for all of `data` at once as they stay in the CPU cache. Every
+    block also covers the 63 bytes before it, so the hashes are the same.
+    """
+    limit = numpy.uint64(1 << (64 - mask.bit_count()))
+    candidates = []
+    for start in range(0, len(data), gearBlockSize):
+        windowStart = max(0, start - 63)
+        hashes = gearHashes(data[windowStart : start + gearBlockSize])
+        (positions,) = numpy.nonzero(hashes[start - windowStart :] < limit)
+        candidates.append(positions + start)
+    return numpy.concatenate(candidates) if candidates else numpy.array([], int)
+
+
+def findChunkBoundary(data, start, minSize, maxSize, mask, candidates):
+    """
+    Return the length of the content-defined chunk at `start` of `data`.
+
+    This is a gear hash rolling over the bytes after the first `minSize` ones,
+    cutting as soon as the bits of `mask` are all zero, and at `maxSize` bytes
+    at the latest. `candidates` are the sorted positions at which the gear
+    hashes of `data` have these bits zero.
+    """
+    rollStart = start + minSize
+    end = min(len(data), start + maxSize)
+    # The hash only covers the bytes since `rollStart` for its first 63 ones,
+    # from then on it is the one of `gearHashes`.
+    h = 0
+    for i in range(rollStart, min(rollStart + 63, end)):
+        h = ((h << 1) + gearTable[data[i]]) & 0xFFFFFFFFFFFFFFFF
+        if not h & mask:
+            return i + 1 - start
+    i = numpy.searchsorted(candidates, rollStart + 63)
+    if i < len(candidates) and candidates[i] < end:
+        return int(candidates[i]) + 1 - start
+    return end - start
+
+
+def splitChunks(source, avgSize):
+    """
+    Split the stream `source` into content-defined chunks of about `avgSize`
+    bytes, which must be a power of two. Identical content yields identical
+    chunks even when it is shifted around in the stream.
+    """
+    minSize = avgSize // 4
+    maxSize = avgSize * 4
+    # The lower bits of the gear hash only depend on the last few bytes, so
+    # the boundary is decided by the upper ones.
+    bits = avgSize.bit_length() - 1
+    mask = ((1 << bits) - 1) << (64 - bits)
+    # Bytes of the stream to find the chunks in at once
+    blockSize = max(4 * 1024 * 1024, 2 * maxSize)
+
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < blockSize:
+            data = source.read(blockSize - len(buffer))
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+        candidates = findCandidates(buffer, mask)
+
+        # Chunks are only cut where there are `maxSize` bytes left, so that
+        # they don't depend on how the stream was read.
+        start = 0
+        while len(buffer) - start >= maxSize or (eof and start < len(buffer)):
+            if eof and len(buffer) - start <= minSize:
+                cut = len(buffer) - start
+            else:
+                cut = findChunkBoundary(
+                    buffer, start, minSize, maxSize, mask, candidates
+                )
+            yield bytes(buffer[start : start + cut])
+            start += cut
+        del buffer[:start]
+
+
+def chunkPath(outDir, chunkHash):
+    return outDir / "chunks" / chunkHash[:2] / chunkHash
+
+
+def writeChunk(outDir, chunkHash, chunk):
+    path = chunkPath(outDir, chunkHash)
+    if path.exists():
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Other workers may write the same chunk at the same time, which is fine as
+    # long as nobody can see a partially written one.
+    fd, tmpPath = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    with open(fd, "wb") as f:
+        f.write(chunk)
+    os.chmod(tmpPath, 0o644)
+    os.replace(tmpPath, path)
+
+
+def dumpChunked(storePath, outDir, avgChunkSize, index):
+    """
+    Write the NAR of `storePath` as content-addressed chunk files below
+    `outDir/chunks`, and the list of its chunks to `index`.
+
+    Returns the sha256 digest and the size of the NAR, and the list of its
+    chunks as (hash, size) tuples.
+    """
+    dump = subprocess.Popen(["nix-store", "--dump", storePath], stdout=subprocess.PIPE)
+
+    narHash = hashlib.sha256()
+    narSize = 0
+    chunks = []
+    with dump.stdout:
+        for chunk in splitChunks(dump.stdout, avgChunkSize):
+            narHash.update(chunk)
+            narSize += len(chunk)
+            chunkHash = toNixBase32(hashlib.sha256(chunk).digest())
+            writeChunk(outDir, chunkHash, chunk)
+            index.write(f"{chunkHash} {len(chunk)}\n")
+            chunks.append((chunkHash, len(chunk)))
+
+    if dump.wait() != 0:
+        raise subprocess.CalledProcessError(dump.returncode, dump.args)
+
+    return narHash.digest(), narSize, chunks
+
+
 def processItem(
-    item, nixPrefix, outDir, compression, compressionCommand, compressionExtension
+    item,
+    nixPrefix,
+    outDir,
+    compression,
+    compressionLevel,
+    compressionExtension,
+    incremental,
+    avgChunkSize=None,
 ):
+    """
+    Write the NAR and the narinfo of a store path to the binary cache.
+
+    With `avgChunkSize` set, the NAR is written as chunks instead, next to a
+    `nar/<hash>.nar.chunks` index listing them, see read-chunked-nar.py.
+
+    Returns None if the store path was skipped, otherwise the list of the
+    chunks written as (hash, size) tuples, or the NAR size without chunking.
+    """
     narInfoHash = dropPrefix(item["path"], nixPrefix).split("-")[0]
+    narInfoFile = outDir / f"{narInfoHash}.narinfo"
 
-    narFile = outDir / "nar" / f"{narInfoHash}.nar{compressionExtension}"
-    with open(narFile, "wb") as f:
-        subprocess.run(
-            f"nix-store --dump {item['path']} {compressionCommand}",
-            stdout=f,
-            shell=True,
-            check=True,
-        )
+    # The narinfo is only written once its NAR is complete, so its existence
+    # means there is nothing left to do for this store path.
+    if incremental and narInfoFile.exists():
+        return None
 
-    fileHash = (
-        subprocess.run(
-            ["nix-hash", "--base32", "--type", "sha256", "--flat", narFile],
-            capture_output=True,
-            check=True,
-        )
-        .stdout.decode()
-        .strip()
-    )
-    fileSize = os.path.getsize(narFile)
+    if avgChunkSize is None:
+        narFile = outDir / "nar" / f"{narInfoHash}.nar{compressionExtension}"
+        with open(narFile, "wb") as f:
+            digest, fileSize = dumpCompressed(
+                item["path"], compressionCommand(compression, compressionLevel), f
+            )
+        result = fileSize
+    else:
+        # The chunks make up the uncompressed NAR, which is what clients will
+        # be served after reassembling it.
+        compression = "none"
+        compressionExtension = ""
+        narFile = outDir / "nar" / f"{narInfoHash}.nar.chunks"
+        with open(narFile, "wt") as f:
+            digest, fileSize, result = dumpChunked(
+                item["path"], outDir, avgChunkSize, f
+            )
+    fileHash = toNixBase32(digest)
 
     finalNarFileName = Path("nar") / f"{fileHash}.nar{compressionExtension}"
-    os.rename(narFile, outDir / finalNarFileName)
+    if avgChunkSize is None:
+        os.rename(narFile, outDir / finalNarFileName)
+    else:
+        os.rename(narFile, outDir / f"{finalNarFileName}.chunks")
 
-    with open(outDir / f"{narInfoHash}.narinfo", "wt") as f:
+    narInfoTmpFile = outDir / f"{narInfoHash}.narinfo.tmp"
+    with open(narInfoTmpFile, "wt") as f:
         f.write(f"StorePath: {item['path']}\n")
         f.write(f"URL: {finalNarFileName}\n")
         f.write(f"Compression: {compression}\n")
@@ -50,18 +295,57 @@ def processItem(
         f.write(
             f"References: {' '.join(dropPrefix(ref, nixPrefix) for ref in item['references'])}\n"
         )
+    os.rename(narInfoTmpFile, narInfoFile)
+
+    return result
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--compression", choices=["none", "xz", "zstd"])
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        help="level passed to the compressor, defaults to the compressor's default",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=int(os.environ.get("NIX_BUILD_CORES", "4")) or os.cpu_count(),
+        help="number of store paths processed in parallel, defaults to $NIX_BUILD_CORES",
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=Path,
+        default=os.environ.get("out"),
+        required="out" not in os.environ,
+        help="directory to write the binary cache to, defaults to $out",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="skip store paths whose .narinfo already exists in the output directory",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=["nar", "chunked"],
+        default="nar",
+        help="write every NAR as one file, or as deduplicated chunks",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=64 * 1024,
+        help="average chunk size for the chunked layout, a power of two",
+    )
     args = parser.parse_args()
 
-    compressionCommand = {
-        "none": "",
-        "xz": "| xz -c",
-        "zstd": "| zstd",
-    }[args.compression]
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.chunk_size < 64 or args.chunk_size & (args.chunk_size - 1):
+        parser.error("--chunk-size must be a power of two of at least 64")
+    if args.layout == "chunked" and numpy is None:
+        parser.error("the chunked layout needs the 'numpy' module")
 
     compressionExtension = {
         "none": "",
@@ -69,28 +353,50 @@ def main():
         "zstd": ".zst",
     }[args.compression]
 
-    outDir = Path(os.environ["out"])
+    outDir = args.out_dir
     nixPrefix = os.environ["NIX_STORE"]
-    numWorkers = int(os.environ.get("NIX_BUILD_CORES", "4"))
 
     with open(os.environ["NIX_ATTRS_JSON_FILE"], "r") as f:
         closures = json.load(f)["closure"]
 
     os.makedirs(outDir / "nar", exist_ok=True)
+    if args.layout == "chunked":
+        os.makedirs(outDir / "chunks", exist_ok=True)
 
     with open(outDir / "nix-cache-info", "w") as f:
         f.write(f"StoreDir: {nixPrefix}\n")
 
-    with Pool(processes=numWorkers) as pool:
+    startTime = time.monotonic()
+    with Pool(processes=args.jobs) as pool:
         worker = partial(
             processItem,
             nixPrefix=nixPrefix,
             outDir=outDir,
             compression=args.compression,
-            compressionCommand=compressionCommand,
+            compressionLevel=args.compression_level,
             compressionExtension=compressionExtension,
+            incremental=args.incremental,
+            avgChunkSize=args.chunk_size if args.layout == "chunked" else None,
+        )
+        results = pool.map(worker, closures)
+    processed = [result for result in results if result is not None]
+
+    if args.incremental:
+        print(
+            f"Processed {len(processed)} new store paths, "
+            f"skipped {len(results) - len(processed)} existing ones"
+        )
+
+    if args.layout == "chunked":
+        narBytes = sum(size for chunks in processed for _, size in chunks)
+        uniqueChunks = {chunk for chunks in processed for chunk in chunks}
+        chunkBytes = sum(size for _, size in uniqueChunks)
+        print(
+            f"Stored {narBytes} bytes of NARs as {len(uniqueChunks)} chunks "
+            f"with {chunkBytes} bytes (dedup ratio "
+            f"{narBytes / max(chunkBytes, 1):.2f}) "
+            f"in {time.monotonic() - startTime:.1f}s"
         )
-        pool.map(worker, closures)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,20 @@
+"""
+Nix's base32 encoding, shared by make-binary-cache.py and read-chunked-nar.py.
+"""
+
+# Alphabet of Nix's base32 encoding, which omits e, o, u and t
+nixBase32Chars = "0123456789abcdfghijklmnpqrsvwxyz"
+
+
+def toNixBase32(digest):
+    """Encode a digest the same way as `nix-hash --base32` does."""
+    length = (len(digest) * 8 - 1) // 5 + 1
+    chars = []
+    for n in range(length - 1, -1, -1):
+        b = n * 5
+        i, j = divmod(b, 8)
+        c = digest[i] >> j
+        if i + 1 < len(digest):
+            c |= digest[i + 1] << (8 - j)
+        chars.append(nixBase32Chars[c & 0x1F])
+    return "".join(chars)
@@ -0,0 +1,76 @@
+"""
+Reassemble a NAR from a binary cache written by make-binary-cache.py with
+`--layout chunked`, for serving it to Nix clients.
+
+The narinfo files of such a cache point to `nar/<hash>.nar` URLs. Next to
+where such a NAR would be, `nar/<hash>.nar.chunks` lists the chunks it is made
+of, one `<chunk hash> <size>` line each, which are stored in
+`chunks/<first two characters of the hash>/<chunk hash>`.
+
+For example, to serve a requested `nar/<hash>.nar` from a CGI script:
+
+    python read-chunked-nar.py /path/to/cache nar/<hash>.nar
+"""
+
+import argparse
+import hashlib
+import os
+from pathlib import Path
+import sys
+
+from nixbase32 import toNixBase32
+
+
+def readChunkIndex(cacheDir, narPath):
+    with open(cacheDir / f"{narPath}.chunks", "rt") as f:
+        for line in f:
+            chunkHash, size = line.split()
+            yield chunkHash, int(size)
+
+
+def writeNar(cacheDir, narPath, out, verify=True):
+    """
+    Write the NAR at `narPath` in the cache to `out`, from its chunks.
+
+    With `verify`, the hash and the size of every chunk are checked against its
+    name and the index, and the hash of the whole NAR against its file name.
+    """
+    narHash = hashlib.sha256()
+    for chunkHash, size in readChunkIndex(cacheDir, narPath):
+        with open(cacheDir / "chunks" / chunkHash[:2] / chunkHash, "rb") as f:
+            chunk = f.read()
+        if verify:
+            if len(chunk) != size or (
+                toNixBase32(hashlib.sha256(chunk).digest()) != chunkHash
+            ):
+                raise ValueError(f"chunk {chunkHash} of {narPath} is corrupt")
+            narHash.update(chunk)
+        out.write(chunk)
+
+    expectedHash = Path(narPath).name.split(".")[0]
+    if verify and toNixBase32(narHash.digest()) != expectedHash:
+        raise ValueError(f"{narPath} does not match its hash")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a NAR of a chunked binary cache to stdout"
+    )
+    parser.add_argument("cache", type=Path, help="directory of the binary cache")
+    parser.add_argument("nar", help="URL of the NAR, like nar/<hash>.nar")
+    parser.add_argument(
+        "--no-verify",
+        action="store_true",
+        help="don't check the hashes of the chunks and the NAR",
+    )
+    args = parser.parse_args()
+
+    narPath = os.path.normpath(args.nar)
+    if narPath.startswith(("/", "..")) or not narPath.endswith(".nar"):
+        parser.error(f"not a NAR in the cache: {args.nar}")
+
+    writeNar(args.cache, narPath, sys.stdout.buffer, verify=not args.no_verify)
+
+
+if __name__ == "__main__":
+    main()
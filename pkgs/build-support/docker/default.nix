@@ -19,6 +19,7 @@
 , nix
 , nixosTests
 , pigz
+, python3Packages
 , rsync
 , runCommand
 , runtimeShell
@@ -899,6 +900,13 @@ rec {
 
   buildLayeredImageWithNixDb = args: buildLayeredImage (args // { includeNixDB = true; });
 
+  # Layering pipeline for streamLayeredImage, which assigns store paths to
+  # layers such that they are shared between the given images.
+  # See: pkgs/by-name/fl/flattenReferencesGraph/src/flatten_references_graph/share_layers.py
+  sharedLayersLayeringPipeline = import ./shared-layers-layering-pipeline.nix {
+    inherit lib jq runCommand;
+  };
+
   # Arguments are documented in ../../../doc/build-helpers/images/dockertools.section.md
   streamLayeredImage = lib.makeOverridable (
     {
@@ -945,7 +953,9 @@ rec {
       let
         baseName = baseNameOf name;
 
-        streamScript = writePython3 "stream" { } ./stream_layered_image.py;
+        streamScript = writePython3 "stream" {
+          libraries = [ python3Packages.zstandard ];
+        } ./stream_layered_image.py;
         baseJson = writeText "${baseName}-base.json" (builtins.toJSON {
           inherit config architecture;
           os = "linux";
@@ -0,0 +1,48 @@
+{
+  lib,
+  runCommand,
+  jq,
+}:
+{
+  # The closure roots of every image which should share layers, as a list
+  # of lists. The same pipeline has to be used for all of these images.
+  images,
+  maxLayers,
+  fromImage ? null,
+}:
+runCommand "shared-layers-layering-pipeline.json"
+  {
+    __structuredAttrs = true;
+    exportReferencesGraph = lib.listToAttrs (
+      lib.imap0 (index: roots: lib.nameValuePair "image${toString index}" roots) images
+    );
+    imageCount = lib.length images;
+    inherit maxLayers;
+    nativeBuildInputs = [ jq ];
+  }
+  ''
+    . .attrs.sh
+
+    # one layer will be taken up by the customisation layer
+    usedLayers=1
+
+    ${lib.optionalString (fromImage != null) ''
+      # subtract number of base image layers
+      baseImageLayersCount=$(tar -xOf "${fromImage}" manifest.json | jq '.[0].Layers | length')
+
+      (( usedLayers += baseImageLayersCount ))
+    ''}
+
+    if ! (( $usedLayers < $maxLayers )); then
+      echo >&2 "Error: usedLayers $usedLayers layers to store 'fromImage' and" \
+                "'extraCommands', but only maxLayers=$maxLayers were" \
+                "allowed. At least 1 layer is required to store contents."
+      exit 1
+    fi
+    availableLayers=$(( maxLayers - usedLayers ))
+
+    # Produce pipeline which shares layers between the images.
+    jq --argjson availableLayers "$availableLayers" '
+      [["share_layers", [range(.imageCount) as $i | .["image\($i)"]], $availableLayers]]
+    ' .attrs.json > ''${outputs[out]}
+  ''
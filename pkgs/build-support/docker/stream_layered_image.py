@@ -28,12 +28,34 @@ on the first iteration we calculate the file size and the checksum,
 and on the second one we actually stream the contents. 'add_layer_dir'
 function does all this.
 
+Since store paths are immutable, the checksum and the size of a layer
+only depend on its store paths and the file ownership and mtime we
+apply to them. If a cache directory is given (or XDG_CACHE_HOME is set),
+we remember them in a small on-disk cache (see 'LayerDigestCache'), so
+streaming an image again only needs to archive the unchanged layers once.
+
+The first pass can also be done ahead of time for all layers at once in
+a pool of worker processes ('--jobs'), while the outer tarball is still
+written in order.
+
+Alternatively, the image can be written as an OCI image layout [3] to a
+directory ('--oci-layout'), optionally with gzip or zstd compressed
+layers ('--compression'). Every blob is then written straight to its
+file, so each layer is archived only once; the compressed and the
+uncompressed (diff_id) checksums are calculated in the same pass.
+
 [1]: https://github.com/moby/moby/blob/master/image/spec/v1.2.md
 [2]: https://github.com/moby/moby/blob/4fb59c20a4fb54f944fe170d0ff1d00eb4a24d6f/image/spec/v1.2.md#image-json-field-descriptions
+[3]: https://github.com/opencontainers/image-spec/blob/v1.1.0/image-layout.md
 """  # noqa: E501
 
 import argparse
+import contextlib
 import io
+import gzip
+import shutil
+import tempfile
+import functools
 import os
 import re
 import sys
@@ -43,9 +65,20 @@ import pathlib
 import tarfile
 import itertools
 import threading
+import concurrent.futures
 from datetime import datetime, timezone
 from collections import namedtuple
 
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 def archive_paths_to(obj, paths, mtime, uid, gid, uname, gname):
     """
@@ -53,6 +86,8 @@ def archive_paths_to(obj, paths, mtime, uid, gid, uname, gname):
 
     obj: Stream to write to. Should have a 'write' method.
     paths: List of store paths.
+
+    Returns: The number of bytes read from the regular files in the store.
     """
 
     # gettarinfo makes the paths relative, this makes them
@@ -78,6 +113,7 @@ def archive_paths_to(obj, paths, mtime, uid, gid, uname, gname):
         ti.type = tarfile.DIRTYPE
         return ti
 
+    bytes_read = 0
     with tarfile.open(fileobj=obj, mode="w|") as tar:
         # To be consistent with the docker utilities, we need to have
         # these directories first when building layer tarballs.
@@ -104,9 +140,12 @@ def archive_paths_to(obj, paths, mtime, uid, gid, uname, gname):
                 if ti.isfile():
                     with open(filename, "rb") as f:
                         tar.addfile(ti, f)
+                    bytes_read += ti.size
                 else:
                     tar.addfile(ti)
 
+    return bytes_read
+
 
 class ExtractChecksum:
     """
@@ -129,9 +168,192 @@ class ExtractChecksum:
         return (self._digest.hexdigest(), self._size)
 
 
+def calculate_layer_checksum(paths, mtime, uid, gid, uname, gname):
+    """
+    Archives the given store paths only to calculate the checksum and the
+    size of the resulting layer tarball.
+
+    Returns: Hex-encoded sha256sum, size and the number of bytes read from
+             the store as a tuple.
+    """
+    extract_checksum = ExtractChecksum()
+    bytes_read = archive_paths_to(
+        extract_checksum, paths, mtime, uid, gid, uname, gname
+    )
+    (checksum, size) = extract_checksum.extract()
+    return (checksum, size, bytes_read)
+
+
+class TeeChecksum(ExtractChecksum):
+    """
+    A writable stream which calculates the final file size and sha256sum
+    of the contents, while passing them through to another stream.
+    """
+
+    def __init__(self, stream):
+        super().__init__()
+        self._stream = stream
+
+    def write(self, data):
+        super().write(data)
+        return self._stream.write(data)
+
+
+class VerifyChecksum:
+    """
+    A readable stream wrapper which calculates the size and sha256sum of
+    everything read through it, so a cached checksum can be verified
+    while the contents are streamed.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._checksum = ExtractChecksum()
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._checksum.write(data)
+        return data
+
+    def extract(self):
+        """
+        Returns: Hex-encoded sha256sum and size as a tuple.
+        """
+        return self._checksum.extract()
+
+
+class LayerDigestCache:
+    """
+    A persistent cache of layer checksums and sizes.
+
+    The entries are keyed on the sorted list of store paths in the layer,
+    together with the ownership and mtime applied to the archived files.
+    Store paths are immutable, so an entry never needs to be invalidated;
+    we only also record the inode and ctime of every store path to notice
+    if a path has been garbage collected and realised again.
+
+    Failing to read or write the cache is never an error, the layer is
+    hashed as if there was no cache at all.
+    """
+
+    VERSION = 1
+
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        self._writable = True
+
+    @classmethod
+    def open(cls, cache_dir):
+        """
+        Returns: A cache in the given directory, or 'None' if the directory
+                 can not be created (e.g. in the Nix build sandbox, where
+                 HOME is not writable).
+        """
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError:
+            return None
+        return cls(cache_dir)
+
+    def key(self, paths, mtime, uid, gid, uname, gname):
+        """
+        Returns: The cache key for the layer with the given store paths.
+        """
+        store_paths = []
+        for path in sorted(paths):
+            st = os.lstat(path)
+            store_paths.append([path, st.st_ino, st.st_ctime_ns])
+
+        key = {
+            "version": self.VERSION,
+            "paths": store_paths,
+            "mtime": mtime,
+            "uid": uid,
+            "gid": gid,
+            "uname": uname,
+            "gname": gname,
+        }
+        key = json.dumps(key, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(key).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self._cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """
+        Returns: Hex-encoded sha256sum and size as a tuple, or 'None' if
+                 the layer is not in the cache.
+        """
+        try:
+            with open(self._entry_path(key), "r") as f:
+                entry = json.load(f)
+            checksum = entry["checksum"]
+            size = int(entry["size"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+        if not re.fullmatch(r"[0-9a-f]{64}", checksum):
+            return None
+        return (checksum, size)
+
+    def put(self, key, checksum, size):
+        """
+        Records the sha256sum and size of the layer with the given key.
+        """
+        if not self._writable:
+            return
+        entry = json.dumps({"checksum": checksum, "size": size})
+        tmp_path = f"{self._entry_path(key)}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(entry)
+            os.replace(tmp_path, self._entry_path(key))
+        except OSError as e:
+            # Only report it once, the other layers would fail the same way
+            print(f"Could not write layer cache: {e}", file=sys.stderr)
+            self._writable = False
+
+    def remove(self, key):
+        """
+        Removes the entry with the given key, if any.
+        """
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+
+def default_cache_dir():
+    """
+    Returns: The default location of the layer digest cache, or 'None' if
+             XDG_CACHE_HOME is not set. The cache is opt-in, since the
+             script also runs in the Nix build sandbox, where it could
+             never pay off.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not cache_home:
+        return None
+    return os.path.join(cache_home, "nix-stream-layered-image")
+
+
 FromImage = namedtuple("FromImage", ["tar", "manifest_json", "image_json"])
 # Some metadata for a layer
-LayerInfo = namedtuple("LayerInfo", ["size", "checksum", "path", "paths"])
+LayerInfo = namedtuple(
+    "LayerInfo", ["size", "checksum", "path", "paths", "bytes_read"],
+    defaults=[0],
+)
+# Some metadata for a layer written as a blob of an OCI image layout,
+# 'checksum' being the sha256sum of the uncompressed layer (its diff_id)
+LayerBlob = namedtuple(
+    "LayerBlob",
+    ["media_type", "digest", "size", "checksum", "paths", "bytes_read"],
+)
+
+OCI_LAYER_MEDIA_TYPES = {
+    "none": "application/vnd.oci.image.layer.v1.tar",
+    "gzip": "application/vnd.oci.image.layer.v1.tar+gzip",
+    "zstd": "application/vnd.oci.image.layer.v1.tar+zstd",
+}
 
 
 def load_from_image(from_image_str):
@@ -210,7 +432,18 @@ def overlay_base_config(from_image, final_config):
     return final_config
 
 
-def add_layer_dir(tar, paths, store_dir, mtime, uid, gid, uname, gname):
+def add_layer_dir(
+    tar,
+    paths,
+    store_dir,
+    mtime,
+    uid,
+    gid,
+    uname,
+    gname,
+    cache=None,
+    pending_checksum=None,
+):
     """
     Appends given store paths to a TarFile object as a new layer.
 
@@ -219,6 +452,11 @@ def add_layer_dir(tar, paths, store_dir, mtime, uid, gid, uname, gname):
     store_dir: the root directory of the nix store
     mtime: 'mtime' of the added files and the layer tarball.
            Should be an integer representing a POSIX time.
+    cache: 'LayerDigestCache' object to look up the checksum and the size
+           of the layer in, or 'None' to always calculate them.
+    pending_checksum: 'concurrent.futures.Future' of the result of
+           'calculate_layer_checksum' for this layer if it is already being
+           calculated elsewhere, or 'None' to calculate it here.
 
     Returns: A 'LayerInfo' object containing some metadata of
              the layer added.
@@ -229,10 +467,29 @@ def add_layer_dir(tar, paths, store_dir, mtime, uid, gid, uname, gname):
         len(invalid_paths) == 0
     ), f"Expecting absolute paths from {store_dir}, but got: {invalid_paths}"
 
-    # First, calculate the tarball checksum and the size.
-    extract_checksum = ExtractChecksum()
-    archive_paths_to(extract_checksum, paths, mtime, uid, gid, uname, gname)
-    (checksum, size) = extract_checksum.extract()
+    bytes_read = 0
+
+    # First, calculate the tarball checksum and the size, unless we
+    # already know them from a previous run.
+    cache_key = None
+    cached = None
+    if cache is not None:
+        cache_key = cache.key(paths, mtime, uid, gid, uname, gname)
+        cached = cache.get(cache_key)
+
+    if cached is not None:
+        print("Using cached layer checksum", file=sys.stderr)
+        (checksum, size) = cached
+    else:
+        if pending_checksum is not None:
+            (checksum, size, hash_bytes_read) = pending_checksum.result()
+        else:
+            (checksum, size, hash_bytes_read) = calculate_layer_checksum(
+                paths, mtime, uid, gid, uname, gname
+            )
+        bytes_read += hash_bytes_read
+        if cache is not None:
+            cache.put(cache_key, checksum, size)
 
     path = f"{checksum}/layer.tar"
     layer_tarinfo = tarfile.TarInfo(path)
@@ -240,11 +497,14 @@ def add_layer_dir(tar, paths, store_dir, mtime, uid, gid, uname, gname):
     layer_tarinfo.mtime = mtime
 
     # Then actually stream the contents to the outer tarball.
+    producer_bytes_read = []
     read_fd, write_fd = os.pipe()
     with open(read_fd, "rb") as read, open(write_fd, "wb") as write:
 
         def producer():
-            archive_paths_to(write, paths, mtime, uid, gid, uname, gname)
+            producer_bytes_read.append(
+                archive_paths_to(write, paths, mtime, uid, gid, uname, gname)
+            )
             write.close()
 
         # Closing the write end of the fifo also closes the read end,
@@ -253,10 +513,61 @@ def add_layer_dir(tar, paths, store_dir, mtime, uid, gid, uname, gname):
         # Any exception from the thread will get printed by the default
         # exception handler, and the 'addfile' call will fail since it
         # won't be able to read required amount of bytes.
-        threading.Thread(target=producer).start()
-        tar.addfile(layer_tarinfo, read)
+        producer_thread = threading.Thread(target=producer)
+        producer_thread.start()
+        if cached is not None:
+            verify_checksum = VerifyChecksum(read)
+            tar.addfile(layer_tarinfo, verify_checksum)
+        else:
+            tar.addfile(layer_tarinfo, read)
+
+    producer_thread.join()
+    bytes_read += sum(producer_bytes_read)
+
+    # A stale cache entry would produce an image which fails to load, so
+    # drop it and make the user retry rather than silently going on.
+    if cached is not None and verify_checksum.extract() != cached:
+        cache.remove(cache_key)
+        raise RuntimeError(
+            f"Cached checksum of the layer with paths {paths} is stale, "
+            "the cache entry has been removed; please try again."
+        )
+
+    return LayerInfo(
+        size=size,
+        checksum=checksum,
+        path=path,
+        paths=paths,
+        bytes_read=bytes_read,
+    )
+
 
-    return LayerInfo(size=size, checksum=checksum, path=path, paths=paths)
+def submit_layer_checksums(
+    executor, store_layers, mtime, uid, gid, uname, gname, cache=None
+):
+    """
+    Starts calculating the checksums of all given layers which are not in
+    the cache yet.
+
+    executor: 'concurrent.futures.Executor' to calculate the checksums in.
+    store_layers: List of layers, each a list of store paths.
+
+    Returns: A list with a 'concurrent.futures.Future' for every layer,
+             or 'None' for the layers found in the cache.
+    """
+    pending = []
+    for paths in store_layers:
+        if cache is not None:
+            cache_key = cache.key(paths, mtime, uid, gid, uname, gname)
+            if cache.get(cache_key) is not None:
+                pending.append(None)
+                continue
+        pending.append(
+            executor.submit(
+                calculate_layer_checksum, paths, mtime, uid, gid, uname, gname
+            )
+        )
+    return pending
 
 
 def add_customisation_layer(target_tar, customisation_layer, mtime):
@@ -307,6 +618,290 @@ def add_bytes(tar, path, content, mtime):
     tar.addfile(ti, io.BytesIO(content))
 
 
+def open_compressor(stream, compression, level=None):
+    """
+    Returns: A writable stream compressing everything written to it into
+             the given stream. Closing it does not close 'stream'.
+
+    compression: One of the keys of 'OCI_LAYER_MEDIA_TYPES'.
+    level: Compression level, or 'None' for the default of the compressor.
+    """
+    if compression == "none":
+        return contextlib.nullcontext(stream)
+
+    if compression == "gzip":
+        return gzip.GzipFile(
+            filename="",
+            mode="wb",
+            fileobj=stream,
+            compresslevel=9 if level is None else level,
+            mtime=0,
+        )
+
+    if compression == "zstd":
+        if zstd is not None:
+            return zstd.ZstdFile(stream, "w", level=level)
+        if zstandard is not None:
+            cctx = zstandard.ZstdCompressor(
+                level=3 if level is None else level
+            )
+            return cctx.stream_writer(stream, closefd=False)
+        raise RuntimeError(
+            "zstd compression needs Python 3.14 or the 'zstandard' module"
+        )
+
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def copy_file_to(obj, path):
+    """
+    Writes the contents of the given file to the given stream.
+
+    Returns: The number of bytes read.
+    """
+    with open(path, "rb") as f:
+        shutil.copyfileobj(f, obj)
+        return f.tell()
+
+
+def write_blob(blobs_dir, content):
+    """
+    Writes the given bytes as a blob of an OCI image layout.
+
+    blobs_dir: The 'blobs/sha256' directory of the image layout.
+
+    Returns: The digest and the size of the blob as a tuple.
+    """
+    assert type(content) is bytes
+
+    checksum = hashlib.sha256(content).hexdigest()
+    with open(os.path.join(blobs_dir, checksum), "wb") as f:
+        f.write(content)
+    return (f"sha256:{checksum}", len(content))
+
+
+def write_layer_blob(
+    blobs_dir, write_layer, paths, compression="none", level=None
+):
+    """
+    Writes a layer as a blob of an OCI image layout, compressing it on the
+    way. Both the checksum of the compressed blob and the uncompressed
+    layer tarball are calculated while it is written, so the layer is only
+    produced once.
+
+    blobs_dir: The 'blobs/sha256' directory of the image layout.
+    write_layer: Function writing the uncompressed layer tarball to the
+                 stream it is given, returning the number of bytes it read.
+    paths: List of paths the layer is made of, for the image history.
+    compression: One of the keys of 'OCI_LAYER_MEDIA_TYPES'.
+    level: Compression level, or 'None' for the default of the compressor.
+
+    Returns: A 'LayerBlob' object containing some metadata of the layer
+             written.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=blobs_dir, prefix=".tmp-")
+    try:
+        with open(fd, "wb") as f:
+            compressed = TeeChecksum(f)
+            with open_compressor(compressed, compression, level) as c:
+                uncompressed = TeeChecksum(c)
+                bytes_read = write_layer(uncompressed)
+        (digest, size) = compressed.extract()
+        (checksum, _) = uncompressed.extract()
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, os.path.join(blobs_dir, digest))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return LayerBlob(
+        media_type=OCI_LAYER_MEDIA_TYPES[compression],
+        digest=f"sha256:{digest}",
+        size=size,
+        checksum=checksum,
+        paths=paths,
+        bytes_read=bytes_read,
+    )
+
+
+def make_image_json(conf, created, from_image, layers):
+    """
+    Returns: The image configuration for the given layers, which is the
+             same for Docker and OCI images.
+    """
+    return {
+        "created": datetime.isoformat(created),
+        "architecture": conf["architecture"],
+        "os": "linux",
+        "config": overlay_base_config(from_image, conf["config"]),
+        "rootfs": {
+            "diff_ids": [f"sha256:{layer.checksum}" for layer in layers],
+            "type": "layers",
+        },
+        "history": [
+            {
+                "created": datetime.isoformat(created),
+                "comment": f"store paths: {layer.paths}",
+            }
+            for layer in layers
+        ],
+    }
+
+
+def write_oci_layout(
+    out_dir,
+    conf,
+    repo_tag,
+    from_image,
+    jobs=1,
+    compression="none",
+    level=None,
+):
+    """
+    Writes the image as an OCI image layout to the given directory.
+
+    Layers are archived, compressed and hashed concurrently in 'jobs'
+    worker processes, every layer directly into its blob file.
+
+    Returns: The list of 'LayerBlob' objects of the layers written.
+    """
+    created = parse_time(conf["created"])
+    mtime = int(parse_time(conf["mtime"]).timestamp())
+    store_dir = conf["store_dir"]
+
+    blobs_dir = os.path.join(out_dir, "blobs", "sha256")
+    os.makedirs(blobs_dir, exist_ok=True)
+
+    for paths in conf["store_layers"]:
+        invalid_paths = [i for i in paths if not i.startswith(store_dir)]
+        assert len(invalid_paths) == 0, (
+            f"Expecting absolute paths from {store_dir}, "
+            f"but got: {invalid_paths}"
+        )
+
+    layers = []
+
+    # Base layers are read from the base image tarball, which can't be
+    # shared with the worker processes.
+    if from_image is None:
+        print("No 'fromImage' provided", file=sys.stderr)
+    else:
+        base_layers = from_image.manifest_json[0]["Layers"]
+        for num, layer in enumerate(base_layers, start=1):
+            print("Adding base layer", num, "from", layer, file=sys.stderr)
+            layer_tarinfo = from_image.tar.getmember(layer)
+
+            def write_base_layer(obj):
+                f = from_image.tar.extractfile(layer_tarinfo)
+                shutil.copyfileobj(f, obj)
+                return 0
+
+            layers.append(
+                write_layer_blob(
+                    blobs_dir, write_base_layer, [layer], compression, level
+                )
+            )
+        from_image.tar.close()
+
+    write_layers = [
+        (
+            functools.partial(
+                archive_paths_to,
+                paths=paths,
+                mtime=mtime,
+                uid=int(conf["uid"]),
+                gid=int(conf["gid"]),
+                uname=conf["uname"],
+                gname=conf["gname"],
+            ),
+            paths,
+        )
+        for paths in conf["store_layers"]
+    ]
+    customisation_layer = conf["customisation_layer"]
+    write_layers.append(
+        (
+            functools.partial(
+                copy_file_to,
+                path=os.path.join(customisation_layer, "layer.tar"),
+            ),
+            [customisation_layer],
+        )
+    )
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = [
+            executor.submit(
+                write_layer_blob,
+                blobs_dir,
+                write_layer,
+                paths,
+                compression,
+                level,
+            )
+            for (write_layer, paths) in write_layers
+        ]
+        for num, future in enumerate(pending, start=len(layers) + 1):
+            layer = future.result()
+            print(
+                "Created layer",
+                num,
+                f"({layer.digest}) from paths:",
+                layer.paths,
+                file=sys.stderr,
+            )
+            layers.append(layer)
+
+    print("Adding manifests...", file=sys.stderr)
+
+    image_json = make_image_json(conf, created, from_image, layers)
+    image_json = json.dumps(image_json, indent=4).encode("utf-8")
+    (config_digest, config_size) = write_blob(blobs_dir, image_json)
+
+    manifest_json = {
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.oci.image.manifest.v1+json",
+        "config": {
+            "mediaType": "application/vnd.oci.image.config.v1+json",
+            "digest": config_digest,
+            "size": config_size,
+        },
+        "layers": [
+            {
+                "mediaType": layer.media_type,
+                "digest": layer.digest,
+                "size": layer.size,
+            }
+            for layer in layers
+        ],
+    }
+    manifest_json = json.dumps(manifest_json, indent=4).encode("utf-8")
+    (manifest_digest, manifest_size) = write_blob(blobs_dir, manifest_json)
+
+    index_json = {
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.oci.image.index.v1+json",
+        "manifests": [
+            {
+                "mediaType": "application/vnd.oci.image.manifest.v1+json",
+                "digest": manifest_digest,
+                "size": manifest_size,
+                "annotations": {
+                    "io.containerd.image.name": repo_tag,
+                    "org.opencontainers.image.ref.name":
+                        repo_tag.rpartition(":")[2],
+                },
+            }
+        ],
+    }
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump(index_json, f, indent=4)
+    with open(os.path.join(out_dir, "oci-layout"), "w") as f:
+        json.dump({"imageLayoutVersion": "1.0.0"}, f)
+
+    return layers
+
+
 now = datetime.now(tz=timezone.utc)
 
 
@@ -346,8 +941,54 @@ Docker Image Specification v1.2 as reference [1].
         "--repo_tag", "-t", type=str,
         help="Override the RepoTags from the configuration"
     )
+    arg_parser.add_argument(
+        "--cache-dir", type=str, default=default_cache_dir(),
+        help="""
+        Directory to cache the layer checksums and sizes in, so that
+        unchanged layers are only archived once on subsequent runs.
+        Defaults to $XDG_CACHE_HOME/nix-stream-layered-image if
+        XDG_CACHE_HOME is set, otherwise no cache is used.
+    """,
+    )
+    arg_parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Do not read or write the layer checksum cache"
+    )
+    arg_parser.add_argument(
+        "--jobs", "-j", type=int, default=1,
+        help="""
+        Number of worker processes to calculate the layer checksums in,
+        ahead of the layers being streamed. 0 means the number of CPUs.
+        Defaults to 1, calculating every checksum right before the layer
+        is streamed. With --oci-layout, the number of layers archived and
+        compressed at once.
+    """,
+    )
+    arg_parser.add_argument(
+        "--oci-layout", type=str, metavar="DIR",
+        help="""
+        Write the image as an OCI image layout to the given directory,
+        instead of streaming a 'docker load' tarball to stdout.
+    """,
+    )
+    arg_parser.add_argument(
+        "--compression", type=str, default="none",
+        choices=sorted(OCI_LAYER_MEDIA_TYPES),
+        help="Compression of the layers written with --oci-layout"
+    )
+    arg_parser.add_argument(
+        "--compression-level", type=int,
+        help="Compression level, defaults to the one of the compressor"
+    )
 
     args = arg_parser.parse_args()
+    if args.compression != "none" and args.oci_layout is None:
+        arg_parser.error("--compression requires --oci-layout")
+    if args.compression == "zstd" and zstd is None and zstandard is None:
+        arg_parser.error(
+            "zstd compression needs Python 3.14 or the 'zstandard' module"
+        )
+
     with open(args.conf, "r") as f:
         conf = json.load(f)
 
@@ -360,13 +1001,50 @@ Docker Image Specification v1.2 as reference [1].
     store_dir = conf["store_dir"]
 
     from_image = load_from_image(conf["from_image"])
+    cache = None
+    if not args.no_cache and args.cache_dir is not None:
+        cache = LayerDigestCache.open(args.cache_dir)
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+
+    if args.oci_layout is not None:
+        layers = write_oci_layout(
+            args.oci_layout,
+            conf,
+            args.repo_tag or conf["repo_tag"],
+            from_image,
+            jobs=jobs,
+            compression=args.compression,
+            level=args.compression_level,
+        )
+        bytes_read = sum(layer.bytes_read for layer in layers)
+        print(f"Read {bytes_read} bytes from the store.", file=sys.stderr)
+        print("Done.", file=sys.stderr)
+        return
+
+    store_layers = conf["store_layers"]
+
+    with contextlib.ExitStack() as stack:
+        pending_checksums = [None] * len(store_layers)
+        if jobs > 1:
+            executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+            )
+            pending_checksums = submit_layer_checksums(
+                executor, store_layers, mtime, uid, gid, uname, gname, cache
+            )
 
-    with tarfile.open(mode="w|", fileobj=sys.stdout.buffer) as tar:
+        tar = stack.enter_context(
+            tarfile.open(mode="w|", fileobj=sys.stdout.buffer)
+        )
         layers = []
         layers.extend(add_base_layers(tar, from_image))
 
         start = len(layers) + 1
-        for num, store_layer in enumerate(conf["store_layers"], start=start):
+        store_layers_pending = zip(store_layers, pending_checksums)
+        for num, (store_layer, pending) in enumerate(
+            store_layers_pending, start=start
+        ):
             print(
                 "Creating layer",
                 num,
@@ -375,7 +1053,16 @@ Docker Image Specification v1.2 as reference [1].
                 file=sys.stderr,
             )
             info = add_layer_dir(
-                tar, store_layer, store_dir, mtime, uid, gid, uname, gname
+                tar,
+                store_layer,
+                store_dir,
+                mtime,
+                uid,
+                gid,
+                uname,
+                gname,
+                cache=cache,
+                pending_checksum=pending,
             )
             layers.append(info)
 
@@ -393,24 +1080,7 @@ Docker Image Specification v1.2 as reference [1].
 
         print("Adding manifests...", file=sys.stderr)
 
-        image_json = {
-            "created": datetime.isoformat(created),
-            "architecture": conf["architecture"],
-            "os": "linux",
-            "config": overlay_base_config(from_image, conf["config"]),
-            "rootfs": {
-                "diff_ids": [f"sha256:{layer.checksum}" for layer in layers],
-                "type": "layers",
-            },
-            "history": [
-                {
-                    "created": datetime.isoformat(created),
-                    "comment": f"store paths: {layer.paths}",
-                }
-                for layer in layers
-            ],
-        }
-
+        image_json = make_image_json(conf, created, from_image, layers)
         image_json = json.dumps(image_json, indent=4).encode("utf-8")
         image_json_checksum = hashlib.sha256(image_json).hexdigest()
         image_json_path = f"{image_json_checksum}.json"
@@ -426,6 +1096,8 @@ Docker Image Specification v1.2 as reference [1].
         manifest_json = json.dumps(manifest_json, indent=4).encode("utf-8")
         add_bytes(tar, "manifest.json", manifest_json, mtime=mtime)
 
+        bytes_read = sum(layer.bytes_read for layer in layers)
+        print(f"Read {bytes_read} bytes from the store.", file=sys.stderr)
         print("Done.", file=sys.stderr)
 
 
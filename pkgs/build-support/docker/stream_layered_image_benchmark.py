@@ -0,0 +1,135 @@
+# Benchmark the layer checksum cache of stream_layered_image.py: stream an
+# image of synthetic store paths, one per layer, twice with the same
+# --cache-dir, and report how much was read from the store and how long it
+# took for the cold and the warm run. Both runs must produce the same image.
+#
+# Run with:
+#
+#   python stream_layered_image_benchmark.py
+#
+# The store paths are created in a temporary directory, so this doesn't need
+# Nix or a store.
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(__file__), "stream_layered_image.py")
+
+
+def make_store_paths(store_dir, layers, files, file_size, seed=0):
+    """
+    Returns: 'layers' store paths under 'store_dir', each with 'files' files
+             of random contents of about 'file_size' bytes.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for index in range(layers):
+        path = os.path.join(
+            store_dir, f"{rng.getrandbits(128):032x}-layer-{index}"
+        )
+        os.makedirs(os.path.join(path, "share"))
+        for file in range(files):
+            size = rng.randint(file_size // 2, file_size * 3 // 2)
+            with open(os.path.join(path, "share", f"file-{file}"), "wb") as f:
+                f.write(rng.randbytes(size))
+        paths.append(path)
+    return paths
+
+
+def make_customisation_layer(path):
+    """
+    Creates the (empty) customisation layer, which stream_layered_image.py
+    expects to be archived and hashed already.
+    """
+    os.makedirs(path)
+    layer = os.path.join(path, "layer.tar")
+    with tarfile.open(layer, "w"):
+        pass
+    with open(layer, "rb") as f:
+        checksum = hashlib.sha256(f.read()).hexdigest()
+    with open(os.path.join(path, "checksum"), "w") as f:
+        f.write(checksum)
+
+
+def stream(conf, cache_dir):
+    """
+    Returns: The number of bytes read from the store, the time it took and
+             the sha256 of the streamed image.
+    """
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, SCRIPT, "--cache-dir", cache_dir, conf],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    duration = time.perf_counter() - start
+    match = re.search(rb"Read (\d+) bytes from the store", process.stderr)
+    if match is None:
+        raise SystemExit(process.stderr.decode())
+    return (
+        int(match.group(1)),
+        duration,
+        hashlib.sha256(process.stdout).hexdigest(),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--layers", type=int, default=100)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--file-size", type=int, default=100_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        store_dir = os.path.join(workdir, "store")
+        paths = make_store_paths(
+            store_dir, args.layers, args.files, args.file_size
+        )
+        customisation_layer = os.path.join(workdir, "customisation-layer")
+        make_customisation_layer(customisation_layer)
+
+        conf = os.path.join(workdir, "conf.json")
+        with open(conf, "w") as f:
+            json.dump(
+                {
+                    "architecture": "amd64",
+                    "config": {},
+                    "created": "1970-01-01T00:00:01Z",
+                    "mtime": "1970-01-01T00:00:01Z",
+                    "repo_tag": "benchmark:latest",
+                    "uid": 0,
+                    "gid": 0,
+                    "uname": "root",
+                    "gname": "root",
+                    "store_dir": store_dir,
+                    "from_image": None,
+                    "store_layers": [[path] for path in paths],
+                    "customisation_layer": customisation_layer,
+                },
+                f,
+            )
+
+        cache_dir = os.path.join(workdir, "cache")
+        cold_bytes, cold_time, cold_image = stream(conf, cache_dir)
+        warm_bytes, warm_time, warm_image = stream(conf, cache_dir)
+        if cold_image != warm_image:
+            raise SystemExit("the cached run streamed a different image")
+
+    print("{:>6} {:>16} {:>10}".format("run", "bytes read", "time"))
+    print("{:>6} {:>16} {:>9.2f}s".format("cold", cold_bytes, cold_time))
+    print("{:>6} {:>16} {:>9.2f}s".format("warm", warm_bytes, warm_time))
+    print(f"The warm run read {cold_bytes / warm_bytes:.2f}x less.")
+
+
+if __name__ == "__main__":
+    main()
@@ -79,6 +79,8 @@ autoPatchelf() {
                "${extraAutoPatchelfLibs[@]}"                            \
         --runtime-dependencies "${runtimeDependenciesArray[@]/%//lib}"  \
         --append-rpaths "${appendRunpathsArray[@]}"                     \
+        ${autoPatchelfIndex:+--index "$autoPatchelfIndex"}              \
+        --jobs "${NIX_BUILD_CORES:-1}"                                  \
         "${autoPatchelfFlagsArray[@]}"                                  \
         --extra-args "${patchelfFlagsArray[@]}"
 }
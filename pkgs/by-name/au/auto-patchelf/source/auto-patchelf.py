@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
 import argparse
+import io
 import os
 import pprint
+import stat
 import subprocess
 import sys
 import json
+import tempfile
 from fnmatch import fnmatch
-from collections import defaultdict
-from contextlib import contextmanager
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
 from dataclasses import dataclass
+from functools import partial
 from itertools import chain
 from pathlib import Path, PurePath
 from typing import DefaultDict, Generator, Iterator, Optional
@@ -145,45 +150,132 @@ def glob(path: Path, pattern: str, recursive: bool) -> Iterator[Path]:
         return [path] if path.match(pattern) else []
 
 
+# The shared objects found in a library directory, as tuples of their name,
+# the directory to add to the rpath, their architecture and OS ABI, and the
+# rpath entries of all of them.
+LibDirEntry = tuple[list[tuple[str, str, str, str]], list[str]]
+
+
+class SonameIndex:
+    """
+    On-disk index of the shared objects in library directories of the Nix
+    store, persisting the result of scanning them across runs.
+
+    Store paths are immutable, so entries never need to be invalidated. Paths
+    which are still writable, like the outputs of the running build, are never
+    added to the index.
+    """
+
+    def __init__(self, path: Optional[Path] = None, store_dir: Optional[str] = None) -> None:
+        self.path = path
+        self.store_dir = Path(store_dir or os.environ.get("NIX_STORE", "/nix/store"))
+        self.entries: dict[str, LibDirEntry] = {}
+        self.changed = False
+
+        if path is None:
+            return
+        try:
+            with path.open() as f:
+                for lib_dir, (libs, rpath) in json.load(f).items():
+                    self.entries[lib_dir] = ([tuple(lib) for lib in libs], rpath)  # type: ignore
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            print(f"warn: auto-patchelf ignoring unreadable index {path}: {e}")
+
+    def is_immutable(self, lib_dir: Path) -> bool:
+        if not lib_dir.is_relative_to(self.store_dir) or lib_dir == self.store_dir:
+            return False
+        store_path = self.store_dir / lib_dir.relative_to(self.store_dir).parts[0]
+        try:
+            # Checking the mode rather than os.access also works as root
+            return not stat.S_IMODE(store_path.stat().st_mode) & 0o222
+        except OSError:
+            return False
+
+    def get(self, lib_dir: Path) -> Optional[LibDirEntry]:
+        if self.path is None:
+            return None
+        return self.entries.get(lib_dir.as_posix())
+
+    def add(self, lib_dir: Path, entry: LibDirEntry) -> None:
+        if self.path is None or not self.is_immutable(lib_dir):
+            return
+        self.entries[lib_dir.as_posix()] = entry
+        self.changed = True
+
+    def save(self) -> None:
+        if self.path is None or not self.changed:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Write atomically, as other builds may use the same index
+            fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.entries, f)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"warn: auto-patchelf could not write index {self.path}: {e}")
+
+
 cached_paths: set[Path] = set()
 soname_cache: DefaultDict[tuple[str, str], list[tuple[Path, str]]] = defaultdict(list)
+soname_index = SonameIndex()
+
+
+def scan_lib_dir(lib_dir: Path, recursive: bool) -> LibDirEntry:
+    libs = []
+    rpaths = []
+
+    for path in glob(lib_dir, "*.so*", recursive):
+        if not path.is_file():
+            continue
+
+        # As an optimisation, resolve the symlinks here, as the target is unique
+        # XXX: (layus, 2022-07-25) is this really an optimisation in all cases ?
+        # It could make the rpath bigger or break the fragile precedence of $out.
+        resolved = path.resolve()
+        # Do not use resolved paths when names do not match
+        if resolved.name != path.name:
+            resolved = path
+
+        try:
+            with open_elf(path) as elf:
+                osabi = get_osabi(elf)
+                arch = get_arch(elf)
+                rpaths += [p for p in get_rpath(elf) if p and '$ORIGIN' not in p]
+                libs.append((path.name, resolved.parent.as_posix(), arch, osabi))
+
+        except ELFError:
+            # Not an ELF file in the right format
+            pass
+
+    return libs, rpaths
 
 
 def populate_cache(initial: list[Path], recursive: bool =False) -> None:
-    lib_dirs = list(initial)
+    lib_dirs = deque(initial)
 
     while lib_dirs:
-        lib_dir = lib_dirs.pop(0)
+        lib_dir = lib_dirs.popleft()
 
         if lib_dir in cached_paths:
             continue
 
         cached_paths.add(lib_dir)
 
-        for path in glob(lib_dir, "*.so*", recursive):
-            if not path.is_file():
-                continue
-
-            # As an optimisation, resolve the symlinks here, as the target is unique
-            # XXX: (layus, 2022-07-25) is this really an optimisation in all cases ?
-            # It could make the rpath bigger or break the fragile precedence of $out.
-            resolved = path.resolve()
-            # Do not use resolved paths when names do not match
-            if resolved.name != path.name:
-                resolved = path
+        # Only library directories are indexed, not the paths to patch
+        entry = None if recursive else soname_index.get(lib_dir)
+        if entry is None:
+            entry = scan_lib_dir(lib_dir, recursive)
+            if not recursive:
+                soname_index.add(lib_dir, entry)
 
-            try:
-                with open_elf(path) as elf:
-                    osabi = get_osabi(elf)
-                    arch = get_arch(elf)
-                    rpath = [Path(p) for p in get_rpath(elf)
-                                     if p and '$ORIGIN' not in p]
-                    lib_dirs += rpath
-                    soname_cache[(path.name, arch)].append((resolved.parent, osabi))
-
-            except ELFError:
-                # Not an ELF file in the right format
-                pass
+        libs, rpath = entry
+        lib_dirs.extend(Path(p) for p in rpath)
+        for name, parent, arch, osabi in libs:
+            soname_cache[(name, arch)].append((Path(parent), osabi))
 
 
 def find_dependency(soname: str, soarch: str, soabi: str) -> Optional[Path]:
@@ -312,6 +404,73 @@ def auto_patchelf_file(path: Path, runtime_deps: list[Path], append_rpaths: list
     return dependencies
 
 
+def init_worker(state: dict) -> None:
+    """Set up the globals of a worker process, for start methods other than fork."""
+    globals().update(state)
+
+
+def auto_patchelf_files(
+        paths: list[Path],
+        runtime_deps: list[Path],
+        append_rpaths: list[Path],
+        keep_libc: bool,
+        extra_args: list[str]) -> list[tuple[str, list[Dependency]]]:
+    """
+    Patch the given files one after the other in a worker process, and return
+    the output and the dependencies of each of them.
+    """
+    results = []
+    for path in paths:
+        output = io.StringIO()
+        with redirect_stdout(output):
+            dependencies = auto_patchelf_file(path, runtime_deps, append_rpaths, keep_libc, extra_args)
+        results.append((output.getvalue(), dependencies))
+    return results
+
+
+def auto_patchelf_parallel(
+        files: list[Path],
+        runtime_deps: list[Path],
+        append_rpaths: list[Path],
+        keep_libc: bool,
+        extra_args: list[str],
+        jobs: int) -> list[Dependency]:
+    # Hard links to the same file must not be patched concurrently, so they
+    # are handed to the same worker, in the order they would be patched in.
+    links: dict[tuple[int, int], list[int]] = {}
+    for i, path in enumerate(files):
+        st = path.stat()
+        links.setdefault((st.st_dev, st.st_ino), []).append(i)
+    batches = list(links.values())
+
+    state = {
+        "interpreter_path": interpreter_path,
+        "interpreter_osabi": interpreter_osabi,
+        "interpreter_arch": interpreter_arch,
+        "libc_lib": libc_lib,
+        "soname_cache": soname_cache,
+    }
+    results: list[Optional[tuple[str, list[Dependency]]]] = [None] * len(files)
+    next_result = 0
+    dependencies = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(state,)) as executor:
+        worker = partial(auto_patchelf_files, runtime_deps=runtime_deps, append_rpaths=append_rpaths,
+                         keep_libc=keep_libc, extra_args=extra_args)
+        batch_results = executor.map(worker, [[files[i] for i in batch] for batch in batches])
+        for batch, batch_result in zip(batches, batch_results):
+            for i, result in zip(batch, batch_result):
+                results[i] = result
+            # Print the output of the files in the order a serial run would
+            # have, as soon as it is available.
+            while next_result < len(files) and (result := results[next_result]) is not None:
+                output, file_dependencies = result
+                print(output, end="")
+                dependencies += file_dependencies
+                results[next_result] = None
+                next_result += 1
+    return dependencies
+
+
 def auto_patchelf(
         paths_to_patch: list[Path],
         lib_dirs: list[Path],
@@ -321,22 +480,33 @@ def auto_patchelf(
         append_rpaths: list[Path] = [],
         keep_libc: bool = False,
         add_existing: bool = True,
-        extra_args: list[str] = []) -> None:
+        extra_args: list[str] = [],
+        index: Optional[Path] = None,
+        jobs: int = 1) -> None:
 
     if not paths_to_patch:
         sys.exit("No paths to patch, stopping.")
 
+    global soname_index
+    soname_index = SonameIndex(index)
+
     # Add all shared objects of the current output path to the cache,
     # before lib_dirs, so that they are chosen first in find_dependency.
     if add_existing:
         populate_cache(paths_to_patch, recursive)
 
     populate_cache(lib_dirs)
+    soname_index.save()
 
-    dependencies = []
-    for path in chain.from_iterable(glob(p, '*', recursive) for p in paths_to_patch):
-        if not path.is_symlink() and path.is_file():
+    files = [path for path in chain.from_iterable(glob(p, '*', recursive) for p in paths_to_patch)
+             if not path.is_symlink() and path.is_file()]
+
+    if jobs == 1 or len(files) <= 1:
+        dependencies = []
+        for path in files:
             dependencies += auto_patchelf_file(path, runtime_deps, append_rpaths, keep_libc, extra_args)
+    else:
+        dependencies = auto_patchelf_parallel(files, runtime_deps, append_rpaths, keep_libc, extra_args, jobs)
 
     missing = [dep for dep in dependencies if not dep.found]
 
@@ -422,6 +592,21 @@ def main() -> None:
         action="store_false",
         help="Do not add the existing rpaths of the patched files to the list of directories to search for dependencies.",
     )
+    parser.add_argument(
+        "--index",
+        type=Path,
+        default=None,
+        help="File to keep an index of the libraries found in the Nix store in,"
+             " so they don't have to be scanned again by later runs.",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of files to analyse and patch in parallel, 0 for one per CPU."
+             " The output is the same as with a single job.",
+    )
     parser.add_argument(
         "--extra-args",
         # Undocumented Python argparse feature: consume all remaining arguments
@@ -446,7 +631,9 @@ def main() -> None:
         append_rpaths=args.append_rpaths,
         keep_libc=args.keep_libc,
         add_existing=args.add_existing,
-        extra_args=args.extra_args)
+        extra_args=args.extra_args,
+        index=args.index,
+        jobs=args.jobs or os.cpu_count() or 1)
 
 
 interpreter_path: Path  = None # type: ignore
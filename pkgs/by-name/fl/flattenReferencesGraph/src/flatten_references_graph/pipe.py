@@ -4,6 +4,7 @@ from toolz import curry
 from . import lib as lib
 from . import subcomponent as subcomponent
 from .popularity_contest import popularity_contest
+from .share_layers import share_layers
 from .split_paths import split_paths
 
 from .lib import (
@@ -34,6 +35,7 @@ funcs = tlz.merge(
     {
         "split_paths": split_paths,
         "popularity_contest": popularity_contest,
+        "share_layers": share_layers,
         "map": tlz.map
     }
 )
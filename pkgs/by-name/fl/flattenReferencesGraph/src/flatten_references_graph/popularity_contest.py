@@ -104,6 +104,28 @@
 # Layers are inherently ordered. However, this is not true -- Docker
 # layers are content-addressable and are not explicitly layered until
 # they are composed in to an Image.
+#
+# Duplicating the nodes makes the tree exponentially large in the worst
+# case, and merging the counters takes time proportional to the number
+# of paths times the number of references. popularity_counts computes
+# the same counts without building the tree, by unrolling the merging:
+# each time a node is merged, its own counter and the counter of each
+# of its (transitive) references are incremented by one. A node is
+# merged once for each distinct route from a root to it, so the
+# popularity of a path is the number of routes to it, plus the number
+# of routes to each of the paths which (transitively) refer to it:
+#
+#     path  routes  referred to by         popularity
+#     A     1                              1
+#     B     1       A                      1 + 1 = 2
+#     C     1       A B                    1 + 1 + 1 = 3
+#     D     1       A B C                  1 + 1 + 1 + 1 = 4
+#     E     2       A B C                  2 + 1 + 1 + 1 = 5
+#     F     3       A B C D E              3 + 1 + 1 + 1 + 1 + 2 = 9
+#     G     1       A                      1 + 1 = 2
+#
+# The routes are counted in topological order, summing up those of the
+# referrers of each path, and the referrers are collected as bitsets.
 
 import igraph as igraph
 
@@ -113,6 +135,7 @@ from toolz import curried as tlz
 from toolz import curry
 
 from .lib import (
+    DEBUG,
     debug,
     directed_graph,
     igraph_to_reference_graph,
@@ -219,12 +242,12 @@ def make_graph_segment_from_root(subgraphs_cache, root, lookup):
         # Python's assignment will use a pointer, preventing memory
         # bloat for large graphs.
         if ref not in subgraphs_cache:
-            debug("Subgraph Cache miss on {}".format(ref))
+            debug("Subgraph Cache miss on", ref)
             subgraphs_cache[ref] = make_graph_segment_from_root(
                 subgraphs_cache, ref, lookup
             )
         else:
-            debug("Subgraph Cache hit on {}".format(ref))
+            debug("Subgraph Cache hit on", ref)
         children[ref] = subgraphs_cache[ref]
     return children
 
@@ -273,11 +296,89 @@ def graph_popularity_contest(popularity_cache, full_graph):
 
         subcontest = popularity_cache[path]
         for subpath, subpopularity in subcontest.items():
-            debug("Calculating popularity for", subpath)
+            if DEBUG:
+                debug("Calculating popularity for", subpath)
             popularity[subpath] += subpopularity + 1
 
     return popularity
 
+
+# Iterate over the indices of the bits set in an integer, in descending
+# order.
+def set_bits(bitset):
+    digits = bin(bitset)
+    last = len(digits) - 1
+    i = digits.find("1", 2)
+    while i != -1:
+        yield last - i
+        i = digits.find("1", i + 1)
+
+
+# Compute the same popularity as graph_popularity_contest does for the
+# graph segments of all the roots of an igraph directed graph, without
+# building them (see the comment at the top of the file).
+#
+# From the graph:
+#
+#   /nix/store/foo -> /nix/store/bar -> /nix/store/baz -> /nix/store/tux
+#                  -> /nix/store/baz
+#
+# to:
+# {
+#   /nix/store/foo: 1
+#   /nix/store/bar: 2
+#   /nix/store/baz: 4
+#   /nix/store/tux: 6
+# }
+def popularity_counts(graph):
+    # Like make_lookup, ignore self references, and like the dicts of
+    # make_graph_segment_from_root, references which appear twice.
+    graph = graph.copy()
+    graph.simplify(multiple=True, loops=True)
+
+    if not graph.is_dag():
+        raise ValueError("Cannot run popularity contest on a cyclic graph")
+    order = graph.topological_sorting(mode="out")
+
+    # All arrays below are indexed by the position in the topological order.
+    position = [0] * len(order)
+    for index, vertex in enumerate(order):
+        position[vertex] = index
+    in_adjlist = graph.get_adjlist(mode="in")
+    parents = [
+        [position[parent] for parent in in_adjlist[vertex]]
+        for vertex in order
+    ]
+    # How many references of a path haven't been processed yet. Once they
+    # all are, the bitset of its referrers isn't needed anymore.
+    outdegree = graph.outdegree()
+    pending = [outdegree[vertex] for vertex in order]
+    routes = [0] * len(order)
+    referrers = [0] * len(order)
+    names = graph.vs["name"] if len(order) > 0 else []
+
+    popularity = {}
+    for index in range(len(order)):
+        # Roots are reached once, by the contest itself.
+        routes[index] = sum(routes[parent] for parent in parents[index]) or 1
+        bitset = 0
+        for parent in parents[index]:
+            bitset |= referrers[parent] | (1 << parent)
+            pending[parent] -= 1
+            if pending[parent] == 0:
+                referrers[parent] = 0
+        if pending[index] > 0:
+            referrers[index] = bitset
+
+        name = names[order[index]]
+        popularity[name] = routes[index] + sum(
+            routes[referrer] for referrer in set_bits(bitset)
+        )
+        if DEBUG:
+            debug("Popularity of", name, "is", popularity[name])
+
+    return popularity
+
 # Emit a list of packages by popularity, most first:
 #
 # From:
@@ -347,6 +448,65 @@ def popularity_contest(graph):
     # copied as vertex attributes.
     debug('graph', graph)
 
+    if isinstance(graph, igraph.Graph):
+        reference_graph = igraph_to_reference_graph(graph)
+    else:
+        reference_graph = graph
+        graph = reference_graph_to_igraph(reference_graph)
+
+    ordered = popularity_order(graph)
+
+    vertex_attrs = {
+        node["path"]: pick_keys_to_keep(node) for node in reference_graph
+    }
+
+    return map(
+        # Turn each path into a graph with 1 vertex.
+        lambda path: directed_graph(
+            # No edges
+            [],
+            # One vertex, with name=path
+            [path],
+            # Setting desired attributes on the vertex.
+            [(path, vertex_attrs[path])]
+        ),
+        ordered
+    )
+
+
+# Order the paths of an igraph directed graph by popularity, most first.
+def popularity_order(graph):
+    debug("Running contest")
+    contest = popularity_counts(graph)
+
+    debug("Ordering by popularity")
+    return order_by_popularity(contest)
+
+
+# Convert a references graph in the format produced by nix's
+# exportReferencesGraph in to an igraph directed graph, with the paths
+# as vertex names. Unlike lib.references_graph_to_igraph, this doesn't
+# need narSize and keeps the order of the paths.
+def reference_graph_to_igraph(reference_graph):
+    names = list(tlz.unique(node["path"] for node in reference_graph))
+    indices = {name: index for index, name in enumerate(names)}
+    graph = igraph.Graph(
+        n=len(names),
+        edges=[
+            (indices[node["path"]], indices[reference])
+            for node in reference_graph
+            for reference in node["references"]
+        ],
+        directed=True
+    )
+    graph.vs["name"] = names
+    return graph
+
+
+# Order the paths of a graph by popularity like popularity_order, as it was
+# implemented before popularity_counts: by building the graph segments of
+# all roots. This is kept to check popularity_counts against it.
+def recursive_popularity_order(graph):
     if isinstance(graph, igraph.Graph):
         graph = igraph_to_reference_graph(graph)
 
@@ -384,15 +544,4 @@ def popularity_contest(graph):
 
     ordered.extend(missing)
 
-    return map(
-        # Turn each path into a graph with 1 vertex.
-        lambda path: directed_graph(
-            # No edges
-            [],
-            # One vertex, with name=path
-            [path],
-            # Setting desired attributes on the vertex.
-            [(path, pick_keys_to_keep(lookup[path]))]
-        ),
-        ordered
-    )
+    return ordered
@@ -0,0 +1,95 @@
+# Benchmark popularity_order against recursive_popularity_order, the
+# implementation it replaced, on synthetic closures, and check that both
+# order the paths exactly the same.
+#
+# Run from the src dir with:
+#
+#   python -m flatten_references_graph.popularity_contest_benchmark
+#
+# The recursive implementation takes time quadratic in the number of paths
+# (finding the roots alone compares every path with every other one), so it
+# is only run up to --max-recursive-size paths.
+
+import argparse
+import random
+import time
+
+from .popularity_contest import (
+    popularity_order,
+    recursive_popularity_order,
+    reference_graph_to_igraph
+)
+
+
+# Make a closure shaped roughly like the ones of real images: every path
+# references a few other paths, preferably popular ones (like glibc) which
+# were created before it, and often itself.
+def make_closure(size, seed=0):
+    rng = random.Random(seed)
+    paths = [
+        "/nix/store/{:032x}-package-{}".format(rng.getrandbits(128), index)
+        for index in range(size)
+    ]
+
+    closure = []
+    for index, path in enumerate(paths):
+        references = set()
+        if index > 0:
+            for _ in range(rng.randint(0, 6)):
+                # Bias towards the first paths, which are referenced a lot.
+                references.add(paths[int(index * rng.random() ** 3)])
+        if rng.random() < 0.5:
+            references.add(path)
+        closure.append({
+            "path": path,
+            "references": sorted(references),
+            "narSize": rng.randint(1, 10**6),
+            "closureSize": rng.randint(1, 10**8),
+        })
+
+    rng.shuffle(closure)
+    return closure
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 5000, 10000, 50000]
+    )
+    parser.add_argument("--max-recursive-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    print("{:>8} {:>12} {:>12}".format("paths", "recursive", "counts"))
+    for size in args.sizes:
+        closure = make_closure(size)
+
+        result, counts_time = timed(
+            popularity_order, reference_graph_to_igraph(closure)
+        )
+
+        if size > args.max_recursive_size:
+            print("{:>8} {:>12} {:>11.2f}s".format(size, "-", counts_time))
+            continue
+
+        expected, recursive_time = timed(recursive_popularity_order, closure)
+        if result != expected:
+            raise SystemExit(
+                "popularity_order differs from recursive_popularity_order"
+                " for {} paths".format(size)
+            )
+        print("{:>8} {:>11.2f}s {:>11.2f}s".format(
+            size, recursive_time, counts_time
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -12,9 +12,15 @@ from .popularity_contest import (
     make_graph_segment_from_root,
     make_lookup,
     popularity_contest,
-    order_by_popularity
+    popularity_counts,
+    popularity_order,
+    order_by_popularity,
+    recursive_popularity_order,
+    reference_graph_to_igraph
 )
 
+from .popularity_contest_benchmark import make_closure
+
 from .lib import (
     directed_graph,
     igraph_to_reference_graph,
@@ -317,6 +323,56 @@ class TestGraphPopularityContest(unittest.TestCase):
         )
 
 
+class TestPopularityCounts(unittest.TestCase):
+    def test_counts_popularity(self):
+        # The example from the top of popularity_contest.py
+        self.assertDictEqual(
+            popularity_counts(directed_graph([
+                ("A", "B"),
+                ("A", "G"),
+                ("B", "C"),
+                ("B", "E"),
+                ("C", "D"),
+                ("C", "E"),
+                ("D", "F"),
+                ("E", "F"),
+            ])),
+            {"A": 1, "B": 2, "C": 3, "D": 4, "E": 5, "F": 9, "G": 2}
+        )
+
+    def test_ignores_self_references_and_duplicates(self):
+        self.assertDictEqual(
+            popularity_counts(directed_graph([
+                ("/nix/store/foo", "/nix/store/foo"),
+                ("/nix/store/foo", "/nix/store/bar"),
+                ("/nix/store/foo", "/nix/store/bar"),
+                ("/nix/store/foo", "/nix/store/baz"),
+                ("/nix/store/bar", "/nix/store/baz"),
+                ("/nix/store/baz", "/nix/store/tux"),
+            ])),
+            {
+                "/nix/store/foo": 1,
+                "/nix/store/bar": 2,
+                "/nix/store/baz": 4,
+                "/nix/store/tux": 6,
+            }
+        )
+
+    def test_rejects_cycles(self):
+        with self.assertRaises(ValueError):
+            popularity_counts(directed_graph([("A", "B"), ("B", "A")]))
+
+
+class TestPopularityOrder(unittest.TestCase):
+    def test_same_as_recursive(self):
+        for seed in range(5):
+            closure = make_closure(300, seed)
+            self.assertListEqual(
+                popularity_order(reference_graph_to_igraph(closure)),
+                recursive_popularity_order(closure)
+            )
+
+
 class TestOrderByPopularity(unittest.TestCase):
     def test_returns_in_order(self):
         self.assertEqual(
@@ -0,0 +1,173 @@
+# Assign the store paths of an image to layers so that as many bytes as
+# possible end up in layers which are identical in other images.
+#
+# Layers are content-addressed, so a layer built for one image is only
+# stored and pulled once if another image has a layer with exactly the same
+# store paths. The other pipeline functions decide the layers of an image
+# by looking at its graph only, and two images with overlapping closures
+# will rarely end up with the same layer unless it contains a single path.
+#
+# share_layers is given the reference graphs (as produced by nix's
+# exportReferencesGraph) of all the images which should share layers, and
+# the maximum number of layers per image. Every image computes the same
+# assignment from them:
+#
+# Store paths are grouped by the set of images which contain them. Each
+# group can become a layer that is shared by exactly those images, saving
+# the size of the group times the number of images containing it minus
+# one. The groups are chosen as layers, most saved bytes first, as long as
+# every image containing the group has a layer left for it, keeping one
+# layer in each image for the paths of the groups that weren't chosen.
+#
+# The remaining paths of an image are then split in to the layers it has
+# left, such that their sizes are as balanced as possible.
+#
+# For the image being built, the chosen groups it contains become layers,
+# followed by the layers of its remaining paths. The image should be one
+# of the reference graphs, otherwise only the groups it contains entirely
+# can be shared.
+
+import sys
+
+from collections import defaultdict
+from toolz import curry
+
+from .lib import (
+    debug,
+    graph_is_empty
+)
+
+
+# Group the paths of the reference graphs by the indices of the graphs which
+# contain them:
+#
+# {
+#   (0, 1): [/nix/store/glibc, /nix/store/bash],
+#   (1,): [/nix/store/hello]
+# }
+def group_by_images(reference_graphs):
+    images_by_path = defaultdict(list)
+    for (image, reference_graph) in enumerate(reference_graphs):
+        for path in sorted({node["path"] for node in reference_graph}):
+            images_by_path[path].append(image)
+
+    groups = defaultdict(list)
+    for path, images in images_by_path.items():
+        groups[tuple(images)].append(path)
+    return groups
+
+
+def path_sizes(reference_graphs):
+    return {
+        node["path"]: node.get("narSize") or 0
+        for reference_graph in reference_graphs
+        for node in reference_graph
+    }
+
+
+# Choose the groups which become shared layers, see the top of the file.
+# Returns the list of (images, paths) tuples of the chosen groups, in
+# order of their saved bytes.
+def choose_shared_groups(groups, sizes, image_count, max_layers):
+    def saved_bytes(item):
+        images, paths = item
+        return sum(sizes[path] for path in paths) * (len(images) - 1)
+
+    candidates = sorted(
+        (item for item in groups.items() if len(item[0]) > 1),
+        # Break ties deterministically, the result must not depend on the
+        # order of the groups.
+        key=lambda item: (-saved_bytes(item), item[0], item[1])
+    )
+
+    # One layer of every image is kept for the paths which aren't shared.
+    layers_left = [max_layers - 1] * image_count
+    chosen = []
+    for images, paths in candidates:
+        if all(layers_left[image] > 0 for image in images):
+            for image in images:
+                layers_left[image] -= 1
+            chosen.append((images, paths))
+    return chosen
+
+
+# Split paths in to at most layer_count lists with sizes as balanced as
+# possible, by adding the largest remaining path to the smallest list.
+def balance_paths(paths, sizes, layer_count):
+    layers = [[] for _ in range(min(layer_count, len(paths)))]
+    layer_sizes = [0] * len(layers)
+    for path in sorted(paths, key=lambda path: (-sizes.get(path, 0), path)):
+        smallest = layer_sizes.index(min(layer_sizes))
+        layers[smallest].append(path)
+        layer_sizes[smallest] += sizes.get(path, 0)
+    return layers
+
+
+# Compute the total size of all images, and the size of the distinct layers
+# they are made of.
+def expected_sizes(reference_graphs, chosen, sizes):
+    shared_paths = {path for _, paths in chosen for path in paths}
+    total = 0
+    stored = sum(sizes[path] for path in shared_paths)
+    for reference_graph in reference_graphs:
+        for path in {node["path"] for node in reference_graph}:
+            total += sizes[path]
+            # Layers with the paths that aren't shared are stored for every
+            # image.
+            if path not in shared_paths:
+                stored += sizes[path]
+    return total, stored
+
+
+@curry
+def share_layers(reference_graphs, max_layers, graph):
+    assert max_layers > 0, "max layers needs to > 0"
+
+    sizes = path_sizes(reference_graphs)
+    groups = group_by_images(reference_graphs)
+    chosen = choose_shared_groups(
+        groups, sizes, len(reference_graphs), max_layers
+    )
+
+    total, stored = expected_sizes(reference_graphs, chosen, sizes)
+    print(
+        "share_layers: {} images with {} bytes are expected to be stored in"
+        " {} bytes, using {} shared layers (dedup ratio {:.2f})".format(
+            len(reference_graphs),
+            total,
+            stored,
+            len(chosen),
+            total / max(stored, 1)
+        ),
+        file=sys.stderr
+    )
+
+    if graph_is_empty(graph):
+        return []
+
+    indices = {v["name"]: v.index for v in graph.vs}
+    if "narSize" in graph.vs.attributes():
+        sizes.update(
+            (v["name"], v["narSize"]) for v in graph.vs
+            if v["narSize"] is not None
+        )
+
+    shared_layers = [
+        paths for _, paths in chosen
+        if all(path in indices for path in paths)
+    ][:max_layers - 1]
+    debug("shared layers", shared_layers)
+
+    shared_paths = {path for paths in shared_layers for path in paths}
+    remaining_paths = [
+        path for path in indices if path not in shared_paths
+    ]
+    remaining_layers = balance_paths(
+        remaining_paths, sizes, max_layers - len(shared_layers)
+    )
+    debug("remaining layers", remaining_layers)
+
+    return [
+        graph.induced_subgraph(sorted(indices[path] for path in paths))
+        for paths in shared_layers + remaining_layers
+    ]
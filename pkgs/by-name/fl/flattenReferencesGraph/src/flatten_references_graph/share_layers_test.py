@@ -0,0 +1,161 @@
+import unittest
+
+from .lib import (
+    directed_graph,
+    igraph_to_reference_graph
+)
+
+from .pipe import pipe
+
+from .share_layers import (
+    balance_paths,
+    choose_shared_groups,
+    expected_sizes,
+    group_by_images,
+    share_layers
+)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+def make_image(root, paths, sizes):
+    return directed_graph(
+        [(root, path) for path in paths],
+        None,
+        [(path, {"narSize": sizes[path]}) for path in [root, *paths]]
+    )
+
+
+SIZES = {
+    "app1": 1,
+    "app2": 1,
+    "app3": 1,
+    "glibc": 100,
+    "python": 50,
+    "openssl": 20,
+    "curl": 5,
+}
+
+IMAGES = [
+    make_image("app1", ["glibc", "python", "openssl"], SIZES),
+    make_image("app2", ["glibc", "python", "curl"], SIZES),
+    make_image("app3", ["glibc", "openssl", "curl"], SIZES),
+]
+
+REFERENCE_GRAPHS = list(map(igraph_to_reference_graph, IMAGES))
+
+
+def layer_names(layers):
+    return [sorted(layer.vs["name"]) for layer in layers]
+
+
+class TestGroupByImages(unittest.TestCase):
+    def test_groups_paths_by_images(self):
+        self.assertDictEqual(
+            dict(group_by_images(REFERENCE_GRAPHS)),
+            {
+                (0,): ["app1"],
+                (1,): ["app2"],
+                (2,): ["app3"],
+                (0, 1, 2): ["glibc"],
+                (0, 1): ["python"],
+                (0, 2): ["openssl"],
+                (1, 2): ["curl"],
+            }
+        )
+
+
+class TestChooseSharedGroups(unittest.TestCase):
+    def test_most_saved_bytes_first(self):
+        self.assertListEqual(
+            choose_shared_groups(
+                group_by_images(REFERENCE_GRAPHS), SIZES, 3, 10
+            ),
+            [
+                ((0, 1, 2), ["glibc"]),
+                ((0, 1), ["python"]),
+                ((0, 2), ["openssl"]),
+                ((1, 2), ["curl"]),
+            ]
+        )
+
+    def test_keeps_a_layer_for_remaining_paths(self):
+        # glibc uses the only layer available for sharing in every image.
+        self.assertListEqual(
+            choose_shared_groups(
+                group_by_images(REFERENCE_GRAPHS), SIZES, 3, 2
+            ),
+            [((0, 1, 2), ["glibc"])]
+        )
+
+
+class TestBalancePaths(unittest.TestCase):
+    def test_balances_sizes(self):
+        self.assertListEqual(
+            balance_paths(
+                ["a", "b", "c", "d"],
+                {"a": 5, "b": 4, "c": 3, "d": 2},
+                2
+            ),
+            [["a", "d"], ["b", "c"]]
+        )
+
+    def test_no_empty_layers(self):
+        self.assertListEqual(
+            balance_paths(["a"], {"a": 5}, 3),
+            [["a"]]
+        )
+
+
+class TestExpectedSizes(unittest.TestCase):
+    def test_shared_paths_are_stored_once(self):
+        chosen = [((0, 1, 2), ["glibc"])]
+        total, stored = expected_sizes(REFERENCE_GRAPHS, chosen, SIZES)
+        self.assertEqual(total, 3 + 300 + 100 + 40 + 10)
+        self.assertEqual(stored, 3 + 100 + 100 + 40 + 10)
+
+
+class TestShareLayers(unittest.TestCase):
+    def test_identical_layers_across_images(self):
+        layers = [
+            layer_names(share_layers(REFERENCE_GRAPHS, 3, image))
+            for image in IMAGES
+        ]
+
+        self.assertListEqual(
+            layers,
+            [
+                [["glibc"], ["python"], ["app1", "openssl"]],
+                [["glibc"], ["python"], ["app2", "curl"]],
+                [["glibc"], ["openssl"], ["app3", "curl"]],
+            ]
+        )
+
+    def test_every_path_in_one_layer(self):
+        for max_layers in range(1, 6):
+            for image in IMAGES:
+                layers = layer_names(
+                    share_layers(REFERENCE_GRAPHS, max_layers, image)
+                )
+                self.assertLessEqual(len(layers), max_layers)
+                self.assertCountEqual(
+                    [path for layer in layers for path in layer],
+                    image.vs["name"]
+                )
+
+    def test_empty_graph(self):
+        self.assertListEqual(
+            share_layers(REFERENCE_GRAPHS, 3, directed_graph([])),
+            []
+        )
+
+    def test_pipe(self):
+        self.assertListEqual(
+            layer_names(pipe(
+                [["share_layers", REFERENCE_GRAPHS, 2]],
+                IMAGES[0]
+            )),
+            [["glibc"], ["app1", "openssl", "python"]]
+        )
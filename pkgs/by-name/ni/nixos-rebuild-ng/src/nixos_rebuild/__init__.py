@@ -1,13 +1,14 @@
 import argparse
+import hashlib
 import json
 import logging
 import os
 import sys
 from pathlib import Path
 from subprocess import CalledProcessError, run
-from typing import assert_never
+from typing import Final, assert_never
 
-from . import nix, tmpdir
+from . import cache, fleet, nix, timings, tmpdir
 from .constants import EXECUTABLE, WITH_NIX_2_18, WITH_REEXEC, WITH_SHELL_FILES
 from .models import Action, BuildAttr, Flake, ImageVariants, NRError, Profile
 from .process import Remote, cleanup_ssh
@@ -16,6 +17,10 @@ from .utils import Args, LogFormatter, tabulate
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+REEXEC_CACHE: Final = "reexec-v1.json"
+# Number of nixos-rebuild builds to remember for re-exec
+REEXEC_CACHE_SIZE: Final = 10
+
 
 def get_parser() -> tuple[argparse.ArgumentParser, dict[str, argparse.ArgumentParser]]:
     common_flags = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
@@ -180,6 +185,42 @@ def get_parser() -> tuple[argparse.ArgumentParser, dict[str, argparse.ArgumentPa
     main_parser.add_argument(
         "--target-host", help="Specifies host to activate the configuration"
     )
+    main_parser.add_argument(
+        "--target-hosts",
+        type=lambda hosts: list(dict.fromkeys(h for h in hosts.split(",") if h)),
+        help="Comma-separated list of hosts to activate the configuration "
+        + "concurrently (fleet mode)",
+    )
+    main_parser.add_argument(
+        "--fleet-jobs",
+        type=int,
+        default=8,
+        help="Maximum number of hosts to deploy at the same time in fleet mode",
+    )
+    main_parser.add_argument(
+        "--fleet-max-failures",
+        type=float,
+        default=0.0,
+        help="Fraction of hosts allowed to fail before fleet mode stops "
+        + "deploying to the remaining hosts",
+    )
+    main_parser.add_argument(
+        "--fleet-copy",
+        choices=fleet.COPY_MODES,
+        default="direct",
+        help="How to distribute the closure in fleet mode: each host from the "
+        + "local machine or build host (direct), or from the hosts that already "
+        + "received it (chain, tree). chain and tree run `nix copy --from ssh://` "
+        + "on the hosts, so they need to reach each other via SSH, and the user "
+        + "(root with --sudo) to be trusted by the Nix daemon or the paths to be "
+        + "signed",
+    )
+    main_parser.add_argument(
+        "--timings",
+        type=Path,
+        help="Write the timings of each phase and command to the given file, "
+        + "in Chrome's Trace Event Format",
+    )
     main_parser.add_argument("--no-build-nix", action="store_true", help="Deprecated")
     main_parser.add_argument(
         "--image-variant",
@@ -258,17 +299,76 @@ def parse_args(
         Action.DRY_ACTIVATE.value,
         Action.BUILD_VM.value,
         Action.BUILD_VM_WITH_BOOTLOADER.value,
+        Action.LIST_GENERATIONS.value,
     ):
         parser.error(
             f"--target-host/--build-host is not supported with '{args.action}'"
         )
 
+    if args.build_host and args.action == Action.LIST_GENERATIONS.value:
+        parser.error("--build-host is not supported with 'list-generations'")
+
     if args.flake and (args.file or args.attr):
         parser.error("--flake cannot be used with --file or --attr")
 
+    if args.target_hosts is not None:
+        if not args.target_hosts:
+            parser.error("--target-hosts needs at least one host")
+        if args.target_host:
+            parser.error("--target-hosts cannot be used with --target-host")
+        if args.rollback:
+            parser.error("--target-hosts cannot be used with --rollback")
+        if args.action not in (
+            Action.SWITCH.value,
+            Action.BOOT.value,
+            Action.TEST.value,
+            Action.DRY_ACTIVATE.value,
+        ):
+            parser.error(f"--target-hosts is not supported with '{args.action}'")
+
+    if args.fleet_jobs < 1:
+        parser.error("--fleet-jobs needs to be at least 1")
+
+    if not 0 <= args.fleet_max_failures <= 1:
+        parser.error("--fleet-max-failures needs to be between 0 and 1")
+
     return args, args_groups
 
 
+def get_reexec_cache_key(
+    flake: Flake | None,
+    build_attr: BuildAttr,
+    build_flags: Args,
+    flake_build_flags: Args,
+) -> str | None:
+    """Get a key that identifies the nixos-rebuild that `reexec()` builds.
+
+    It is based on the flake lock file, or the Nixpkgs revision without
+    flakes, plus the attribute and flags used to build it. Returns None if
+    it can not be determined, e.g.: remote flakes, a configuration file
+    passed with `--file` or a Nixpkgs checkout with uncommitted changes.
+    """
+    if flake:
+        source = nix.get_flake_lock_hash(flake)
+        key = [source, str(flake), flake_build_flags]
+    elif build_attr.path == "<nixpkgs/nixos>":
+        nixpkgs_path = nix.find_file("nixpkgs", build_flags)
+        if nixpkgs_path and nixpkgs_path.resolve().is_relative_to("/nix/store"):
+            # Channels are immutable store paths
+            source = str(nixpkgs_path.resolve())
+        elif (rev := nix.get_nixpkgs_rev(nixpkgs_path)) and not rev.endswith("M"):
+            source = rev
+        else:
+            source = None
+        key = [source, build_flags]
+    else:
+        return None
+
+    if source is None:
+        return None
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
 def reexec(
     argv: list[str],
     args: argparse.Namespace,
@@ -277,22 +377,54 @@ def reexec(
 ) -> None:
     drv = None
     attr = "config.system.build.nixos-rebuild"
+    # GC roots that keep the cached builds of nixos-rebuild alive
+    gcroots = cache.get_cache_dir() / "reexec"
     try:
-        # Parsing the args here but ignore ask_sudo_password since it is not
-        # needed and we would end up asking sudo password twice
-        if flake := Flake.from_arg(args.flake, Remote.from_arg(args.target_host, None)):
-            drv = nix.build_flake(
-                attr,
-                flake,
-                flake_build_flags | {"no_link": True},
-            )
-        else:
+        with timings.phase("reexec") as event:
+            # Parsing the args here but ignore ask_sudo_password since it is
+            # not needed and we would end up asking sudo password twice
+            target_host = Remote.from_arg(args.target_host, None)
+            flake = Flake.from_arg(args.flake, target_host)
             build_attr = BuildAttr.from_arg(args.attr, args.file)
-            drv = nix.build(
-                attr,
-                build_attr,
-                build_flags | {"no_out_link": True},
+            key = get_reexec_cache_key(
+                flake, build_attr, build_flags, flake_build_flags
             )
+            entries = cache.load(REEXEC_CACHE) if key else {}
+            cached = entries.get(key) if key else None
+
+            if key and cached and Path(cached).exists():
+                logger.debug("using cached nixos-rebuild %s", cached)
+                event["cached"] = True
+                drv = Path(cached)
+                if not (gcroots / key).is_symlink():
+                    try:
+                        nix.add_gcroot(drv, gcroots / key)
+                    except CalledProcessError:
+                        logger.debug("could not add GC root", exc_info=True)
+            else:
+                link_flags: Args
+                if key:
+                    gcroots.mkdir(parents=True, exist_ok=True)
+                    link_flags = {"out_link": str(gcroots / key)}
+                elif flake:
+                    link_flags = {"no_link": True}
+                else:
+                    link_flags = {"no_out_link": True}
+
+                if flake:
+                    drv = nix.build_flake(attr, flake, flake_build_flags | link_flags)
+                else:
+                    drv = nix.build(attr, build_attr, build_flags | link_flags)
+
+            if key:
+                # Most recently used last, so the oldest entries are pruned
+                entries.pop(key, None)
+                entries[key] = str(drv)
+                keys = list(entries)
+                for old_key in keys[:-REEXEC_CACHE_SIZE]:
+                    del entries[old_key]
+                    (gcroots / old_key).unlink(missing_ok=True)
+                cache.save(REEXEC_CACHE, entries)
     except CalledProcessError:
         logger.warning(
             "could not build a newer version of nixos-rebuild, using current version"
@@ -311,6 +443,8 @@ def reexec(
             # the process immediately
             cleanup_ssh()
             tmpdir.TMPDIR.cleanup()
+            # The new process will continue the trace from where we are
+            timings.write()
             try:
                 os.execve(new, argv, os.environ | {"_NIXOS_REBUILD_REEXEC": "1"})
             except Exception:
@@ -330,6 +464,9 @@ def reexec(
 def execute(argv: list[str]) -> None:
     args, args_groups = parse_args(argv)
 
+    if args.timings:
+        timings.enable(args.timings)
+
     if not WITH_NIX_2_18:
         logger.warning("you're using Nix <2.18, some features will not work correctly")
 
@@ -341,7 +478,8 @@ def execute(argv: list[str]) -> None:
     copy_flags = common_flags | vars(args_groups["copy_flags"])
 
     if args.upgrade or args.upgrade_all:
-        nix.upgrade_channels(bool(args.upgrade_all))
+        with timings.phase("upgrade_channels"):
+            nix.upgrade_channels(bool(args.upgrade_all))
 
     action = Action(args.action)
     # Only run shell scripts from the Nixpkgs tree if the action is
@@ -421,10 +559,95 @@ def execute(argv: list[str]) -> None:
                 case _:
                     attr = "config.system.build.toplevel"
 
-            match (action, rollback, build_host, flake):
-                case (Action.SWITCH | Action.BOOT, True, _, _):
+            def build_system(flake: Flake | None, build_host: Remote | None) -> Path:
+                match (build_host, flake):
+                    case (Remote(_), Flake(_)):
+                        return nix.build_remote_flake(
+                            attr,
+                            flake,
+                            build_host,
+                            eval_flags=flake_common_flags,
+                            flake_build_flags=flake_build_flags
+                            | {"no_link": no_link, "dry_run": dry_run},
+                            copy_flags=copy_flags,
+                        )
+                    case (None, Flake(_)):
+                        return nix.build_flake(
+                            attr,
+                            flake,
+                            flake_build_flags=flake_build_flags
+                            | {"no_link": no_link, "dry_run": dry_run},
+                        )
+                    case (Remote(_), None):
+                        return nix.build_remote(
+                            attr,
+                            build_attr,
+                            build_host,
+                            realise_flags=common_flags,
+                            instantiate_flags=build_flags,
+                            copy_flags=copy_flags,
+                        )
+                    case (None, None):
+                        return nix.build(
+                            attr,
+                            build_attr,
+                            build_flags=build_flags
+                            | {"no_out_link": no_link, "dry_run": dry_run},
+                        )
+                    case never:
+                        # should never happen, but mypy is not smart enough to
+                        # handle this with assert_never
+                        # https://github.com/python/mypy/issues/16650
+                        # https://github.com/python/mypy/issues/16722
+                        raise AssertionError(
+                            f"expected code to be unreachable, but got: {never}"
+                        )
+
+            if args.target_hosts:
+                assert action in (
+                    Action.SWITCH,
+                    Action.BOOT,
+                    Action.TEST,
+                    Action.DRY_ACTIVATE,
+                ), f"unexpected action for --target-hosts: {action}"
+                remotes = fleet.get_remotes(args.target_hosts, args.ask_sudo_password)
+                # Hosts share a build when they resolve to the same flake
+                # attribute (or always, without flakes)
+                groups = fleet.group_by_configuration(
+                    remotes,
+                    lambda remote: Flake.from_arg(args.flake, remote),
+                    args.fleet_jobs,
+                )
+                fleet_hosts: list[fleet.FleetHost] = []
+                for fleet_flake, group in groups.items():
+                    logger.info(
+                        "building the system configuration for %s...",
+                        ", ".join(r.host for r in group),
+                    )
+                    with timings.phase("build", flake=fleet_flake):
+                        path = build_system(fleet_flake, build_host)
+                    fleet_hosts.extend(fleet.FleetHost(r, path) for r in group)
+
+                results = fleet.deploy(
+                    fleet_hosts,
+                    action,
+                    profile,
+                    build_host=build_host,
+                    copy_flags=copy_flags,
+                    sudo=args.sudo,
+                    specialisation=args.specialisation,
+                    install_bootloader=args.install_bootloader,
+                    jobs=args.fleet_jobs,
+                    max_failures=args.fleet_max_failures,
+                    copy_mode=args.fleet_copy,
+                )
+                fleet.print_summary(results)
+                return
+
+            match (action, rollback):
+                case (Action.SWITCH | Action.BOOT, True):
                     path_to_config = nix.rollback(profile, target_host, sudo=args.sudo)
-                case (Action.TEST | Action.BUILD, True, _, _):
+                case (Action.TEST | Action.BUILD, True):
                     maybe_path_to_config = nix.rollback_temporary_profile(
                         profile,
                         target_host,
@@ -434,64 +657,28 @@ def execute(argv: list[str]) -> None:
                         path_to_config = maybe_path_to_config
                     else:
                         raise NRError("could not find previous generation")
-                case (_, True, _, _):
+                case (_, True):
                     raise NRError(f"--rollback is incompatible with '{action}'")
-                case (_, False, Remote(_), Flake(_)):
-                    path_to_config = nix.build_remote_flake(
-                        attr,
-                        flake,
-                        build_host,
-                        eval_flags=flake_common_flags,
-                        flake_build_flags=flake_build_flags
-                        | {"no_link": no_link, "dry_run": dry_run},
-                        copy_flags=copy_flags,
-                    )
-                case (_, False, None, Flake(_)):
-                    path_to_config = nix.build_flake(
-                        attr,
-                        flake,
-                        flake_build_flags=flake_build_flags
-                        | {"no_link": no_link, "dry_run": dry_run},
-                    )
-                case (_, False, Remote(_), None):
-                    path_to_config = nix.build_remote(
-                        attr,
-                        build_attr,
-                        build_host,
-                        realise_flags=common_flags,
-                        instantiate_flags=build_flags,
-                        copy_flags=copy_flags,
-                    )
-                case (_, False, None, None):
-                    path_to_config = nix.build(
-                        attr,
-                        build_attr,
-                        build_flags=build_flags
-                        | {"no_out_link": no_link, "dry_run": dry_run},
-                    )
-                case never:
-                    # should never happen, but mypy is not smart enough to
-                    # handle this with assert_never
-                    # https://github.com/python/mypy/issues/16650
-                    # https://github.com/python/mypy/issues/16722
-                    raise AssertionError(
-                        f"expected code to be unreachable, but got: {never}"
-                    )
+                case (_, False):
+                    with timings.phase("build", flake=flake):
+                        path_to_config = build_system(flake, build_host)
 
             if not rollback:
-                nix.copy_closure(
-                    path_to_config,
-                    to_host=target_host,
-                    from_host=build_host,
-                    copy_flags=copy_flags,
-                )
-                if action in (Action.SWITCH, Action.BOOT):
-                    nix.set_profile(
-                        profile,
+                with timings.phase("copy_closure"):
+                    nix.copy_closure(
                         path_to_config,
-                        target_host=target_host,
-                        sudo=args.sudo,
+                        to_host=target_host,
+                        from_host=build_host,
+                        copy_flags=copy_flags,
                     )
+                if action in (Action.SWITCH, Action.BOOT):
+                    with timings.phase("set_profile"):
+                        nix.set_profile(
+                            profile,
+                            path_to_config,
+                            target_host=target_host,
+                            sudo=args.sudo,
+                        )
 
             # Print only the result to stdout to make it easier to script
             def print_result(msg: str, result: str | Path) -> None:
@@ -500,14 +687,15 @@ def execute(argv: list[str]) -> None:
 
             match action:
                 case Action.SWITCH | Action.BOOT | Action.TEST | Action.DRY_ACTIVATE:
-                    nix.switch_to_configuration(
-                        path_to_config,
-                        action,
-                        target_host=target_host,
-                        sudo=args.sudo,
-                        specialisation=args.specialisation,
-                        install_bootloader=args.install_bootloader,
-                    )
+                    with timings.phase("switch_to_configuration"):
+                        nix.switch_to_configuration(
+                            path_to_config,
+                            action,
+                            target_host=target_host,
+                            sudo=args.sudo,
+                            specialisation=args.specialisation,
+                            install_bootloader=args.install_bootloader,
+                        )
                     print_result("Done. The new configuration is", path_to_config)
                 case Action.BUILD:
                     print_result("Done. The new configuration is", path_to_config)
@@ -528,7 +716,7 @@ def execute(argv: list[str]) -> None:
             raise AssertionError("DRY_RUN should be a DRY_BUILD alias")
 
         case Action.LIST_GENERATIONS:
-            generations = nix.list_generations(profile)
+            generations = nix.list_generations(profile, target_host)
             if args.json:
                 print(json.dumps(generations, indent=2))
             else:
@@ -0,0 +1,43 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache_dir() -> Path:
+    "Directory for nixos-rebuild's persistent caches, per XDG Base Directory spec."
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "nixos-rebuild"
+
+
+def load(name: str) -> dict[str, Any]:
+    "Load a JSON cache, returning an empty one if it is missing or invalid."
+    path = get_cache_dir() / name
+    try:
+        data = json.loads(path.read_text())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as ex:
+        logger.debug("ignoring invalid cache %s: %s", path, ex)
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def save(name: str, data: dict[str, Any]) -> None:
+    """Save a JSON cache.
+
+    The file is replaced atomically, so concurrent runs never read a partially
+    written cache. Failing to save is not an error, the cache is an
+    optimisation only.
+    """
+    path = get_cache_dir() / name
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+        tmp_path.write_text(json.dumps(data))
+        tmp_path.replace(path)
+    except OSError as ex:
+        logger.debug("could not save cache %s: %s", path, ex)
@@ -0,0 +1,350 @@
+import logging
+import time
+from collections.abc import Callable, Mapping, Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from subprocess import CalledProcessError
+from typing import Final, Literal, TypedDict
+
+from . import nix, timings
+from .models import Action, NRError, Profile
+from .process import Remote
+from .utils import Args, tabulate
+
+logger = logging.getLogger(__name__)
+
+type FleetAction = Literal[Action.SWITCH, Action.BOOT, Action.TEST, Action.DRY_ACTIVATE]
+type CopyMode = Literal["direct", "chain", "tree"]
+
+COPY_MODES: Final = ["direct", "chain", "tree"]
+# Number of hosts each host sends the closure to in "tree" copy mode
+TREE_FANOUT: Final = 2
+
+
+class HostResult(TypedDict):
+    host: str
+    status: str
+    duration: str
+    error: str
+
+
+@dataclass(frozen=True)
+class FleetHost:
+    remote: Remote
+    path_to_config: Path
+
+
+@dataclass(frozen=True)
+class CopyStep:
+    # None means the local machine, or the build host if there is one
+    source: FleetHost | None
+    paths: list[Path]
+
+
+def get_remotes(hosts: Sequence[str], ask_sudo_password: bool | None) -> list[Remote]:
+    "Create a Remote for every host, asking for the sudo password only once."
+    first = Remote.from_arg(hosts[0], ask_sudo_password)
+    assert first is not None, "expected at least one host"
+    return [
+        first,
+        *(Remote(host, first.opts, first.sudo_password) for host in hosts[1:]),
+    ]
+
+
+def group_by_configuration[T](
+    remotes: Sequence[Remote],
+    get_configuration: Callable[[Remote], T],
+    jobs: int,
+) -> dict[T, list[Remote]]:
+    """Group hosts by the configuration that needs to be built for them.
+
+    `get_configuration` may need to connect to the host (e.g.: to find out the
+    hostname for the flake attribute), so it is called concurrently.
+    """
+    groups: dict[T, list[Remote]] = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for remote, configuration in zip(
+            remotes, executor.map(get_configuration, remotes), strict=True
+        ):
+            groups.setdefault(configuration, []).append(remote)
+    return groups
+
+
+def top_paths(paths: set[Path], references: Mapping[Path, set[Path]]) -> list[Path]:
+    """Return the paths not referenced by any other path of the set.
+
+    If the set is closed under references (like the intersection of two
+    closures), copying the closures of these paths copies the whole set.
+    """
+    referenced = {
+        ref for path in paths for ref in references.get(path, ()) if ref != path
+    }
+    return sorted(paths - referenced)
+
+
+def plan_copies(
+    hosts: Sequence[FleetHost],
+    mode: CopyMode,
+    build_host: Remote | None,
+) -> dict[str, list[CopyStep]]:
+    """Plan from where each host receives its closure.
+
+    In "direct" mode every host receives it from the local machine (or the
+    build host). Otherwise only the first host of each configuration does,
+    and the other hosts receive it from a host that already has it, either
+    the previous one ("chain") or in a tree where each host sends it to
+    `TREE_FANOUT` others ("tree").
+
+    If there is more than one configuration, the first host of each one first
+    receives the paths it shares with the configurations before it from their
+    first hosts, so the link of the local machine (or the build host) carries
+    each path only once.
+
+    Hosts only receive the closure from hosts that come before them in
+    `hosts`.
+    """
+    configurations: dict[Path, list[FleetHost]] = {}
+    for host in hosts:
+        configurations.setdefault(host.path_to_config, []).append(host)
+
+    references: dict[Path, dict[Path, set[Path]]] = {}
+    if mode != "direct" and len(configurations) > 1:
+        for config in configurations:
+            references[config] = nix.get_closure_references(config, build_host)
+
+    plan: dict[str, list[CopyStep]] = {}
+    first_hosts: list[FleetHost] = []
+    for config, group in configurations.items():
+        if mode == "direct":
+            for host in group:
+                plan[host.remote.host] = [CopyStep(None, [config])]
+            continue
+
+        first, *others = group
+        steps = []
+        if references:
+            remaining = set(references[config])
+            for other in first_hosts:
+                shared = remaining & references[other.path_to_config].keys()
+                if shared:
+                    steps.append(CopyStep(other, top_paths(shared, references[config])))
+                    remaining -= shared
+        steps.append(CopyStep(None, [config]))
+        plan[first.remote.host] = steps
+        first_hosts.append(first)
+
+        for i, host in enumerate(others, start=1):
+            source = group[i - 1] if mode == "chain" else group[(i - 1) // TREE_FANOUT]
+            plan[host.remote.host] = [CopyStep(source, [config])]
+
+    return plan
+
+
+def copy_to_host(
+    host: FleetHost,
+    steps: Sequence[CopyStep],
+    copied: Mapping[str, Future[bool]],
+    build_host: Remote | None,
+    copy_flags: Args,
+    sudo: bool = False,
+) -> None:
+    """Copy the closure of a host following its steps from `plan_copies`.
+
+    Waits until the source hosts received their closure, and falls back to
+    copying from the local machine (or build host) if they could not.
+    """
+    name = host.remote.host
+    for step in steps:
+        if step.source is not None:
+            source = step.source.remote.host
+            if copied[source].result():
+                logger.info("%s: copying closure from %s...", name, source)
+                try:
+                    nix.copy_closure_from_peer(
+                        step.paths,
+                        to_host=host.remote,
+                        from_host=step.source.remote,
+                        copy_flags=copy_flags,
+                        sudo=sudo,
+                    )
+                    continue
+                except CalledProcessError:
+                    logger.warning(
+                        "%s: could not copy closure from %s, copying it directly "
+                        + "(can it connect to %s via SSH, and is the user "
+                        + "trusted by its Nix daemon?)",
+                        name,
+                        source,
+                        source,
+                    )
+            else:
+                logger.warning(
+                    "%s: %s did not receive its closure, copying it directly",
+                    name,
+                    source,
+                )
+
+        logger.info("%s: copying closure...", name)
+        nix.copy_closure(
+            host.path_to_config,
+            to_host=host.remote,
+            from_host=build_host,
+            copy_flags=copy_flags,
+        )
+        # Copying directly always copies the whole closure
+        break
+
+
+def deploy_host(
+    host: FleetHost,
+    action: FleetAction,
+    profile: Profile,
+    build_host: Remote | None,
+    copy_flags: Args,
+    sudo: bool,
+    specialisation: str | None,
+    install_bootloader: bool,
+    copy_steps: Sequence[CopyStep],
+    copied: Mapping[str, Future[bool]],
+) -> None:
+    name = host.remote.host
+    try:
+        with timings.phase("copy_closure", host=name):
+            copy_to_host(host, copy_steps, copied, build_host, copy_flags, sudo)
+    except BaseException:
+        copied[name].set_result(False)
+        raise
+    copied[name].set_result(True)
+    if action in (Action.SWITCH, Action.BOOT):
+        logger.info("%s: setting profile...", name)
+        with timings.phase("set_profile", host=name):
+            nix.set_profile(
+                profile,
+                host.path_to_config,
+                target_host=host.remote,
+                sudo=sudo,
+            )
+    logger.info("%s: activating the configuration...", name)
+    with timings.phase("switch_to_configuration", host=name):
+        nix.switch_to_configuration(
+            host.path_to_config,
+            action,
+            target_host=host.remote,
+            sudo=sudo,
+            specialisation=specialisation,
+            install_bootloader=install_bootloader,
+        )
+
+
+def deploy(
+    hosts: Sequence[FleetHost],
+    action: FleetAction,
+    profile: Profile,
+    build_host: Remote | None,
+    copy_flags: Args,
+    sudo: bool,
+    specialisation: str | None,
+    install_bootloader: bool,
+    jobs: int,
+    max_failures: float,
+    copy_mode: CopyMode = "direct",
+) -> list[HostResult]:
+    """Copy, set profile and activate the configuration of every host.
+
+    At most `jobs` hosts are deployed at the same time. Once more than
+    `max_failures` (a fraction of all hosts) failed, no new hosts are
+    started, and the hosts that were not started yet are reported as skipped.
+
+    See `plan_copies` for `copy_mode`. Hosts are started in order, so the
+    hosts they receive their closure from are always already running.
+    """
+    copy_plan = plan_copies(hosts, copy_mode, build_host)
+    copied: dict[str, Future[bool]] = {host.remote.host: Future() for host in hosts}
+    allowed_failures = int(max_failures * len(hosts))
+    results: dict[str, HostResult] = {
+        host.remote.host: {
+            "host": host.remote.host,
+            "status": "skipped",
+            "duration": "",
+            "error": "",
+        }
+        for host in hosts
+    }
+    pending = list(reversed(hosts))
+    running: dict[Future[None], tuple[FleetHost, float]] = {}
+    failures = 0
+    done = 0
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            while pending and len(running) < jobs and failures <= allowed_failures:
+                host = pending.pop()
+                future = executor.submit(
+                    deploy_host,
+                    host,
+                    action,
+                    profile,
+                    build_host,
+                    copy_flags,
+                    sudo,
+                    specialisation,
+                    install_bootloader,
+                    copy_plan[host.remote.host],
+                    copied,
+                )
+                running[future] = (host, time.monotonic())
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                host, start = running.pop(future)
+                result = results[host.remote.host]
+                result["duration"] = f"{time.monotonic() - start:.1f}s"
+                done += 1
+                if (error := future.exception()) is not None:
+                    failures += 1
+                    result["status"] = "failed"
+                    result["error"] = str(error) or type(error).__name__
+                    logger.error(
+                        "[%d/%d] %s: failed: %s",
+                        done,
+                        len(hosts),
+                        host.remote.host,
+                        result["error"],
+                    )
+                else:
+                    result["status"] = "done"
+                    logger.info("[%d/%d] %s: done", done, len(hosts), host.remote.host)
+
+    if pending:
+        logger.error(
+            "%d of %d hosts failed, not deploying to the remaining %d hosts",
+            failures,
+            len(hosts),
+            len(pending),
+        )
+
+    return list(results.values())
+
+
+def print_summary(results: Sequence[HostResult]) -> None:
+    print(
+        tabulate(
+            results,
+            headers={
+                "host": "Host",
+                "status": "Status",
+                "duration": "Duration",
+                "error": "Error",
+            },
+        )
+    )
+    failed = [r for r in results if r["status"] != "done"]
+    if failed:
+        raise NRError(
+            f"deployment failed or was skipped for {len(failed)} of "
+            + f"{len(results)} hosts"
+        )
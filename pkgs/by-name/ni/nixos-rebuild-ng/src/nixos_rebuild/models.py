@@ -153,6 +153,14 @@ class Generation:
     current: bool
 
 
+# Information about a generation that only depends on its store path
+class GenerationInfo(TypedDict):
+    nixosVersion: str
+    kernelVersion: str
+    configurationRevision: str
+    specialisations: list[str]
+
+
 # camelCase since this will be used as output for `--json` flag
 class GenerationJson(TypedDict):
     generation: int
@@ -1,23 +1,27 @@
+import hashlib
 import json
 import logging
 import os
 import textwrap
+import time
+from collections.abc import Sequence
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from importlib.resources import files
 from pathlib import Path
 from string import Template
 from subprocess import PIPE, CalledProcessError
-from typing import Final, Literal
+from typing import Any, Final, Literal
 from uuid import uuid4
 
-from . import tmpdir
+from . import cache, timings, tmpdir
 from .constants import WITH_NIX_2_18
 from .models import (
     Action,
     BuildAttr,
     Flake,
     Generation,
+    GenerationInfo,
     GenerationJson,
     ImageVariants,
     NRError,
@@ -29,6 +33,9 @@ from .utils import Args, dict_to_flags
 
 FLAKE_FLAGS: Final = ["--extra-experimental-features", "nix-command flakes"]
 FLAKE_REPL_TEMPLATE: Final = "repl.nix.template"
+GENERATIONS_CACHE: Final = "generations-v1.json"
+# Cached generations not seen for this long (in seconds) are removed
+GENERATIONS_CACHE_MAX_AGE: Final = 90 * 24 * 60 * 60
 logger = logging.getLogger(__name__)
 
 
@@ -205,24 +212,81 @@ def copy_closure(
             extra_env=extra_env,
         )
 
-    match (to_host, from_host):
-        case (None, None):
-            return
-        case (Remote(_) as host, None) | (None, Remote(_) as host):
-            nix_copy_closure(host, to=bool(to_host))
-        case (Remote(_), Remote(_)):
-            if WITH_NIX_2_18:
-                # With newer Nix, use `nix copy` instead of `nix-copy-closure`
-                # since it supports `--to` and `--from` at the same time
-                # TODO: once we drop Nix 2.3 from nixpkgs, remove support for
-                # `nix-copy-closure`
-                nix_copy(to_host, from_host)
-            else:
-                # With older Nix, we need to copy from to local and local to
-                # host. This means it is slower and need additional disk space
-                # in local
-                nix_copy_closure(from_host, to=False)
-                nix_copy_closure(to_host, to=True)
+    if to_host is None and from_host is None:
+        return
+
+    with timings.span(
+        "copy_closure",
+        "copy",
+        closure=closure,
+        to_host=to_host.host if to_host else None,
+        from_host=from_host.host if from_host else None,
+    ) as event:
+        if timings.is_enabled():
+            event["bytes"] = get_copy_size([closure], to_host, from_host)
+
+        match (to_host, from_host):
+            case (Remote(_) as host, None) | (None, Remote(_) as host):
+                nix_copy_closure(host, to=bool(to_host))
+            case (Remote(_), Remote(_)):
+                if WITH_NIX_2_18:
+                    # With newer Nix, use `nix copy` instead of
+                    # `nix-copy-closure` since it supports `--to` and `--from`
+                    # at the same time
+                    # TODO: once we drop Nix 2.3 from nixpkgs, remove support
+                    # for `nix-copy-closure`
+                    nix_copy(to_host, from_host)
+                else:
+                    # With older Nix, we need to copy from to local and local
+                    # to host. This means it is slower and need additional
+                    # disk space in local
+                    nix_copy_closure(from_host, to=False)
+                    nix_copy_closure(to_host, to=True)
+
+
+def copy_closure_from_peer(
+    paths: Sequence[Path],
+    to_host: Remote,
+    from_host: Remote,
+    copy_flags: Args | None = None,
+    sudo: bool = False,
+) -> None:
+    """Copy paths (and their closures) from a remote host to another one.
+
+    Unlike `copy_closure`, `nix copy` runs in `to_host` itself so the paths
+    are sent directly between both hosts instead of passing through localhost.
+    This needs `to_host` to be able to connect to `from_host` via SSH (as root
+    with `sudo`), and the user to be trusted by its Nix daemon, unless the
+    paths are signed by a trusted key."""
+    with timings.span(
+        "copy_closure_from_peer",
+        "copy",
+        paths=paths,
+        to_host=to_host.host,
+        from_host=from_host.host,
+    ) as event:
+        if timings.is_enabled():
+            event["bytes"] = get_copy_size(paths, to_host, from_host)
+
+        run_wrapper(
+            [
+                "nix",
+                *FLAKE_FLAGS,
+                "copy",
+                *dict_to_flags(copy_flags),
+                "--from",
+                f"ssh://{from_host.host}",
+                *paths,
+            ],
+            remote=to_host,
+            sudo=sudo,
+            # Only the user's options, the default ones are for local sockets
+            extra_env=(
+                {"NIX_SSHOPTS": sshopts}
+                if (sshopts := os.getenv("NIX_SSHOPTS"))
+                else None
+            ),
+        )
 
 
 def edit(flake: Flake | None, flake_flags: Args | None = None) -> None:
@@ -317,6 +381,25 @@ def get_build_image_variants_flake(
     return j
 
 
+def get_flake_lock_hash(flake: Flake) -> str | None:
+    """Get the hash of the lock file of a local flake.
+
+    Returns None for remote flakes or flakes without a lock file."""
+    match flake.path:
+        case Path() as path:
+            lock_path = path / "flake.lock"
+        case str(s) if s.startswith("git+file://"):
+            lock_path = Path(s.removeprefix("git+file://")) / "flake.lock"
+        case _:
+            return None
+
+    try:
+        return hashlib.sha256(lock_path.read_bytes()).hexdigest()
+    except OSError as ex:
+        logger.debug("could not read flake lock file: %s", ex)
+        return None
+
+
 def get_nixpkgs_rev(nixpkgs_path: Path | None) -> str | None:
     """Get Nixpkgs path as a Git revision.
 
@@ -349,6 +432,66 @@ def get_nixpkgs_rev(nixpkgs_path: Path | None) -> str | None:
         return None
 
 
+def _get_path_info(closure: Path, remote: Remote | None) -> dict[str, Any]:
+    r = run_wrapper(
+        ["nix", *FLAKE_FLAGS, "path-info", "--json", "--recursive", closure],
+        remote=remote,
+        stdout=PIPE,
+    )
+    info = json.loads(r.stdout)
+    # Nix 2.19 changed the output from a list to an object keyed by path
+    if isinstance(info, list):
+        info = {i["path"]: i for i in info}
+    return {path: i for path, i in info.items() if i}
+
+
+def get_closure_references(
+    closure: Path,
+    remote: Remote | None = None,
+) -> dict[Path, set[Path]]:
+    "Get the references of every path in the closure of a Nix store path."
+    return {
+        Path(path): {Path(ref) for ref in i["references"]}
+        for path, i in _get_path_info(closure, remote).items()
+    }
+
+
+def get_copy_size(
+    paths: Sequence[Path],
+    to_host: Remote | None,
+    from_host: Remote | None,
+) -> int | None:
+    """Get the NAR size of the paths in the closures of `paths` that are
+    missing in `to_host`, i.e.: how many bytes copying them will transfer.
+
+    Returns None if it could not be calculated."""
+    try:
+        sizes: dict[str, int] = {
+            path: i["narSize"]
+            for closure in paths
+            for path, i in _get_path_info(closure, from_host).items()
+        }
+        missing: set[str] = set()
+        store_paths = sorted(sizes)
+        # Avoid hitting MAX_ARG_STRLEN in the remote shell
+        for i in range(0, len(store_paths), 1000):
+            r = run_wrapper(
+                [
+                    "nix-store",
+                    "--check-validity",
+                    "--print-invalid",
+                    *store_paths[i : i + 1000],
+                ],
+                remote=to_host,
+                stdout=PIPE,
+            )
+            missing.update(r.stdout.split())
+        return sum(sizes[path] for path in missing)
+    except (CalledProcessError, ValueError, KeyError):
+        logger.debug("could not calculate the size of %s", paths, exc_info=True)
+        return None
+
+
 def get_generations(profile: Profile) -> list[Generation]:
     """Get all NixOS generations from profile.
 
@@ -417,62 +560,198 @@ def get_generations_from_nix_env(
     )
 
 
-def list_generations(profile: Profile) -> list[GenerationJson]:
+def get_generation_path(profile: Profile, generation: Generation) -> Path:
+    return profile.path.parent / f"{profile.path.name}-{generation.id}-link"
+
+
+def get_generations_remote(
+    profile: Profile,
+    target_host: Remote,
+) -> list[tuple[Generation, str]]:
+    """Get all NixOS generations from profile in a remote host.
+
+    Same as `get_generations`, but also returns the store path of each
+    generation. Uses a single SSH command, independent of the number of
+    generations.
+    """
+    # Outputs the name and ctime of every generation link, followed by their
+    # store paths (in the same order) and the link of the current generation
+    script = (
+        'cd "$1" && stat -L -c "%n %Z" "$2"-*-link'
+        + ' && readlink -f "$2"-*-link && readlink "$2"'
+    )
+    r = run_wrapper(
+        ["sh", "-c", script, "sh", profile.path.parent, profile.path.name],
+        remote=target_host,
+        check=False,
+        capture_output=True,
+    )
+    if r.returncode != 0:
+        raise NRError(
+            f"could not find generations of profile '{profile.name}' in "
+            + f"{target_host.host}: {r.stderr.strip()}"
+        )
+
+    lines = r.stdout.splitlines()
+    count = (len(lines) - 1) // 2
+    current = lines[-1]
+    generations = []
+    for line, store_path in zip(lines[:count], lines[count : 2 * count], strict=True):
+        name, ctime = line.rsplit(" ", 1)
+        entry_id = name.removeprefix(f"{profile.path.name}-").removesuffix("-link")
+        timestamp = datetime.fromtimestamp(int(ctime)).strftime("%Y-%m-%d %H:%M:%S")
+        generation = Generation(
+            id=int(entry_id),
+            timestamp=timestamp,
+            current=name == current,
+        )
+        generations.append((generation, store_path))
+
+    return sorted(generations, key=lambda g: g[0].id)
+
+
+def get_generation_info(generation_path: Path) -> GenerationInfo:
+    "Get information of a NixOS generation from its path."
+    try:
+        nixos_version = (generation_path / "nixos-version").read_text().strip()
+    except OSError as ex:
+        logger.debug("could not get nixos-version: %s", ex)
+        nixos_version = "Unknown"
+    try:
+        kernel_version = next(
+            (generation_path / "kernel-modules/lib/modules").iterdir()
+        ).name
+    except OSError as ex:
+        logger.debug("could not get kernel version: %s", ex)
+        kernel_version = "Unknown"
+    specialisations = [
+        s.name for s in (generation_path / "specialisation").glob("*") if s.is_dir()
+    ]
+    try:
+        configuration_revision = run_wrapper(
+            [generation_path / "sw/bin/nixos-version", "--configuration-revision"],
+            capture_output=True,
+        ).stdout.strip()
+    except (OSError, CalledProcessError) as ex:
+        logger.debug("could not get configuration revision: %s", ex)
+        configuration_revision = "Unknown"
+
+    return GenerationInfo(
+        nixosVersion=nixos_version,
+        kernelVersion=kernel_version,
+        configurationRevision=configuration_revision,
+        specialisations=specialisations,
+    )
+
+
+def get_generation_info_remote(
+    store_paths: Sequence[str],
+    target_host: Remote,
+) -> dict[str, GenerationInfo]:
+    """Get information of NixOS generations in a remote host.
+
+    Same as `get_generation_info`, but for many generations at once to avoid
+    one SSH command per generation.
+    """
+    # Outputs 5 lines per generation: the store path, NixOS version, kernel
+    # version, specialisations (separated by "/") and configuration revision
+    script = textwrap.dedent("""
+        for p in "$@"; do
+          printf '%s\\n' "$p"
+          printf '%s\\n' "$(cat "$p/nixos-version" 2>/dev/null)"
+          printf '%s\\n' "$(ls "$p/kernel-modules/lib/modules" 2>/dev/null | head -n1)"
+          printf '%s\\n' "$(ls "$p/specialisation" 2>/dev/null | tr '\\n' /)"
+          printf '%s\\n' "$("$p/sw/bin/nixos-version" --configuration-revision 2>/dev/null)"
+        done
+    """)
+    infos = {}
+    # Avoid hitting MAX_ARG_STRLEN in the remote shell
+    for i in range(0, len(store_paths), 1000):
+        r = run_wrapper(
+            ["sh", "-c", script, "sh", *store_paths[i : i + 1000]],
+            remote=target_host,
+            stdout=PIPE,
+        )
+        lines = r.stdout.splitlines()
+        for j in range(0, len(lines) - 4, 5):
+            store_path, version, kernel, specialisations, revision = lines[j : j + 5]
+            infos[store_path] = GenerationInfo(
+                nixosVersion=version.strip() or "Unknown",
+                kernelVersion=kernel or "Unknown",
+                configurationRevision=revision.strip() or "Unknown",
+                specialisations=[s for s in specialisations.split("/") if s],
+            )
+    return infos
+
+
+def list_generations(
+    profile: Profile,
+    target_host: Remote | None = None,
+) -> list[GenerationJson]:
     """Get all NixOS generations from profile, including extra information.
 
     Includes OS information like the commit, kernel version, configuration
     revision and specialisations.
 
+    Since the store path of a generation never changes, this information is
+    cached by store path and only read for new generations.
+
     Will be formatted in a way that is expected by the output of
     `nixos-rebuild list-generations --json`.
     """
-
-    def get_generation_info(generation: Generation) -> GenerationJson:
-        generation_path = (
-            profile.path.parent / f"{profile.path.name}-{generation.id}-link"
-        )
-        try:
-            nixos_version = (generation_path / "nixos-version").read_text().strip()
-        except OSError as ex:
-            logger.debug("could not get nixos-version: %s", ex)
-            nixos_version = "Unknown"
-        try:
-            kernel_version = next(
-                (generation_path / "kernel-modules/lib/modules").iterdir()
-            ).name
-        except OSError as ex:
-            logger.debug("could not get kernel version: %s", ex)
-            kernel_version = "Unknown"
-        specialisations = [
-            s.name for s in (generation_path / "specialisation").glob("*") if s.is_dir()
+    if target_host:
+        generations = get_generations_remote(profile, target_host)
+    else:
+        generations = [
+            (generation, str(get_generation_path(profile, generation).resolve()))
+            for generation in get_generations(profile)
         ]
-        try:
-            configuration_revision = run_wrapper(
-                [generation_path / "sw/bin/nixos-version", "--configuration-revision"],
-                capture_output=True,
-            ).stdout.strip()
-        except (OSError, CalledProcessError) as ex:
-            logger.debug("could not get configuration revision: %s", ex)
-            configuration_revision = "Unknown"
-
-        return GenerationJson(
-            generation=generation.id,
-            date=generation.timestamp,
-            nixosVersion=nixos_version,
-            kernelVersion=kernel_version,
-            configurationRevision=configuration_revision,
-            specialisations=specialisations,
-            current=generation.current,
-        )
 
-    # This can be surprisingly slow, especially with lots of generations,
-    # but it is basically IO work so we can run in parallel
-    with ThreadPoolExecutor() as executor:
-        return sorted(
-            executor.map(get_generation_info, get_generations(profile)),
-            key=lambda x: x["generation"],
-            reverse=True,
-        )
+    entries = cache.load(GENERATIONS_CACHE)
+    missing = sorted({path for _, path in generations if path not in entries})
+    if missing and target_host:
+        entries.update(get_generation_info_remote(missing, target_host))
+    elif missing:
+        # This can be surprisingly slow, especially with lots of generations,
+        # but it is basically IO work so we can run in parallel
+        with ThreadPoolExecutor() as executor:
+            entries.update(
+                zip(
+                    missing,
+                    executor.map(get_generation_info, map(Path, missing)),
+                    strict=True,
+                )
+            )
+
+    # Drop generations that were not listed in a while (e.g.: deleted ones)
+    now = int(time.time())
+    for _, path in generations:
+        entries[path]["lastSeen"] = now
+    cache.save(
+        GENERATIONS_CACHE,
+        {
+            path: entry
+            for path, entry in entries.items()
+            if now - entry.get("lastSeen", 0) < GENERATIONS_CACHE_MAX_AGE
+        },
+    )
+
+    return sorted(
+        [
+            GenerationJson(
+                generation=generation.id,
+                date=generation.timestamp,
+                nixosVersion=entries[path]["nixosVersion"],
+                kernelVersion=entries[path]["kernelVersion"],
+                configurationRevision=entries[path]["configurationRevision"],
+                specialisations=entries[path]["specialisations"],
+                current=generation.current,
+            )
+            for generation, path in generations
+        ],
+        key=lambda x: x["generation"],
+        reverse=True,
+    )
 
 
 def repl(attr: str, build_attr: BuildAttr, nix_flags: Args | None = None) -> None:
@@ -538,6 +817,11 @@ def rollback_temporary_profile(
         return None
 
 
+def add_gcroot(path: Path, root: Path) -> None:
+    "Make `root` an indirect garbage collector root for `path`."
+    run_wrapper(["nix-store", "--realise", path, "--add-root", root], stdout=PIPE)
+
+
 def set_profile(
     profile: Profile,
     path_to_config: Path,
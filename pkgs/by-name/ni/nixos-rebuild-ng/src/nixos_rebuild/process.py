@@ -8,7 +8,7 @@ from dataclasses import dataclass
 from getpass import getpass
 from typing import Final, Self, TypedDict, Unpack
 
-from . import tmpdir
+from . import timings, tmpdir
 
 logger = logging.getLogger(__name__)
 
@@ -93,6 +93,13 @@ def run_wrapper(
     "Wrapper around `subprocess.run` that supports extra functionality."
     env = None
     process_input = None
+    command = [str(a) for a in args]
+    # The first connection to a host also sets up the SSH ControlMaster. Its
+    # ControlPath uses `%n`, the host name without the `user@` part
+    new_ssh_connection = bool(
+        remote
+        and not (tmpdir.TMPDIR_PATH / f"ssh-{remote.host.rpartition('@')[2]}").exists()
+    )
     if remote:
         if extra_env:
             extra_env_args = [f"{env}={value}" for env, value in extra_env.items()]
@@ -129,17 +136,26 @@ def run_wrapper(
     )
 
     try:
-        r = subprocess.run(
-            args,
-            check=check,
-            env=env,
-            input=process_input,
-            # Hope nobody is using NixOS with non-UTF8 encodings, but "surrogateescape"
-            # should still work in those systems.
-            text=True,
-            errors="surrogateescape",
-            **kwargs,
-        )
+        with timings.span(
+            os.path.basename(command[0]),
+            "remote" if remote else "local",
+            command=shlex.join(command),
+            host=remote.host if remote else None,
+            sudo=sudo,
+            new_ssh_connection=new_ssh_connection,
+        ) as event:
+            r = subprocess.run(
+                args,
+                check=check,
+                env=env,
+                input=process_input,
+                # Hope nobody is using NixOS with non-UTF8 encodings, but
+                # "surrogateescape" should still work in those systems.
+                text=True,
+                errors="surrogateescape",
+                **kwargs,
+            )
+            event["returncode"] = r.returncode
 
         if kwargs.get("capture_output") or kwargs.get("stderr") or kwargs.get("stdout"):
             logger.debug("captured output stdout=%r, stderr=%r", r.stdout, r.stderr)
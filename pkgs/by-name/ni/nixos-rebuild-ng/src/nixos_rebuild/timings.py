@@ -0,0 +1,106 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import AbstractContextManager, contextmanager
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# Events in Chrome's Trace Event Format, that can be loaded in
+# chrome://tracing, https://ui.perfetto.dev or https://speedscope.app
+# https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+_events: list[dict[str, Any]] = []
+_threads: set[int] = set()
+_lock = threading.Lock()
+_path: Path | None = None
+
+
+def enable(path: Path) -> None:
+    """Record timings and write them to `path` at exit.
+
+    If we re-exec'd from an older nixos-rebuild, events that it wrote to
+    `path` are kept, so the trace covers the whole run.
+    """
+    global _path
+    if _path is None:
+        atexit.register(write)
+    _path = path
+    if os.environ.get("_NIXOS_REBUILD_REEXEC") and path.exists():
+        try:
+            _events.extend(json.loads(path.read_text())["traceEvents"])
+        except (ValueError, KeyError):
+            logger.debug("ignoring invalid timings file %s", path, exc_info=True)
+
+
+def is_enabled() -> bool:
+    return _path is not None
+
+
+def _now() -> int:
+    # Absolute timestamps, so events from before a re-exec can be merged
+    return time.time_ns() // 1000
+
+
+@contextmanager
+def span(name: str, category: str, **args: Any) -> Iterator[dict[str, Any]]:
+    """Record the wall time of the block as a complete ("X") event.
+
+    Yields the event arguments, so the block can add more information to
+    them (e.g.: the process exit code).
+    """
+    if _path is None:
+        yield args
+        return
+
+    start = _now()
+    try:
+        yield args
+    except BaseException as ex:
+        args["error"] = type(ex).__name__
+        raise
+    finally:
+        thread = threading.current_thread()
+        tid = threading.get_ident()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start,
+            "dur": _now() - start,
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": args,
+        }
+        with _lock:
+            _events.append(event)
+            if tid not in _threads:
+                _threads.add(tid)
+                _events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": os.getpid(),
+                        "tid": tid,
+                        "args": {"name": thread.name},
+                    }
+                )
+
+
+def phase(name: str, **args: Any) -> AbstractContextManager[dict[str, Any]]:
+    "Record a phase of nixos-rebuild (e.g.: build, copy_closure)."
+    return span(name, "phase", **args)
+
+
+def write() -> None:
+    if _path is None:
+        return
+    with _lock:
+        events = list(_events)
+    _path.write_text(
+        json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, default=str)
+    )
@@ -0,0 +1,12 @@
+from pathlib import Path
+
+import pytest
+from pytest import MonkeyPatch
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch: MonkeyPatch, tmp_path: Path) -> Path:
+    "Avoid reading or writing the persistent caches of the user running tests."
+    path = tmp_path / "cache"
+    monkeypatch.setenv("XDG_CACHE_HOME", str(path))
+    return path / "nixos-rebuild"
@@ -0,0 +1,265 @@
+from pathlib import Path
+from subprocess import CalledProcessError
+from typing import Any
+from unittest.mock import Mock, patch
+
+import pytest
+
+import nixos_rebuild.fleet as f
+import nixos_rebuild.models as m
+import nixos_rebuild.process as p
+
+from .helpers import get_qualified_name
+
+PROFILE = m.Profile("system", Path("/nix/var/nix/profiles/system"))
+
+
+def fleet_hosts(*names: str) -> list[f.FleetHost]:
+    return [
+        f.FleetHost(p.Remote(name, [], None), Path("/nix/store/config"))
+        for name in names
+    ]
+
+
+# get_qualified_name doesn't work because getpass is aliased to another
+# function
+@patch(f"{p.__name__}.getpass", autospec=True, return_value="password")
+def test_get_remotes(mock_getpass: Mock) -> None:
+    remotes = f.get_remotes(["host1", "host2", "host3"], True)
+    assert [r.host for r in remotes] == ["host1", "host2", "host3"]
+    assert all(r.sudo_password == "password" for r in remotes)
+    mock_getpass.assert_called_once()
+
+
+def test_group_by_configuration() -> None:
+    remotes = [p.Remote(name, [], None) for name in ["a1", "b1", "a2"]]
+    groups = f.group_by_configuration(remotes, lambda r: r.host[0], 2)
+    assert {k: [r.host for r in v] for k, v in groups.items()} == {
+        "a": ["a1", "a2"],
+        "b": ["b1"],
+    }
+
+
+@patch(get_qualified_name(f.nix.switch_to_configuration, f.nix), autospec=True)
+@patch(get_qualified_name(f.nix.set_profile, f.nix), autospec=True)
+@patch(get_qualified_name(f.nix.copy_closure, f.nix), autospec=True)
+def test_deploy(
+    mock_copy_closure: Mock,
+    mock_set_profile: Mock,
+    mock_switch_to_configuration: Mock,
+) -> None:
+    hosts = fleet_hosts("host1", "host2", "host3")
+    results = f.deploy(
+        hosts,
+        m.Action.SWITCH,
+        PROFILE,
+        build_host=None,
+        copy_flags={},
+        sudo=True,
+        specialisation=None,
+        install_bootloader=False,
+        jobs=2,
+        max_failures=0,
+    )
+    assert [(r["host"], r["status"]) for r in results] == [
+        ("host1", "done"),
+        ("host2", "done"),
+        ("host3", "done"),
+    ]
+    assert mock_copy_closure.call_count == 3
+    assert mock_set_profile.call_count == 3
+    assert mock_switch_to_configuration.call_count == 3
+
+
+@patch(get_qualified_name(f.nix.switch_to_configuration, f.nix), autospec=True)
+@patch(get_qualified_name(f.nix.set_profile, f.nix), autospec=True)
+@patch(get_qualified_name(f.nix.copy_closure, f.nix), autospec=True)
+def test_deploy_test_skips_set_profile(
+    mock_copy_closure: Mock,
+    mock_set_profile: Mock,
+    mock_switch_to_configuration: Mock,
+) -> None:
+    f.deploy(
+        fleet_hosts("host1"),
+        m.Action.TEST,
+        PROFILE,
+        build_host=None,
+        copy_flags={},
+        sudo=False,
+        specialisation=None,
+        install_bootloader=False,
+        jobs=1,
+        max_failures=0,
+    )
+    mock_copy_closure.assert_called_once()
+    mock_set_profile.assert_not_called()
+    mock_switch_to_configuration.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "max_failures, statuses",
+    [
+        (0, ["done", "failed", "skipped", "skipped"]),
+        (0.25, ["done", "failed", "done", "done"]),
+    ],
+)
+@patch(get_qualified_name(f.nix.switch_to_configuration, f.nix), autospec=True)
+@patch(get_qualified_name(f.nix.set_profile, f.nix), autospec=True)
+@patch(get_qualified_name(f.nix.copy_closure, f.nix), autospec=True)
+def test_deploy_max_failures(
+    mock_copy_closure: Mock,
+    mock_set_profile: Mock,
+    mock_switch_to_configuration: Mock,
+    max_failures: float,
+    statuses: list[str],
+) -> None:
+    def copy_closure_side_effect(
+        closure: Path, to_host: p.Remote, **kwargs: Any
+    ) -> None:
+        if to_host.host == "host2":
+            raise CalledProcessError(1, "nix-copy-closure")
+
+    mock_copy_closure.side_effect = copy_closure_side_effect
+
+    results = f.deploy(
+        fleet_hosts("host1", "host2", "host3", "host4"),
+        m.Action.BOOT,
+        PROFILE,
+        build_host=None,
+        copy_flags={},
+        sudo=False,
+        specialisation=None,
+        install_bootloader=False,
+        jobs=1,
+        max_failures=max_failures,
+    )
+    assert [r["status"] for r in results] == statuses
+    assert "nix-copy-closure" in results[1]["error"]
+
+
+def test_print_summary(capsys: pytest.CaptureFixture[str]) -> None:
+    results: list[f.HostResult] = [
+        {"host": "host1", "status": "done", "duration": "1.0s", "error": ""},
+        {"host": "host2", "status": "failed", "duration": "2.0s", "error": "oops"},
+    ]
+    with pytest.raises(m.NRError) as e:
+        f.print_summary(results)
+    assert "1 of 2 hosts" in str(e.value)
+    assert capsys.readouterr().out.splitlines() == [
+        "Host   Status  Duration  Error",
+        "host1  done    1.0s",
+        "host2  failed  2.0s      oops",
+    ]
+
+
+def test_top_paths() -> None:
+    references = {
+        Path("/nix/store/a"): {Path("/nix/store/a"), Path("/nix/store/b")},
+        Path("/nix/store/b"): {Path("/nix/store/c")},
+        Path("/nix/store/c"): set(),
+        Path("/nix/store/d"): {Path("/nix/store/c")},
+    }
+    assert f.top_paths(set(references), references) == [
+        Path("/nix/store/a"),
+        Path("/nix/store/d"),
+    ]
+
+
+def test_plan_copies() -> None:
+    hosts = fleet_hosts("host1", "host2", "host3", "host4")
+
+    def sources(plan: dict[str, list[f.CopyStep]]) -> dict[str, list[str | None]]:
+        return {
+            host: [s.source.remote.host if s.source else None for s in steps]
+            for host, steps in plan.items()
+        }
+
+    assert sources(f.plan_copies(hosts, "direct", None)) == {
+        "host1": [None],
+        "host2": [None],
+        "host3": [None],
+        "host4": [None],
+    }
+    assert sources(f.plan_copies(hosts, "chain", None)) == {
+        "host1": [None],
+        "host2": ["host1"],
+        "host3": ["host2"],
+        "host4": ["host3"],
+    }
+    assert sources(f.plan_copies(hosts, "tree", None)) == {
+        "host1": [None],
+        "host2": ["host1"],
+        "host3": ["host1"],
+        "host4": ["host2"],
+    }
+
+
+@patch(get_qualified_name(f.nix.get_closure_references, f.nix), autospec=True)
+def test_plan_copies_shared_paths(mock_get_closure_references: Mock) -> None:
+    config1 = Path("/nix/store/config1")
+    config2 = Path("/nix/store/config2")
+    glibc = Path("/nix/store/glibc")
+    bash = Path("/nix/store/bash")
+    references = {
+        config1: {config1: {bash}, bash: {glibc}, glibc: set()},
+        config2: {config2: {bash}, bash: {glibc}, glibc: set()},
+    }
+    mock_get_closure_references.side_effect = lambda closure, _: references[closure]
+    hosts = [
+        f.FleetHost(p.Remote("host1", [], None), config1),
+        f.FleetHost(p.Remote("host2", [], None), config2),
+        f.FleetHost(p.Remote("host3", [], None), config1),
+    ]
+
+    plan = f.plan_copies(hosts, "tree", None)
+    assert plan == {
+        "host1": [f.CopyStep(None, [config1])],
+        "host2": [f.CopyStep(hosts[0], [bash]), f.CopyStep(None, [config2])],
+        "host3": [f.CopyStep(hosts[0], [config1])],
+    }
+
+
+@patch(get_qualified_name(f.nix.switch_to_configuration, f.nix), autospec=True)
+@patch(get_qualified_name(f.nix.copy_closure_from_peer, f.nix), autospec=True)
+@patch(get_qualified_name(f.nix.copy_closure, f.nix), autospec=True)
+def test_deploy_chain(
+    mock_copy_closure: Mock,
+    mock_copy_closure_from_peer: Mock,
+    mock_switch_to_configuration: Mock,
+) -> None:
+    def copy_closure_from_peer_side_effect(
+        paths: list[Path], to_host: p.Remote, from_host: p.Remote, **kwargs: Any
+    ) -> None:
+        if to_host.host == "host3":
+            raise CalledProcessError(1, "nix")
+
+    mock_copy_closure_from_peer.side_effect = copy_closure_from_peer_side_effect
+
+    hosts = fleet_hosts("host1", "host2", "host3")
+    results = f.deploy(
+        hosts,
+        m.Action.TEST,
+        PROFILE,
+        build_host=None,
+        copy_flags={},
+        sudo=False,
+        specialisation=None,
+        install_bootloader=False,
+        jobs=3,
+        max_failures=0,
+        copy_mode="chain",
+    )
+    assert [r["status"] for r in results] == ["done", "done", "done"]
+    # host1 from localhost, host2 from host1, host3 falls back to localhost
+    assert [c.kwargs["to_host"].host for c in mock_copy_closure.call_args_list] == [
+        "host1",
+        "host3",
+    ]
+    assert mock_copy_closure_from_peer.call_count == 2
+    mock_copy_closure_from_peer.assert_any_call(
+        [Path("/nix/store/config")],
+        to_host=hosts[1].remote,
+        from_host=hosts[0].remote,
+        copy_flags={},
+        sudo=False,
+    )
@@ -1,3 +1,4 @@
+import json
 import logging
 import textwrap
 import uuid
@@ -34,6 +35,10 @@ def test_parse_args() -> None:
         nr.parse_args(["nixos-rebuild", "edit", "--attr", "attr"])
     assert e.value.code == 2
 
+    with pytest.raises(SystemExit) as e:
+        nr.parse_args(["nixos-rebuild", "list-generations", "--build-host", "host"])
+    assert e.value.code == 2
+
     r1, g1 = nr.parse_args(
         [
             "nixos-rebuild",
@@ -126,10 +131,55 @@ def test_parse_args() -> None:
     ]
 
 
+def test_parse_args_target_hosts() -> None:
+    with pytest.raises(SystemExit) as e:
+        nr.parse_args(["nixos-rebuild", "build", "--target-hosts", "host1,host2"])
+    assert e.value.code == 2
+
+    with pytest.raises(SystemExit) as e:
+        nr.parse_args(
+            [
+                "nixos-rebuild",
+                "switch",
+                "--target-hosts",
+                "host1",
+                "--target-host",
+                "host2",
+            ]
+        )
+    assert e.value.code == 2
+
+    with pytest.raises(SystemExit) as e:
+        nr.parse_args(
+            [
+                "nixos-rebuild",
+                "switch",
+                "--target-hosts",
+                "host1",
+                "--fleet-max-failures",
+                "2",
+            ]
+        )
+    assert e.value.code == 2
+
+    r, _ = nr.parse_args(
+        ["nixos-rebuild", "switch", "--target-hosts", "host1,host2,,host1"]
+    )
+    assert r.target_hosts == ["host1", "host2"]
+    assert r.fleet_jobs == 8
+    assert r.fleet_max_failures == 0
+
+
 @patch.dict(nr.os.environ, {}, clear=True)
 @patch(get_qualified_name(nr.os.execve, nr.os), autospec=True)
 @patch(get_qualified_name(nr.nix.build), autospec=True)
-def test_reexec(mock_build: Mock, mock_execve: Mock, monkeypatch: MonkeyPatch) -> None:
+@patch(get_qualified_name(nr.get_reexec_cache_key), autospec=True, return_value=None)
+def test_reexec(
+    mock_get_reexec_cache_key: Mock,
+    mock_build: Mock,
+    mock_execve: Mock,
+    monkeypatch: MonkeyPatch,
+) -> None:
     monkeypatch.setattr(nr, "EXECUTABLE", "nixos-rebuild-ng")
     argv = ["/path/bin/nixos-rebuild-ng", "switch", "--no-flake"]
     args, _ = nr.parse_args(argv)
@@ -173,8 +223,12 @@ def test_reexec(mock_build: Mock, mock_execve: Mock, monkeypatch: MonkeyPatch) -
 @patch.dict(nr.os.environ, {}, clear=True)
 @patch(get_qualified_name(nr.os.execve, nr.os), autospec=True)
 @patch(get_qualified_name(nr.nix.build_flake), autospec=True)
+@patch(get_qualified_name(nr.get_reexec_cache_key), autospec=True, return_value=None)
 def test_reexec_flake(
-    mock_build: Mock, mock_execve: Mock, monkeypatch: MonkeyPatch
+    mock_get_reexec_cache_key: Mock,
+    mock_build: Mock,
+    mock_execve: Mock,
+    monkeypatch: MonkeyPatch,
 ) -> None:
     monkeypatch.setattr(nr, "EXECUTABLE", "nixos-rebuild-ng")
     argv = ["/path/bin/nixos-rebuild-ng", "switch", "--flake"]
@@ -212,6 +266,80 @@ def test_reexec_flake(
     )
 
 
+@patch.dict(nr.os.environ, {}, clear=True)
+@patch(get_qualified_name(nr.os.execve, nr.os), autospec=True)
+@patch(get_qualified_name(nr.nix.add_gcroot), autospec=True)
+@patch(get_qualified_name(nr.nix.build_flake), autospec=True)
+@patch(get_qualified_name(nr.nix.get_flake_lock_hash), autospec=True)
+def test_reexec_cache(
+    mock_get_flake_lock_hash: Mock,
+    mock_build: Mock,
+    mock_add_gcroot: Mock,
+    mock_execve: Mock,
+    monkeypatch: MonkeyPatch,
+    tmp_path: Path,
+    cache_dir: Path,
+) -> None:
+    monkeypatch.setattr(nr, "EXECUTABLE", "nixos-rebuild-ng")
+    # os.environ was cleared after the cache_dir fixture set it
+    monkeypatch.setenv("XDG_CACHE_HOME", str(cache_dir.parent))
+    env = {"XDG_CACHE_HOME": str(cache_dir.parent), "_NIXOS_REBUILD_REEXEC": "1"}
+    argv = ["/path/bin/nixos-rebuild-ng", "switch", "--flake", "/etc/nixos"]
+    args, _ = nr.parse_args(argv)
+    mock_get_flake_lock_hash.return_value = "lock-hash"
+    mock_build.return_value = tmp_path / "new"
+    (tmp_path / "new").mkdir()
+
+    nr.reexec(argv, args, {}, {"flake": True})
+    (key,) = json.loads((cache_dir / "reexec-v1.json").read_text())
+    gcroot = cache_dir / "reexec" / key
+    mock_build.assert_called_once_with(
+        "config.system.build.nixos-rebuild",
+        nr.models.Flake(ANY, ANY),
+        {"flake": True, "out_link": str(gcroot)},
+    )
+    mock_execve.assert_called_once_with(
+        tmp_path / "new/bin/nixos-rebuild-ng", argv, env
+    )
+
+    # same flake.lock, skip the build and re-exec the cached version
+    mock_build.reset_mock()
+    mock_execve.reset_mock()
+    nr.reexec(argv, args, {}, {"flake": True})
+    mock_build.assert_not_called()
+    mock_add_gcroot.assert_called_once_with(tmp_path / "new", gcroot)
+    mock_execve.assert_called_once_with(
+        tmp_path / "new/bin/nixos-rebuild-ng", argv, env
+    )
+
+    # flake.lock changed, build again
+    mock_get_flake_lock_hash.return_value = "other-lock-hash"
+    nr.reexec(argv, args, {}, {"flake": True})
+    mock_build.assert_called_once()
+
+
+@patch(get_qualified_name(nr.nix.get_nixpkgs_rev), autospec=True)
+@patch(get_qualified_name(nr.nix.find_file), autospec=True)
+def test_get_reexec_cache_key(
+    mock_find_file: Mock, mock_get_nixpkgs_rev: Mock, tmp_path: Path
+) -> None:
+    build_attr = nr.models.BuildAttr.from_arg(None, None)
+    mock_find_file.return_value = tmp_path
+    mock_get_nixpkgs_rev.return_value = "abcdef"
+    key = nr.get_reexec_cache_key(None, build_attr, {}, {})
+    assert key is not None
+    assert nr.get_reexec_cache_key(None, build_attr, {"flag": True}, {}) != key
+
+    # uncommitted changes in Nixpkgs
+    mock_get_nixpkgs_rev.return_value = "abcdefM"
+    assert nr.get_reexec_cache_key(None, build_attr, {}, {}) is None
+
+    # --file configurations can change without Nixpkgs changing
+    build_attr = nr.models.BuildAttr.from_arg(None, "default.nix")
+    mock_get_nixpkgs_rev.return_value = "abcdef"
+    assert nr.get_reexec_cache_key(None, build_attr, {}, {}) is None
+
+
 @patch.dict(nr.process.os.environ, {}, clear=True)
 @patch(get_qualified_name(nr.process.subprocess.run), autospec=True)
 def test_execute_nix_boot(mock_run: Mock, tmp_path: Path) -> None:
@@ -1060,3 +1188,62 @@ def test_execute_test_rollback(
             ),
         ]
     )
+
+
+@patch.dict(nr.process.os.environ, {}, clear=True)
+@patch(get_qualified_name(nr.process.subprocess.run), autospec=True)
+@patch(get_qualified_name(nr.cleanup_ssh, nr), autospec=True)
+def test_execute_nix_switch_flake_target_hosts(
+    mock_cleanup_ssh: Mock,
+    mock_run: Mock,
+    tmp_path: Path,
+) -> None:
+    config_path = tmp_path / "test"
+    config_path.touch()
+
+    def run_side_effect(args: list[str], **kwargs: Any) -> CompletedProcess[str]:
+        if args[0] == "nix":
+            return CompletedProcess([], 0, str(config_path))
+        else:
+            return CompletedProcess([], 0)
+
+    mock_run.side_effect = run_side_effect
+
+    nr.execute(
+        [
+            "nixos-rebuild",
+            "switch",
+            "--flake",
+            "/path/to/config#hostname",
+            "--sudo",
+            "--target-hosts",
+            "host1,host2",
+            "--no-reexec",
+        ]
+    )
+
+    # built only once, copied, set and activated once per host
+    assert mock_run.call_count == 7
+    builds = [c for c in mock_run.call_args_list if c.args[0][0] == "nix"]
+    assert len(builds) == 1
+    for host in ["host1", "host2"]:
+        mock_run.assert_any_call(
+            ["nix-copy-closure", "--to", host, config_path],
+            check=True,
+            **DEFAULT_RUN_KWARGS,
+        )
+        mock_run.assert_any_call(
+            [
+                "ssh",
+                *nr.process.SSH_DEFAULT_OPTS,
+                host,
+                "--",
+                "sudo",
+                "env",
+                "NIXOS_INSTALL_BOOTLOADER=0",
+                str(config_path / "bin/switch-to-configuration"),
+                "switch",
+            ],
+            check=True,
+            **DEFAULT_RUN_KWARGS,
+        )
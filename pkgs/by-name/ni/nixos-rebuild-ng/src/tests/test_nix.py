@@ -1,7 +1,8 @@
+import json
 import textwrap
 import uuid
 from pathlib import Path
-from subprocess import PIPE, CompletedProcess
+from subprocess import PIPE, CalledProcessError, CompletedProcess
 from typing import Any
 from unittest.mock import ANY, Mock, call, patch
 
@@ -291,6 +292,57 @@ def test_copy_closure(monkeypatch: MonkeyPatch) -> None:
         )
 
 
+@patch(get_qualified_name(n.run_wrapper, n), autospec=True)
+def test_copy_closure_from_peer(mock_run: Mock, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.delenv("NIX_SSHOPTS", raising=False)
+    target_host = m.Remote("user@target.host", [], None)
+    peer_host = m.Remote("user@peer.host", [], None)
+    n.copy_closure_from_peer(
+        [Path("/nix/store/a"), Path("/nix/store/b")],
+        to_host=target_host,
+        from_host=peer_host,
+        copy_flags={"s": True},
+    )
+    mock_run.assert_called_with(
+        [
+            "nix",
+            "--extra-experimental-features",
+            "nix-command flakes",
+            "copy",
+            "-s",
+            "--from",
+            "ssh://user@peer.host",
+            Path("/nix/store/a"),
+            Path("/nix/store/b"),
+        ],
+        remote=target_host,
+        sudo=False,
+        extra_env=None,
+    )
+
+    monkeypatch.setenv("NIX_SSHOPTS", "-p 2222")
+    n.copy_closure_from_peer(
+        [Path("/nix/store/a")],
+        to_host=target_host,
+        from_host=peer_host,
+        sudo=True,
+    )
+    mock_run.assert_called_with(
+        [
+            "nix",
+            "--extra-experimental-features",
+            "nix-command flakes",
+            "copy",
+            "--from",
+            "ssh://user@peer.host",
+            Path("/nix/store/a"),
+        ],
+        remote=target_host,
+        sudo=True,
+        extra_env={"NIX_SSHOPTS": "-p 2222"},
+    )
+
+
 @patch(get_qualified_name(n.run_wrapper, n), autospec=True)
 def test_edit(mock_run: Mock, monkeypatch: MonkeyPatch, tmpdir: Path) -> None:
     # Flake
@@ -418,6 +470,17 @@ def test_get_build_image_variants_flake(mock_run: Mock) -> None:
     )
 
 
+def test_get_flake_lock_hash(tmp_path: Path) -> None:
+    flake = m.Flake(tmp_path, "nixosConfigurations.hostname")
+    assert n.get_flake_lock_hash(flake) is None
+
+    (tmp_path / "flake.lock").write_text("{}")
+    lock_hash = n.get_flake_lock_hash(flake)
+    assert lock_hash is not None
+    assert n.get_flake_lock_hash(m.Flake(f"git+file://{tmp_path}", "")) == lock_hash
+    assert n.get_flake_lock_hash(m.Flake("github:NixOS/nixpkgs", "")) is None
+
+
 def test_get_nixpkgs_rev() -> None:
     assert n.get_nixpkgs_rev(None) is None
 
@@ -470,6 +533,85 @@ def test_get_nixpkgs_rev() -> None:
         mock_run.assert_has_calls(expected_calls)
 
 
+@pytest.mark.parametrize(
+    "output",
+    [
+        # Nix >=2.19
+        {
+            "/nix/store/a": {"references": ["/nix/store/a", "/nix/store/b"]},
+            "/nix/store/b": {"references": []},
+        },
+        [
+            {"path": "/nix/store/a", "references": ["/nix/store/a", "/nix/store/b"]},
+            {"path": "/nix/store/b", "references": []},
+        ],
+    ],
+)
+def test_get_closure_references(output: Any) -> None:
+    remote = m.Remote("user@host", [], None)
+    with patch(
+        get_qualified_name(n.run_wrapper, n),
+        autospec=True,
+        return_value=CompletedProcess([], 0, stdout=json.dumps(output)),
+    ) as mock_run:
+        assert n.get_closure_references(Path("/nix/store/a"), remote) == {
+            Path("/nix/store/a"): {Path("/nix/store/a"), Path("/nix/store/b")},
+            Path("/nix/store/b"): set(),
+        }
+    mock_run.assert_called_with(
+        [
+            "nix",
+            "--extra-experimental-features",
+            "nix-command flakes",
+            "path-info",
+            "--json",
+            "--recursive",
+            Path("/nix/store/a"),
+        ],
+        remote=remote,
+        stdout=PIPE,
+    )
+
+
+def test_get_copy_size() -> None:
+    target_host = m.Remote("user@target.host", [], None)
+    path_info = {
+        "/nix/store/a": {"narSize": 10, "references": ["/nix/store/b"]},
+        "/nix/store/b": {"narSize": 20, "references": []},
+    }
+
+    def run_side_effect(args: list[str], **kwargs: Any) -> CompletedProcess[str]:
+        if args[0] == "nix":
+            return CompletedProcess([], 0, stdout=json.dumps(path_info))
+        else:
+            return CompletedProcess([], 0, stdout="/nix/store/a\n")
+
+    with patch(
+        get_qualified_name(n.run_wrapper, n),
+        autospec=True,
+        side_effect=run_side_effect,
+    ) as mock_run:
+        assert n.get_copy_size([Path("/nix/store/a")], target_host, None) == 10
+    mock_run.assert_called_with(
+        [
+            "nix-store",
+            "--check-validity",
+            "--print-invalid",
+            "/nix/store/a",
+            "/nix/store/b",
+        ],
+        remote=target_host,
+        stdout=PIPE,
+    )
+
+    with patch(
+        get_qualified_name(n.run_wrapper, n),
+        autospec=True,
+        side_effect=CalledProcessError(1, "nix"),
+    ):
+        assert n.get_copy_size([Path("/nix/store/a")], target_host, None) is None
+
+
 def test_get_generations(tmp_path: Path) -> None:
     nixos_path = tmp_path / "nixos-system"
     nixos_path.mkdir()
@@ -575,6 +717,116 @@ def test_list_generations(mock_get_generations: Mock, tmp_path: Path) -> None:
     ]
 
 
+@patch(
+    get_qualified_name(n.get_generation_info),
+    autospec=True,
+    return_value={
+        "nixosVersion": "24.11",
+        "kernelVersion": "6.6.0",
+        "configurationRevision": "abc",
+        "specialisations": [],
+    },
+)
+@patch(
+    get_qualified_name(n.get_generations),
+    autospec=True,
+    return_value=[m.Generation(id=1, timestamp="2024-11-07 23:54:17", current=True)],
+)
+def test_list_generations_cache(
+    mock_get_generations: Mock,
+    mock_get_generation_info: Mock,
+    tmp_path: Path,
+    cache_dir: Path,
+) -> None:
+    store_path = tmp_path / "nixos-system"
+    store_path.mkdir()
+    (tmp_path / "system-1-link").symlink_to(store_path)
+    profile = m.Profile("system", tmp_path / "system")
+
+    expected = [
+        {
+            "generation": 1,
+            "date": "2024-11-07 23:54:17",
+            "nixosVersion": "24.11",
+            "kernelVersion": "6.6.0",
+            "configurationRevision": "abc",
+            "specialisations": [],
+            "current": True,
+        }
+    ]
+    assert n.list_generations(profile) == expected
+    assert n.list_generations(profile) == expected
+    mock_get_generation_info.assert_called_once_with(store_path)
+    assert str(store_path) in json.loads((cache_dir / n.GENERATIONS_CACHE).read_text())
+
+
+def test_list_generations_remote() -> None:
+    target_host = m.Remote("user@host", [], None)
+    profile = m.Profile("system", Path("/nix/var/nix/profiles/system"))
+
+    def run_side_effect(args: list[str], **kwargs: Any) -> CompletedProcess[str]:
+        if args[-1] == "system":
+            return CompletedProcess(
+                [],
+                0,
+                stdout=textwrap.dedent("""\
+                system-1-link 1731020057
+                system-2-link 1731023657
+                /nix/store/1-nixos-system
+                /nix/store/2-nixos-system
+                system-2-link
+                """),
+            )
+        else:
+            return CompletedProcess(
+                [],
+                0,
+                stdout=textwrap.dedent("""\
+                /nix/store/2-nixos-system
+                24.11
+
+                foo/bar/
+                abc
+                """),
+            )
+
+    cached = {
+        "nixosVersion": "24.05",
+        "kernelVersion": "6.1.0",
+        "configurationRevision": "Unknown",
+        "specialisations": [],
+    }
+    n.cache.save(n.GENERATIONS_CACHE, {"/nix/store/1-nixos-system": cached})
+
+    with patch(
+        get_qualified_name(n.run_wrapper, n),
+        autospec=True,
+        side_effect=run_side_effect,
+    ) as mock_run:
+        assert n.list_generations(profile, target_host) == [
+            {
+                "generation": 2,
+                "date": ANY,
+                "nixosVersion": "24.11",
+                "kernelVersion": "Unknown",
+                "configurationRevision": "abc",
+                "specialisations": ["foo", "bar"],
+                "current": True,
+            },
+            {
+                "generation": 1,
+                "date": ANY,
+                "current": False,
+                **cached,
+            },
+        ]
+
+    # Only the generation missing from the cache is queried
+    assert mock_run.call_count == 2
+    assert mock_run.call_args.args[0][4:] == ["/nix/store/2-nixos-system"]
+    assert mock_run.call_args.kwargs["remote"] == target_host
+
+
 @patch(get_qualified_name(n.run_wrapper, n), autospec=True)
 def test_repl(mock_run: Mock) -> None:
     n.repl("attr", m.BuildAttr("<nixpkgs/nixos>", None), {"nix_flag": True})
@@ -0,0 +1,124 @@
+import json
+from pathlib import Path
+from subprocess import CompletedProcess
+from typing import Any
+from unittest.mock import Mock, patch
+
+import pytest
+from pytest import MonkeyPatch
+
+import nixos_rebuild.process as p
+import nixos_rebuild.timings as t
+
+from .helpers import get_qualified_name
+
+
+@pytest.fixture
+def trace(monkeypatch: MonkeyPatch, tmp_path: Path) -> Path:
+    monkeypatch.setattr(t, "_events", [])
+    monkeypatch.setattr(t, "_threads", set())
+    monkeypatch.setattr(t, "_path", None)
+    monkeypatch.delenv("_NIXOS_REBUILD_REEXEC", raising=False)
+    with patch(get_qualified_name(t.atexit.register, t.atexit), autospec=True):
+        t.enable(tmp_path / "trace.json")
+    return tmp_path / "trace.json"
+
+
+def read_events(path: Path) -> list[dict[str, Any]]:
+    t.write()
+    events: list[dict[str, Any]] = json.loads(path.read_text())["traceEvents"]
+    return [e for e in events if e["ph"] == "X"]
+
+
+def test_disabled(monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setattr(t, "_events", [])
+    monkeypatch.setattr(t, "_path", None)
+    with t.phase("build") as event:
+        event["foo"] = "bar"
+    assert not t.is_enabled()
+    assert t._events == []
+
+
+def test_span(trace: Path) -> None:
+    with t.phase("build", host="host") as event:
+        event["bytes"] = 42
+
+    with pytest.raises(ValueError), t.phase("switch_to_configuration"):
+        raise ValueError("oops")
+
+    build, switch = read_events(trace)
+    assert build["name"] == "build"
+    assert build["cat"] == "phase"
+    assert build["dur"] >= 0
+    assert build["args"] == {"host": "host", "bytes": 42}
+    assert switch["args"] == {"error": "ValueError"}
+
+
+def test_enable_after_reexec(
+    trace: Path, monkeypatch: MonkeyPatch, tmp_path: Path
+) -> None:
+    with t.phase("reexec"):
+        pass
+    t.write()
+
+    monkeypatch.setattr(t, "_events", [])
+    monkeypatch.setenv("_NIXOS_REBUILD_REEXEC", "1")
+    t.enable(trace)
+    with t.phase("build"):
+        pass
+
+    assert [e["name"] for e in read_events(trace)] == ["reexec", "build"]
+
+
+@patch(
+    get_qualified_name(p.subprocess.run),
+    autospec=True,
+    return_value=CompletedProcess([], 0),
+)
+def test_run_wrapper(mock_run: Mock, trace: Path) -> None:
+    p.run_wrapper(["test", "--with", "flags"], check=True)
+    p.run_wrapper(
+        ["/bin/test", "--with", "flags"],
+        check=True,
+        remote=p.Remote("user@localhost", [], None),
+        sudo=True,
+    )
+
+    local, remote = read_events(trace)
+    assert local["name"] == "test"
+    assert local["cat"] == "local"
+    assert local["args"] == {
+        "command": "test --with flags",
+        "host": None,
+        "sudo": False,
+        "new_ssh_connection": False,
+        "returncode": 0,
+    }
+    assert remote["name"] == "test"
+    assert remote["cat"] == "remote"
+    assert remote["args"] == {
+        "command": "/bin/test --with flags",
+        "host": "user@localhost",
+        "sudo": True,
+        "new_ssh_connection": True,
+        "returncode": 0,
+    }
+
+
+@patch(
+    get_qualified_name(p.subprocess.run),
+    autospec=True,
+    return_value=CompletedProcess([], 0),
+)
+def test_run_wrapper_existing_ssh_connection(
+    mock_run: Mock, trace: Path, monkeypatch: MonkeyPatch, tmp_path: Path
+) -> None:
+    monkeypatch.setattr(p.tmpdir, "TMPDIR_PATH", tmp_path)
+    # ControlPath=ssh-%n, where %n doesn't include the user
+    (tmp_path / "ssh-localhost").touch()
+    p.run_wrapper(["test"], remote=p.Remote("user@localhost", [], None))
+    p.run_wrapper(["test"], remote=p.Remote("otherhost", [], None))
+
+    existing, new = read_events(trace)
+    assert existing["args"]["new_ssh_connection"] is False
+    assert new["args"]["new_ssh_connection"] is True
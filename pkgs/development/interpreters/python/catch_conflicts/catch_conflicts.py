@@ -1,19 +1,39 @@
 from importlib.metadata import PathDistribution
 from pathlib import Path
 import collections
+import re
 import sys
 import os
-from typing import Dict, List, Set, Tuple
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 do_abort: bool = False
-packages: Dict[str, Dict[str, Dict[str, List[str]]]] = collections.defaultdict(dict)
+packages: Dict[str, Dict[Path, str]] = collections.defaultdict(dict)
 found_paths: Set[Path] = set()
+# how each visited path was first reached, to describe its dependency chain
+parent_paths: Dict[Path, Optional[Path]] = {}
+path_labels: Dict[Path, str] = {}
 out_path: Path = Path(os.getenv("out"))
 version: Tuple[int, int] = sys.version_info
 site_packages_path: str = f'lib/python{version[0]}.{version[1]}/site-packages'
 
 
+# normalize a distribution name (PEP 503), so that e.g. 'zope.interface' and
+# 'zope_interface' are recognized as the same package
+def normalize_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "_", name).lower()
+
+
 def get_name(dist: PathDistribution) -> str:
-    return dist.metadata['name'].lower().replace('-', '_')
+    return normalize_name(dist.metadata['name'])
+
+
+# get the name and version of a .dist-info directory, from its directory name
+# '{name}-{version}.dist-info' if possible, to avoid parsing its METADATA
+def get_name_and_version(dist_info: Path) -> Tuple[str, str]:
+    parts = dist_info.name[:-len(".dist-info")].split("-")
+    if len(parts) == 2 and all(parts):
+        return normalize_name(parts[0]), parts[1]
+    dist: PathDistribution = PathDistribution(dist_info)
+    return get_name(dist), dist.version
 
 
 # pretty print a package
@@ -30,49 +50,76 @@ def describe_parents(parents: List[str]) -> str:
         + str(f"\n      ...depending on: ".join(parents))
 
 
+# reconstruct the dependency chain leading to a path from the parent pointers
+def get_parents(store_path: Path) -> List[str]:
+    parents: List[str] = []
+    node: Optional[Path] = store_path
+    while node is not None:
+        parents.append(path_labels[node])
+        node = parent_paths[node]
+    parents.reverse()
+    return parents
+
+
 # inserts an entry into 'packages'
-def add_entry(name: str, version: str, store_path: str, parents: List[str]) -> None:
-    packages[name][store_path] = dict(
-        version=version,
-        parents=parents,
-    )
+def add_entry(name: str, version: str, store_path: Path) -> None:
+    packages[name][store_path] = version
 
 
-# transitively discover python dependencies and store them in 'packages'
-def find_packages(store_path: Path, site_packages_path: str, parents: List[str]) -> None:
+# visit a path: record its python packages and return its dependencies
+def visit(store_path: Path, site_packages_path: str) -> List[str]:
     site_packages: Path = (store_path / site_packages_path)
     propagated_build_inputs: Path = (store_path / "nix-support/propagated-build-inputs")
 
-    # only visit each path once, to avoid exponential complexity with highly
-    # connected dependency graphs
-    if store_path in found_paths:
-        return
-    found_paths.add(store_path)
-
     # add the current package to the list
     if site_packages.exists():
         for dist_info in site_packages.glob("*.dist-info"):
-            dist: PathDistribution = PathDistribution(dist_info)
-            add_entry(get_name(dist), dist.version, store_path, parents)
+            add_entry(*get_name_and_version(dist_info), store_path)
 
-    # recursively add dependencies
     if propagated_build_inputs.exists():
         with open(propagated_build_inputs, "r") as f:
-            build_inputs: List[str] = f.read().split()
-            for build_input in build_inputs:
-                find_packages(Path(build_input), site_packages_path, parents + [build_input])
+            return f.read().split()
+    return []
 
 
-find_packages(out_path, site_packages_path, [f"this derivation: {out_path}"])
+# transitively discover python dependencies and store them in 'packages'
+#
+# This is a depth-first search visiting the paths in the same order as a
+# recursive one would, using a stack of iterators instead of recursion.
+def find_packages(store_path: Path, site_packages_path: str, label: str) -> None:
+    found_paths.add(store_path)
+    parent_paths[store_path] = None
+    path_labels[store_path] = label
+    stack: List[Tuple[Path, Iterator[str]]] = [
+        (store_path, iter(visit(store_path, site_packages_path)))
+    ]
+    while stack:
+        parent, build_inputs = stack[-1]
+        build_input = next(build_inputs, None)
+        if build_input is None:
+            stack.pop()
+            continue
+        path = Path(build_input)
+        # only visit each path once, to avoid exponential complexity with
+        # highly connected dependency graphs
+        if path in found_paths:
+            continue
+        found_paths.add(path)
+        parent_paths[path] = parent
+        path_labels[path] = build_input
+        stack.append((path, iter(visit(path, site_packages_path))))
+
+
+find_packages(out_path, site_packages_path, f"this derivation: {out_path}")
 
 # print all duplicates
 for name, store_paths in packages.items():
     if len(store_paths) > 1:
         do_abort = True
         print("Found duplicated packages in closure for dependency '{}': ".format(name))
-        for store_path, candidate in store_paths.items():
-            print(f"  {name} {candidate['version']} ({store_path})")
-            print(describe_parents(candidate['parents']))
+        for store_path, package_version in store_paths.items():
+            print(f"  {name} {package_version} ({store_path})")
+            print(describe_parents(get_parents(store_path)))
 
 # fail if duplicates were found
 if do_abort:
@@ -173,6 +173,10 @@ in
   # Skip setting the PYTHONNOUSERSITE environment variable in wrapped programs
   permitUserSite ? false,
 
+  # Let wrapped programs set up sys.path from an index of their dependencies,
+  # instead of listing every site directory on startup. See wrap.sh.
+  siteIndex ? false,
+
   # Remove bytecode from bin folder.
   # When a Python script has the extension `.py`, bytecode is generated
   # Typically, executables in bin have no extension, so no bytecode is generated.
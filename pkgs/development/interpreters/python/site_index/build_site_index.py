@@ -0,0 +1,111 @@
+"""
+Build an index of Python site directories, to be loaded by sitecustomize.py.
+
+Usage: build_site_index.py OUTPUT SITEDIR...
+
+Programs wrapped by wrapPythonPrograms add the site directory of every one of
+their dependencies with `site.addsitedir`, which lists them and reads their
+`.pth` files on each start, and imports then look for modules in every
+directory. The index records all of this once: the `sys.path` entries and `.pth`
+imports in the order `site.addsitedir` would produce them, and for every
+top-level module the site directory it is imported from. With `siteIndex`,
+wrap.sh builds it and the wrapped programs load it with
+`sitecustomize.load_site_index` instead.
+
+The index must be built by the interpreter that is going to use it, since it
+depends on its module suffixes and its standard library.
+
+This script is in a subdirectory for the same reason as catch_conflicts.py.
+"""
+
+import importlib.machinery
+import os
+import site
+import sys
+
+INDEX_VERSION = 1
+
+# Modules of the interpreter itself are found before the site directories
+RESERVED_MODULES = set(sys.builtin_module_names) | set(getattr(sys, "stdlib_module_names", ()))
+
+
+# add a site directory like site.addsitedir, recording what it does
+def add_sitedir(sitedir, known_paths, entries):
+    sitedir, sitedircase = site.makepath(sitedir)
+    if sitedircase not in known_paths:
+        entries.append(("path", sitedir))
+        known_paths.add(sitedircase)
+    try:
+        names = os.listdir(sitedir)
+    except OSError:
+        return
+    for name in sorted(names):
+        if name.endswith(".pth") and not name.startswith("."):
+            add_package(sitedir, name, known_paths, entries)
+
+
+# process a .pth file like site.addpackage, recording what it does
+def add_package(sitedir, name, known_paths, entries):
+    try:
+        with open(os.path.join(sitedir, name), encoding="utf-8-sig") as f:
+            lines = f.read().splitlines()
+    except (OSError, UnicodeDecodeError):
+        return
+    for line in lines:
+        if line.startswith("#") or not line.strip():
+            continue
+        if line.startswith(("import ", "import\t")):
+            entries.append(("exec", line))
+            continue
+        line = line.rstrip()
+        directory, directorycase = site.makepath(sitedir, line)
+        if directorycase not in known_paths and os.path.exists(directory):
+            entries.append(("path", directory))
+            known_paths.add(directorycase)
+
+
+# find the top-level modules in a directory that are not namespace packages
+def find_modules(directory):
+    suffixes = importlib.machinery.all_suffixes()
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in sorted(names):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            if name.isidentifier() and any(os.path.isfile(os.path.join(path, "__init__" + suffix)) for suffix in suffixes):
+                yield name
+            continue
+        for suffix in suffixes:
+            if name.endswith(suffix) and name[:-len(suffix)].isidentifier():
+                yield name[:-len(suffix)]
+                break
+
+
+def main():
+    output, sitedirs = sys.argv[1], sys.argv[2:]
+
+    entries = []
+    known_paths = set()
+    for sitedir in sitedirs:
+        add_sitedir(sitedir, known_paths, entries)
+
+    # Like the path based finder, use the first directory a module is found in
+    modules = {}
+    for kind, value in entries:
+        if kind == "path":
+            for module in find_modules(value):
+                if module not in RESERVED_MODULES:
+                    modules.setdefault(module, value)
+
+    with open(output, "w") as f:
+        f.write(f"nix-site-index {INDEX_VERSION} {sys.implementation.cache_tag}\n")
+        for kind, value in entries:
+            f.write(f"{kind} {value}\n")
+        for module, directory in sorted(modules.items()):
+            f.write(f"module {module} {directory}\n")
+
+
+if __name__ == "__main__":
+    main()
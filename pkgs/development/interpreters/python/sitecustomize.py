@@ -11,12 +11,93 @@ Note the `NIX_PYTHONPATH` environment variable is unset in order to prevent leak
 
 Similarly, this module listens to the environment variable `NIX_PYTHONEXECUTABLE`
 and sets `sys.executable` to its value.
+
+Programs wrapped by `wrapPythonPrograms` with a site index call `load_site_index`
+instead of adding their dependencies with `site.addsitedir`, see
+`site_index/build_site_index.py`.
 """
 import site
 import sys
 import os
 import functools
 
+
+class NixSiteIndexFinder(object):
+    """Find the top-level modules listed in a site index in their directory.
+
+    Only the `sys.path` entries before the indexed ones are searched first,
+    instead of all of them, which preserves their precedence.
+    """
+
+    def __init__(self, modules, first_path):
+        self.modules = modules
+        self.first_path = first_path
+
+    def find_spec(self, name, path=None, target=None):
+        from importlib.machinery import PathFinder
+
+        directory = self.modules.get(name)
+        if path is not None or directory is None:
+            return None
+        try:
+            position = sys.path.index(self.first_path)
+        except ValueError:
+            return None
+        spec = PathFinder.find_spec(name, sys.path[:position], target)
+        # Namespace packages are only used if there is no regular module
+        if spec is not None and spec.origin is not None:
+            return spec
+        return PathFinder.find_spec(name, [directory], target)
+
+
+def load_site_index(index_file):
+    """Set up `sys.path` from a site index, returning False if it can't be used.
+
+    The index sets up `sys.path` with a single read, without listing the site
+    directories or reading their `.pth` files, and tells the import system which
+    directory each of their modules is in.
+    """
+    try:
+        with open(index_file) as f:
+            lines = f.read().splitlines()
+    except (IOError, OSError):
+        return False
+    if not lines or lines[0] != 'nix-site-index 1 %s' % sys.implementation.cache_tag:
+        return False
+
+    known_paths = site._init_pathinfo()
+    modules = {}
+    first_path = None
+    for line in lines[1:]:
+        kind, _, value = line.partition(' ')
+        if kind == 'path':
+            directory, directorycase = site.makepath(value)
+            if directorycase not in known_paths:
+                sys.path.append(directory)
+                known_paths.add(directorycase)
+                if first_path is None:
+                    first_path = directory
+        elif kind == 'exec':
+            # Lines of .pth files starting with `import`, see `site.addpackage`
+            try:
+                exec(value)
+            except Exception:
+                import traceback
+                sys.stderr.write('Error processing line of %s: %s\n' % (index_file, value))
+                traceback.print_exc()
+        elif kind == 'module':
+            name, _, directory = value.partition(' ')
+            modules[name] = directory
+
+    if modules and first_path is not None:
+        from importlib.machinery import PathFinder
+
+        finder = NixSiteIndexFinder(modules, first_path)
+        if PathFinder in sys.meta_path:
+            sys.meta_path.insert(sys.meta_path.index(PathFinder), finder)
+    return True
+
+
 paths = os.environ.pop('NIX_PYTHONPATH', None)
 if paths:
     functools.reduce(lambda k, p: site.addsitedir(p, k), paths.split(':'), site._init_pathinfo())
@@ -110,6 +110,11 @@ let
     tkinter = callPackage ./tests/test_tkinter {
       interpreter = python;
     };
+  } // lib.optionalAttrs (python.isPy3k) {
+    # Make sure a site index is equivalent to site.addsitedir in wrapped programs, and benchmark it
+    site-index = callPackage ./tests/test_site_index {
+      interpreter = python;
+    };
   } // lib.optionalAttrs (python.isPy3k && python.pythonOlder "3.13" && !stdenv.hostPlatform.isDarwin) { # darwin has no split-debug
     # fails on python3.13
     cpython-gdb = callPackage ./tests/test_cpython_gdb {
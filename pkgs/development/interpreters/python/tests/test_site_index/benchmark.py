@@ -0,0 +1,128 @@
+"""
+Compare the startup of programs wrapped by wrapPythonPrograms with and without
+a site index built by build_site_index.py, for different numbers of dependencies.
+
+Like with wrapPythonPrograms, every dependency has its own site directory with
+a package and its .dist-info, and the program starts with the preamble that
+wrap-python.nix inserts, adding them with site.addsitedir or loading the index.
+Every tenth dependency also has a .pth file adding another directory and
+running an import. Both programs must result in the same sys.path and import
+the same files, otherwise this script fails.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Keep in sync with the preamble in wrap-python.nix
+PREAMBLE = (
+    "import sys;import site;import functools;sys.argv[0] = '{program}';"
+    "{load_index}functools.reduce(lambda k, p: site.addsitedir(p, k), [{sitedirs}], site._init_pathinfo());\n"
+)
+LOAD_INDEX = (
+    'getattr(sys.modules.get("sitecustomize"), "load_site_index", lambda f: False)("{index}") or '
+)
+
+# The program imports some of its dependencies, like most programs would
+PROGRAM = """\
+import {imports}
+print(sys.path)
+print({files})
+"""
+
+
+def make_environment(workdir, size):
+    sitedirs = []
+    for i in range(size):
+        prefix = os.path.join(workdir, f"env-{size}", f"dep-{i}")
+        sitedir = os.path.join(prefix, "lib", "site-packages")
+        package = os.path.join(sitedir, f"dep_{i}")
+        dist_info = os.path.join(sitedir, f"dep_{i}-1.0.dist-info")
+        os.makedirs(package, exist_ok=True)
+        os.makedirs(dist_info, exist_ok=True)
+        for name in ["__init__.py", "core.py", "utils.py"]:
+            with open(os.path.join(package, name), "w") as f:
+                f.write("")
+        for name in ["METADATA", "RECORD", "WHEEL"]:
+            with open(os.path.join(dist_info, name), "w") as f:
+                f.write("")
+        if i % 10 == 0:
+            extra = os.path.join(prefix, "extra")
+            os.makedirs(extra, exist_ok=True)
+            with open(os.path.join(extra, f"extra_{i}.py"), "w") as f:
+                f.write("")
+            with open(os.path.join(sitedir, f"dep_{i}.pth"), "w") as f:
+                f.write(f"# added by dep {i}\n../../extra\nimport sys\n")
+        sitedirs.append(sitedir)
+    return sitedirs
+
+
+def make_program(path, sitedirs, index=None):
+    size = len(sitedirs)
+    modules = [f"dep_{i}" for i in range(0, size, max(1, size // 20))] + [f"dep_{size - 1}", "extra_0"]
+    preamble = PREAMBLE.format(
+        program=path,
+        load_index=LOAD_INDEX.format(index=index) if index else "",
+        sitedirs=",".join(f"'{d}'" for d in sitedirs),
+    )
+    with open(path, "w") as f:
+        f.write(preamble)
+        f.write(PROGRAM.format(imports=", ".join(modules), files=", ".join(f"{m}.__file__" for m in modules)))
+
+
+def run(interpreter, env, program):
+    start = time.perf_counter()
+    output = subprocess.run(
+        [interpreter, program], env=env, check=True, stdout=subprocess.PIPE, text=True
+    ).stdout
+    return time.perf_counter() - start, output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--build-site-index", required=True, help="path to build_site_index.py")
+    parser.add_argument("--workdir", required=True, help="directory to create the environments in")
+    parser.add_argument("--interpreter", default=sys.executable)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 100, 300])
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    env = {k: v for k, v in os.environ.items() if not k.startswith("NIX_PYTHON")}
+    # Like in wrapped programs, otherwise looking for usercustomize dominates
+    env["PYTHONNOUSERSITE"] = "true"
+    # Otherwise both programs silently fall back to site.addsitedir
+    subprocess.run(
+        [args.interpreter, "-c", "import sitecustomize; sitecustomize.load_site_index"], env=env, check=True
+    )
+    print(f"{'deps':>6} {'addsitedir':>12} {'index':>10} {'speedup':>8}")
+    for size in args.sizes:
+        sitedirs = make_environment(args.workdir, size)
+        index = os.path.join(args.workdir, f"env-{size}", "site-index")
+        subprocess.run(
+            [args.interpreter, args.build_site_index, index, *sitedirs], check=True
+        )
+        programs = {
+            "path": os.path.join(args.workdir, f"env-{size}", "program"),
+            "index": os.path.join(args.workdir, f"env-{size}", "program-index"),
+        }
+        make_program(programs["path"], sitedirs)
+        make_program(programs["index"], sitedirs, index)
+
+        outputs = {mode: run(args.interpreter, env, program)[1] for mode, program in programs.items()}
+        if outputs["path"] != outputs["index"]:
+            sys.exit(f"the site index changes sys.path or imports:\n{outputs['path']}\n{outputs['index']}")
+
+        timings = {mode: [] for mode in programs}
+        for _ in range(args.runs):
+            for mode, program in programs.items():
+                timings[mode].append(run(args.interpreter, env, program)[0])
+        path_time = statistics.median(timings["path"]) * 1000
+        index_time = statistics.median(timings["index"]) * 1000
+        print(f"{size:>6} {path_time:>10.1f}ms {index_time:>8.1f}ms {path_time / index_time:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
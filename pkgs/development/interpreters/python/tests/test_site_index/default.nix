@@ -0,0 +1,15 @@
+{
+  interpreter,
+  runCommand,
+}:
+
+# Checks that a site index sets up the same sys.path as site.addsitedir in
+# programs wrapped by wrapPythonPrograms, and reports how much faster they
+# start with it.
+runCommand "${interpreter.name}-site-index-test" { } ''
+  ${interpreter.interpreter} ${./.}/benchmark.py \
+    --build-site-index ${../../site_index}/build_site_index.py \
+    --workdir "$TMPDIR/environments" \
+    --sizes 20 100 300 \
+    --runs 5 | tee $out
+''
@@ -10,6 +10,10 @@ makePythonHook {
       substitutions.executable = python.interpreter;
       substitutions.python = python.pythonOnBuildForHost;
       substitutions.pythonHost = python;
+      # The site index has to be built by the interpreter the programs run with
+      substitutions.buildSiteIndex = lib.optionalString
+        (python.isPy3k && python.stdenv.buildPlatform.canExecute python.stdenv.hostPlatform)
+        "${python.interpreter} ${./site_index}/build_site_index.py";
       substitutions.magicalSedExpression = let
         # Looks weird? Of course, it's between single quoted shell strings.
         # NOTE: Order DOES matter here, so single character quotes need to be
@@ -31,12 +35,14 @@ makePythonHook {
         # * Sets argv[0] to the original application's name; otherwise it would be .foo-wrapped.
         #   Python doesn't support `exec -a`.
         # * Adds all required libraries to sys.path via `site.addsitedir`. It also handles *.pth files.
+        #   With a site index (see wrap.sh), sitecustomize.py sets up sys.path from it instead,
+        #   falling back to `site.addsitedir` if it can't be used.
         preamble = ''
           import sys
           import site
           import functools
           sys.argv[0] = '"'$(readlink -f "$f")'"'
-          functools.reduce(lambda k, p: site.addsitedir(p, k), ['"$([ -n "$program_PYTHONPATH" ] && (echo "'$program_PYTHONPATH'" | sed "s|:|','|g") || true)"'], site._init_pathinfo())
+          '"''${program_SITE_INDEX:+getattr(sys.modules.get(\"sitecustomize\"), \"load_site_index\", lambda f: False)(\"$program_SITE_INDEX\") or }"'functools.reduce(lambda k, p: site.addsitedir(p, k), ['"$([ -n "$program_PYTHONPATH" ] && (echo "'$program_PYTHONPATH'" | sed "s|:|','|g") || true)"'], site._init_pathinfo())
         '';
 
       in ''
@@ -23,6 +23,28 @@ buildPythonPath() {
     done
 }
 
+# Builds an index of the site directories in $program_PYTHONPATH, so
+# wrapped programs can set up sys.path from it instead of listing every
+# directory and reading their .pth files on startup (see
+# site_index/build_site_index.py). Only done if `siteIndex` is set, and
+# the index is named after the directories, since wrapPythonProgramsIn
+# can be called for different ones.
+buildSiteIndex() {
+    local dir="$1"
+
+    program_SITE_INDEX=
+    if [ -z "${siteIndex-}" ] || [ -z "@buildSiteIndex@" ] || [ ! -d "$dir" ]; then
+        return
+    fi
+
+    local hash
+    hash="$(echo -n "$program_PYTHONPATH" | sha256sum | head -c 16)"
+    program_SITE_INDEX="$out/nix-support/python-site-index-$hash"
+    mkdir -p "$out/nix-support"
+    echo "building site index $program_SITE_INDEX"
+    @buildSiteIndex@ "$program_SITE_INDEX" ${program_PYTHONPATH//:/ }
+}
+
 # Patches a Python script so that it has correct libraries path and executable
 # name.
 patchPythonScript() {
@@ -31,7 +53,7 @@ patchPythonScript() {
     # The magicalSedExpression will invoke a "$(basename "$f")", so
     # if you change $f to something else, be sure to also change it
     # in pkgs/top-level/python-packages.nix!
-    # It also uses $program_PYTHONPATH.
+    # It also uses $program_PYTHONPATH and $program_SITE_INDEX.
     sed -i "$f" -re '@magicalSedExpression@'
 }
 
@@ -45,6 +67,7 @@ wrapPythonProgramsIn() {
     local f
 
     buildPythonPath "$pythonPath"
+    buildSiteIndex "$dir"
 
     # Find all regular files in the output directory that are executable.
     if [ -d "$dir" ]; then
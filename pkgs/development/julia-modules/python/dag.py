@@ -13,6 +13,8 @@ class Node:
 class DAG:
     def __init__(self):
         self.nodes = {}
+        # Transitive dependencies of every node, computed on first use
+        self.closures = None
 
     def add_node(self, node_name, dependencies=None):
         if node_name in self.nodes:
@@ -23,6 +25,7 @@ class DAG:
             node.dependencies.update(dependencies)
 
         self.nodes[node_name] = node
+        self.closures = None
 
     def add_dependency(self, node_name, dependency_name):
         if node_name not in self.nodes:
@@ -32,22 +35,55 @@ class DAG:
             raise ValueError(f"Dependency '{dependency_name}' does not exist in the graph.")
 
         self.nodes[node_name].dependencies.add(dependency_name)
+        self.closures = None
+
+    def get_transitive_closures(self):
+        """
+        Return a dict mapping every node to the set of its direct and
+        transitive dependencies, including those which aren't nodes.
+
+        The closures are computed in a single depth-first pass, where every
+        node is visited once and its closure is assembled from the memoised
+        closures of its dependencies. A dependency cycle raises a ValueError.
+        """
+        if self.closures is not None:
+            return self.closures
+
+        closures = {}
+        for root_name in self.nodes:
+            if root_name in closures:
+                continue
+
+            # The nodes currently being visited, and the iterators over their
+            # remaining dependencies
+            path = [root_name]
+            stack = [iter(self.nodes[root_name].dependencies)]
+            while stack:
+                for dependency in stack[-1]:
+                    if dependency in path:
+                        cycle = path[path.index(dependency):] + [dependency]
+                        raise ValueError(f"Dependency cycle in the graph: {' -> '.join(cycle)}")
+                    if dependency in self.nodes and dependency not in closures:
+                        path.append(dependency)
+                        stack.append(iter(self.nodes[dependency].dependencies))
+                        break
+                else:
+                    node_name = path.pop()
+                    stack.pop()
+                    closure = set()
+                    for dependency in self.nodes[node_name].dependencies:
+                        closure.add(dependency)
+                        closure.update(closures.get(dependency, ()))
+                    closures[node_name] = frozenset(closure)
+
+        self.closures = closures
+        return closures
 
     def get_dependencies(self, node_name):
         if node_name not in self.nodes:
             raise ValueError(f"Node '{node_name}' does not exist in the graph.")
 
-        node = self.nodes[node_name]
-        dependencies = set()
-
-        def traverse_dependencies(current_node):
-            for dependency in current_node.dependencies:
-                dependencies.add(dependency)
-                if dependency in self.nodes:
-                  traverse_dependencies(self.nodes[dependency])
-
-        traverse_dependencies(node)
-        return dependencies
+        return set(self.get_transitive_closures()[node_name])
 
     def has_node(self, node_name):
         return node_name in self.nodes
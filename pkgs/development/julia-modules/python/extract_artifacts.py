@@ -1,5 +1,6 @@
 
 import json
+import os
 from pathlib import Path
 import multiprocessing
 import subprocess
@@ -32,11 +33,7 @@ archive_extensions = [
   ".zip"
   ]
 
-def get_archive_derivation(uuid, artifact_name, url, sha256, closure_dependencies_dag, dependency_uuids, extra_libs, is_darwin):
-  depends_on = set()
-  if closure_dependencies_dag.has_node(uuid):
-    depends_on = set(closure_dependencies_dag.get_dependencies(uuid)).intersection(dependency_uuids)
-
+def get_archive_derivation(uuid, artifact_name, url, sha256, depends_on, extra_libs, is_darwin):
   other_libs = extra_libs.get(uuid, [])
 
   if is_darwin:
@@ -81,7 +78,7 @@ def get_plain_derivation(url, sha256):
       }}"""
 
 def process_item(args):
-  item, julia_path, extract_artifacts_script, closure_dependencies_dag, dependency_uuids, extra_libs, is_darwin = args
+  item, julia_path, extract_artifacts_script, depends_on, extra_libs, is_darwin = args
   uuid, src = item
   lines = []
 
@@ -102,7 +99,7 @@ def process_item(args):
 
     parsed_url = urlparse(url)
     if any(parsed_url.path.endswith(x) for x in archive_extensions):
-      derivation = get_archive_derivation(uuid, artifact_name, url, sha256, closure_dependencies_dag, dependency_uuids, extra_libs, is_darwin)
+      derivation = get_archive_derivation(uuid, artifact_name, url, sha256, depends_on, extra_libs, is_darwin)
     else:
       derivation = get_plain_derivation(url, sha256)
 
@@ -115,6 +112,12 @@ def process_item(args):
 
   return "\n".join(lines)
 
+def get_pool_size(item_count):
+  # Every item runs its own Julia process, so use as many workers as there are
+  # cores available to the build, but not more than there are items
+  cores = int(os.environ.get("NIX_BUILD_CORES", "0")) or os.cpu_count() or 1
+  return max(1, min(cores, item_count))
+
 def main():
   dependencies_path = Path(sys.argv[1])
   closure_yaml_path = Path(sys.argv[2])
@@ -126,7 +129,7 @@ def main():
 
   with open(dependencies_path, "r") as f:
     dependencies = yaml.safe_load(f)
-    dependency_uuids = list(dependencies.keys())  # Convert dict_keys to list
+    dependency_uuids = set(dependencies.keys())
 
   with open(closure_yaml_path, "r") as f:
     # Build up a map of UUID -> closure information
@@ -149,13 +152,17 @@ def main():
 
     f.write("rec {\n")
 
-    with multiprocessing.Pool(10) as pool:
+    # Compute the transitive dependencies of all UUIDs at once, instead of
+    # sending the whole graph to the workers for every item
+    closures = closure_dependencies_dag.get_transitive_closures()
+
+    with multiprocessing.Pool(get_pool_size(len(dependencies))) as pool:
       # Create args tuples for each item
       process_args = [
-        (item, julia_path, extract_artifacts_script, closure_dependencies_dag, dependency_uuids, extra_libs, is_darwin)
+        (item, julia_path, extract_artifacts_script, closures.get(item[0], frozenset()) & dependency_uuids, extra_libs, is_darwin)
         for item in dependencies.items()
       ]
-      for s in pool.map(process_item, process_args):
+      for s in pool.imap(process_item, process_args):
         f.write(s)
 
     f.write(f"""
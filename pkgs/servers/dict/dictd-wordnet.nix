@@ -28,7 +28,7 @@ stdenv.mkDerivation rec {
     done
 
     source_date=$(date --utc --date=@$SOURCE_DATE_EPOCH "+%F %T")
-    faketime -f "$source_date" python ${convert} $DATA
+    faketime -f "$source_date" python ${convert} --mmap $DATA
     echo en_US.UTF-8 > locale
   '';
 
@@ -1,5 +1,8 @@
 # Adapted to produce DICT-compatible files by Petr Rockai in 2012
 # Based on code from wiktiondict by Greg Hewgill
+import collections
+import itertools
+import multiprocessing
 import re
 import sys
 import os
@@ -698,7 +701,9 @@ class WikiHandler(xml.sax.ContentHandler):
     def __init__(self):
         self.element = None
         self.page = None
-        self.text = ""
+        # Chunks of the text of the page, joined once it is complete
+        self.text = []
+        self.textLength = 0
         self.long = {}
     def startElement(self, name, attrs):
         #print "start", name, attrs
@@ -707,12 +712,14 @@ class WikiHandler(xml.sax.ContentHandler):
         #print "end", name
         if self.element == "text":
             if self.page:
+                text = ''.join(self.text)
                 if self.page in self.long:
-                    print(self.page, len(self.text))
+                    print(self.page, len(text))
                     print()
-                self.doPage(self.page, self.text)
+                self.doPage(self.page, text)
                 self.page = None
-            self.text = ""
+            self.text = []
+            self.textLength = 0
         self.element = None
     def characters(self, content):
         #print "characters", content
@@ -721,34 +728,71 @@ class WikiHandler(xml.sax.ContentHandler):
                 self.page = content
         elif self.element == "text":
             if self.page:
-                self.text += content
-                if len(self.text) > 100000 and self.page not in self.long:
+                self.text.append(content)
+                self.textLength += len(content)
+                if self.textLength > 100000 and self.page not in self.long:
                     self.long[self.page] = 1
     def checkPage(self, page):
         return False
     def doPage(self, page, text):
         pass
 
-class TemplateHandler(WikiHandler):
-    def checkPage(self, page):
-        return page.startswith("Template:")
-    def doPage(self, page, text):
-        Templates[page[page.find(':')+1:].lower()] = text
-
-class WordHandler(WikiHandler):
+class PageHandler(WikiHandler):
+    # Collects the words into self.words. Templates are skipped, since
+    # template expansion in dewiki is disabled, so they would only take up
+    # memory.
+    def __init__(self):
+        WikiHandler.__init__(self)
+        self.words = []
     def checkPage(self, page):
         return ':' not in page
     def doPage(self, page, text):
-        m = re.match(r"#redirect\s*\[\[(.*?)\]\]", text, re.IGNORECASE)
-        if m:
-            out.write("  See <%s>" % page)
-            return
-        doc = parse(page, text)
-        out.write(formatBrief(page, doc))
-        #print formatBrief(page, doc)
-
-fn = sys.argv[1]
-info = """   This file was converted from the original database on:
+        self.words.append((page, text))
+
+def readWords(f):
+    # Parse the dump incrementally, yielding the words as they are found
+    handler = PageHandler()
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(handler)
+    while True:
+        data = f.read(1024 * 1024)
+        if not data:
+            break
+        parser.feed(data)
+        yield from handler.words
+        handler.words = []
+    parser.close()
+    yield from handler.words
+
+def formatWord(page, text):
+    m = re.match(r"#redirect\s*\[\[(.*?)\]\]", text, re.IGNORECASE)
+    if m:
+        return "  See <%s>" % page
+    doc = parse(page, text)
+    return formatBrief(page, doc)
+    #print formatBrief(page, doc)
+
+def formatWords(words):
+    return ''.join(formatWord(page, text) for page, text in words)
+
+def writeWords(f, out, jobs, batchSize = 256):
+    # The words are formatted in batches by worker processes, and written in
+    # the order of the dump. Only a few batches are in flight at any time, so
+    # that the dump doesn't have to fit into memory.
+    pending = collections.deque()
+    with multiprocessing.Pool(jobs) as pool:
+        words = readWords(f)
+        while batch := list(itertools.islice(words, batchSize)):
+            pending.append(pool.apply_async(formatWords, (batch,)))
+            if len(pending) >= 2 * jobs:
+                out.write(pending.popleft().get())
+        while pending:
+            out.write(pending.popleft().get())
+
+if __name__ == '__main__':
+    fn = sys.argv[1]
+    jobs = (int(sys.argv[2]) if len(sys.argv) > 2 else 0) or os.cpu_count()
+    info = """   This file was converted from the original database on:
              %s
 
    The original data is available from:
@@ -759,17 +803,12 @@ info = """   This file was converted from the original database on:
   Wiktionary is available under the GNU Free Documentation License.
 """ % (time.ctime(), os.path.basename(fn))
 
-errors = open("mkdict.err", "w")
-
-Templates = {}
-f = os.popen("bunzip2 -c %s" % fn, "r")
-xml.sax.parse(f, TemplateHandler())
-f.close()
+    errors = open("mkdict.err", "w")
 
-f = os.popen("bunzip2 -c %s" % fn, "r")
-out = os.popen("dictfmt -p wiktionary-en --utf8 --columns 0 -u http://en.wiktionary.org", "w")
+    f = os.popen("bunzip2 -c %s" % fn, "r")
+    out = os.popen("dictfmt -p wiktionary-en --utf8 --columns 0 -u http://en.wiktionary.org", "w")
 
-out.write("%%h English Wiktionary\n%s" % info)
-xml.sax.parse(f, WordHandler())
-f.close()
-out.close()
+    out.write("%%h English Wiktionary\n%s" % info)
+    writeWords(f, out, jobs)
+    f.close()
+    out.close()
@@ -26,7 +26,11 @@
 # written.
 
 import datetime
+import functools
+import heapq
+import itertools
 import math
+import mmap
 from textwrap import TextWrapper
 
 CAT_ADJECTIVE = 0
@@ -63,6 +67,20 @@ class WordIndex:
       synsets = [synset_map[int(line_split[i],10)] for i in range(6 + ptr_count, 6 + ptr_count + synset_count)]
       return cls(lemma, category, ptrs, synsets, tagsense_count)
 
+   @classmethod
+   def iter_from_file(cls, f, synset_map):
+      """Yield the entries of a sorted index file one by one"""
+      word_prev = None
+      for line in f:
+         if (line.startswith('  ')):
+            continue
+         wi = cls.build_from_line(line, synset_map)
+         word = wi.lemma.lower()
+         if ((word_prev is not None) and (word < word_prev)):
+            raise ValueError('Index file %r is not sorted: %r follows %r' % (f.name, word, word_prev))
+         word_prev = word
+         yield wi
+
    @classmethod
    def build_from_file(cls, f, synset_map, rv_base=None):
       if (rv_base is None):
@@ -158,21 +176,28 @@ class Synset:
 
       for line in f:
          if (line.startswith('  ')):
-            line_s = line.lstrip().rstrip('\n')
-            line_elements = line_s.split(None,1)
-            try:
-               int(line_elements[0])
-            except ValueError:
-               continue
-            if (len(line_elements) == 1):
-               line_elements.append('')
-            comments.append(line_elements[1])
+            comment = cls.comment_from_line(line)
+            if (comment is not None):
+               comments.append(comment)
             continue
          synset = cls.build_from_line(line.rstrip())
          rv[synset.offset] = synset
 
       return (rv, comments)
 
+   @classmethod
+   def comment_from_line(cls, line_data):
+      """Return the text of a numbered comment line, or None"""
+      line_s = line_data.lstrip().rstrip('\n')
+      line_elements = line_s.split(None,1)
+      try:
+         int(line_elements[0])
+      except (ValueError, IndexError):
+         return None
+      if (len(line_elements) == 1):
+         line_elements.append('')
+      return line_elements[1]
+
    def dict_str(self):
       rv = self.gloss
       if (len(self.words) > 1):
@@ -183,6 +208,47 @@ class Synset:
       return '%s%s' % (self.__class__.__name__, (self.offset, self.type, self.words, self.ptrs, self.gloss, self.frames))
 
 
+class SynsetMap:
+   """Mapping of synset offsets to synsets of a memory-mapped data file.
+
+   Synsets are parsed on demand from the line starting at their offset, which
+   is what wordnet uses to refer to them, and only the most recently used ones
+   are kept around."""
+   def __init__(self, file_data, cache_size=4096):
+      self.name = file_data.name
+      self.data = mmap.mmap(file_data.fileno(), 0, access=mmap.ACCESS_READ)
+      self.lookup = functools.lru_cache(maxsize=cache_size)(self.build)
+
+   def line(self, offset):
+      end = self.data.find(b'\n', offset)
+      if (end < 0):
+         end = len(self.data)
+      return self.data[offset:end].decode()
+
+   def build(self, offset):
+      if not (0 <= offset < len(self.data)):
+         raise KeyError(offset)
+      synset = Synset.build_from_line(self.line(offset).rstrip())
+      if (synset.offset != offset):
+         raise KeyError(offset)
+      return synset
+
+   def __getitem__(self, offset):
+      return self.lookup(offset)
+
+   def comments(self):
+      """Return the comments (license text) at the start of the data file"""
+      rv = []
+      offset = 0
+      while (self.data[offset:offset+2] == b'  '):
+         line = self.line(offset)
+         offset += len(line.encode()) + 1
+         comment = Synset.comment_from_line(line)
+         if (comment is not None):
+            rv.append(comment)
+      return rv
+
+
 class WordnetDict:
    db_info_fmt = '''This file was converted from the original database on:
           %(conversion_datetime)s
@@ -199,8 +265,11 @@ original version.\n\n
    datetime_fmt = '%Y-%m-%dT%H:%M:%S'
    base64_map = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
 
-   def __init__(self, wn_url, desc_short, desc_long):
+   def __init__(self, wn_url, desc_short, desc_long, use_mmap=False):
       self.word_data = {}
+      # (index file, synset map) pairs to read the words from in mmap mode
+      self.word_sources = []
+      self.use_mmap = use_mmap
       self.wn_url = wn_url
       self.desc_short = desc_short
       self.desc_long = desc_long
@@ -209,11 +278,34 @@ original version.\n\n
    def wn_dict_add(self, file_index, file_data):
       file_data.seek(0)
       file_index.seek(0)
-      (synsets, license_lines) = Synset.build_from_file(file_data)
-      WordIndexDictFormatter.build_from_file(file_index, synsets, self.word_data)
+      if (self.use_mmap):
+         synsets = SynsetMap(file_data)
+         license_lines = synsets.comments()
+         self.word_sources.append((file_index, synsets))
+      else:
+         (synsets, license_lines) = Synset.build_from_file(file_data)
+         WordIndexDictFormatter.build_from_file(file_index, synsets, self.word_data)
       if (license_lines):
          self.wn_license = '\n'.join(license_lines) + '\n'
 
+   def words_sorted(self):
+      """Yield (word, word indices) pairs in sorted order of the words.
+
+      In mmap mode, the sorted index files are merged while reading them, and
+      only the synsets of the current word are parsed."""
+      if not (self.use_mmap):
+         for word in sorted(self.word_data):
+            yield (word, self.word_data[word])
+         return
+
+      for (file_index, synsets) in self.word_sources:
+         file_index.seek(0)
+      word_indices = heapq.merge(
+         *[WordIndexDictFormatter.iter_from_file(file_index, synsets) for (file_index, synsets) in self.word_sources],
+         key=lambda wi: wi.lemma.lower())
+      for (word, wis) in itertools.groupby(word_indices, key=lambda wi: wi.lemma.lower()):
+         yield (word, list(wis))
+
    @classmethod
    def base64_encode(cls, i):
       """Encode a non-negative integer into a dictd compatible base64 string"""
@@ -263,10 +355,8 @@ original version.\n\n
       self.dict_entry_write(file_index, file_data, '00-database-url', '00-database-url\n%s\n' % self.wn_url)
 
 
-      words = list(self.word_data.keys())
-      words.sort()
-      for word in words:
-         for wi in self.word_data[word]:
+      for (word, word_indices) in self.words_sorted():
+         for wi in word_indices:
             word_cs = word
             # Use case-sensitivity information of first entry of first synset that
             # matches this word case-insensitively
@@ -283,7 +373,7 @@ original version.\n\n
             break
 
          outstr = ''
-         for wi in self.word_data[word]:
+         for wi in word_indices:
             outstr += wi.dict_str() + '\n'
 
          outstr = '%s%s%s' % (word_cs, wi.linesep, outstr)
@@ -295,16 +385,20 @@ original version.\n\n
 
 if (__name__ == '__main__'):
    import optparse
+   import resource
+   import time
    op = optparse.OptionParser(usage='usage: %prog [options] (<wn_index_file> <wn_data_file>)+')
    op.add_option('-i', '--outindex', dest='oi', default='wn.index', help='filename of index file to write to')
    op.add_option('-d', '--outdata', dest='od', default='wn.dict', help='filename of data file to write to')
    op.add_option('--wn_url', dest='wn_url', default='ftp://ftp.cogsci.princeton.edu/pub/wordnet/2.0', help='URL for wordnet sources')
    op.add_option('--db_desc_short', dest='desc_short', default='     WordNet (r) 2.1 (2005)', help='short dict DB description')
+   op.add_option('--mmap', dest='mmap', action='store_true', default=False, help='memory-map the data files and parse synsets on demand, instead of loading all of them')
    op.add_option('--db_desc_long', dest='desc_long', default='    WordNet (r): A Lexical Database for English from the\n     Cognitive Science Laboratory at Princeton University', help='long dict DB description')
 
    (options, args) = op.parse_args()
 
-   wnd = WordnetDict(wn_url=options.wn_url, desc_short=options.desc_short, desc_long=options.desc_long)
+   time_start = time.monotonic()
+   wnd = WordnetDict(wn_url=options.wn_url, desc_short=options.desc_short, desc_long=options.desc_long, use_mmap=options.mmap)
 
    for i in range(0,len(args),2):
       print('Opening index file %r...' % args[i])
@@ -317,4 +411,5 @@ if (__name__ == '__main__'):
    print('All input files parsed. Writing output to index file %r and data file %r.' % (options.oi, options.od))
 
    wnd.dict_generate(open(options.oi, 'w'),open(options.od, 'w'))
-   print('All done.')
+   print('All done in %.1fs, peak RSS %.1f MiB.' % (time.monotonic() - time_start,
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))